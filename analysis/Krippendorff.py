@@ -7,6 +7,7 @@ license: http://creativecommons.org/licenses/by-sa/3.0/
 '''
 
 import numpy as np
+import parallel
 
 def nominal_metric(a,b):
   return a != b
@@ -17,6 +18,10 @@ def interval_metric(a,b):
 def ratio_metric(a,b):
   return ((a-b)/(a+b))**2
 
+def is_missing(g,missing_items):
+  # the masked constant of numpy.ma is not hashable, so it can't be looked up in a set
+  return g is np.ma.masked or g is missing_items or (missing_items is not None and g == missing_items)
+
 def alpha(data,metric=interval_metric,force_vecmath=False,convert_items=float,missing_items=None):
   '''
   Calculate Krippendorff's alpha (inter-rater reliability):
@@ -39,10 +44,6 @@ def alpha(data,metric=interval_metric,force_vecmath=False,convert_items=float,mi
   # number of coders
   m = len(data)
   
-  # set of constants identifying missing values
-  maskitems = set((missing_items,))
-  maskitems.add(np.ma.masked_singleton)
-  
   # convert input data to a dict of items
   units = {}
   for d in data:
@@ -54,7 +55,7 @@ def alpha(data,metric=interval_metric,force_vecmath=False,convert_items=float,mi
       diter = enumerate(d)
       
     for it,g in diter:
-      if g not in maskitems:
+      if not is_missing(g,missing_items):
         try:
           its = units[it]
         except KeyError:
@@ -90,3 +91,227 @@ def alpha(data,metric=interval_metric,force_vecmath=False,convert_items=float,mi
   De /= float(n*(n-1))
 
   return 1.-Do/De
+
+def fast_alpha(data,metric=interval_metric,convert_items=float,missing_items=None):
+  '''
+  Calculate Krippendorff's alpha without comparing every pair of units. Takes
+  the same data as alpha() and gives the same result up to rounding error:
+  
+  interval_metric: from the sum of squared deviations within each unit and over all pairable values
+  nominal_metric: from the counts of each value within each unit and over all pairable values
+  any other metric: from the coincidences of the distinct values (the metric must accept numpy arrays)
+  
+  convert_items: function for the type conversion of items (default: float)
+  missing_items: indicator for missing items (default: None)
+  '''
+  
+  units,values = pairable_values(data,convert_items,missing_items)
+  return alpha_from_values(units,values,metric)
+
+def reliability_matrix(data,convert_items=float,missing_items=None):
+  '''
+  Arrange data (in any of the formats accepted by alpha()) as a matrix with
+  rows corresponding to coders and columns to units (in order of first
+  appearance). Returns the matrix of values and a boolean matrix marking which
+  of them are present.
+  '''
+  
+  unit_numbers = {}
+  coders = []
+  units = []
+  values = []
+  for c,d in enumerate(data):
+    try:
+      # try if d behaves as a dict
+      diter = d.iteritems()
+    except AttributeError:
+      # sequence assumed for d
+      diter = enumerate(d)
+    
+    for it,g in diter:
+      if not is_missing(g,missing_items):
+        try:
+          u = unit_numbers[it]
+        except KeyError:
+          u = len(unit_numbers)
+          unit_numbers[it] = u
+        coders.append(c)
+        units.append(u)
+        values.append(convert_items(g))
+  
+  values = np.array(values)
+  matrix = np.zeros((len(data),len(unit_numbers)),dtype=values.dtype)
+  mask = np.zeros((len(data),len(unit_numbers)),dtype=bool)
+  matrix[coders,units] = values
+  mask[coders,units] = True
+  return matrix,mask
+
+def pairable_values(data,convert_items=float,missing_items=None):
+  '''
+  Collect the pairable values in data (in any of the formats accepted by
+  alpha()), dropping units that have fewer than two values. Returns two arrays:
+  the unit number of each value (numbered from 0, in order of first
+  appearance) and the values themselves, both sorted by unit.
+  '''
+  
+  return matrix_values(*reliability_matrix(data,convert_items,missing_items))
+
+def matrix_values(matrix,mask):
+  '''
+  Collect the pairable values from the output of reliability_matrix(), in the
+  same format as pairable_values().
+  '''
+  
+  pairable = mask.sum(axis=0) > 1
+  units,coders = np.nonzero(mask[:,pairable].T)
+  return units,matrix[:,pairable][coders,units]
+
+def alpha_from_values(units,values,metric=interval_metric):
+  '''
+  Calculate Krippendorff's alpha from the output of pairable_values().
+  '''
+  
+  n = len(values)  # number of pairable values
+  unit_sizes = np.bincount(units).astype(float)
+  
+  if metric == interval_metric:
+    # the sum of (a-b)**2 over all ordered pairs in a group of k values is
+    # 2*k times the sum of squared deviations from the group mean
+    unit_means = np.bincount(units,values)/unit_sizes
+    unit_ss = np.bincount(units,(values-unit_means[units])**2)
+    Do = np.sum(2.*unit_sizes*unit_ss/(unit_sizes-1.))/n
+    De = 2.*n*np.sum((values-values.mean())**2)/(n*(n-1.))
+  
+  elif metric == nominal_metric:
+    # the number of ordered pairs of unequal values in a group of k values is
+    # k**2 less the sum of the squared counts of each distinct value
+    codes = np.unique(values,return_inverse=True)[1]
+    unit_value_counts = np.unique(units*(codes.max()+1)+codes,return_counts=True)
+    unit_squares = np.bincount(unit_value_counts[0]//(codes.max()+1),unit_value_counts[1].astype(float)**2)
+    Do = np.sum((unit_sizes**2-unit_squares)/(unit_sizes-1.))/n
+    De = (float(n)**2-np.sum(np.bincount(codes).astype(float)**2))/(n*(n-1.))
+  
+  else:
+    # within units, compare each pair of values directly
+    starts = np.concatenate(([0],np.cumsum(np.bincount(units))))
+    Do = 0.
+    for u in range(len(starts)-1):
+      gr = values[starts[u]:starts[u+1]]
+      Do += np.sum(metric(gr[:,np.newaxis],gr[np.newaxis,:]))/float(len(gr)-1)
+    Do /= float(n)
+    # over all pairable values, compare each pair of distinct values weighted
+    # by how often the pair occurs, a block of rows at a time
+    distinct,counts = np.unique(values,return_counts=True)
+    counts = counts.astype(float)
+    De = 0.
+    for start in range(0,len(distinct),256):
+      block = distinct[start:start+256]
+      De += np.dot(counts[start:start+256],np.dot(metric(block[:,np.newaxis],distinct[np.newaxis,:]),counts))
+    De /= float(n*(n-1))
+  
+  return 1.-Do/De
+
+def alpha_bootstrap(data,n_boot=1000,n_jobs=1,seed=None,resample='units',metric=interval_metric,level=0.95,convert_items=float,missing_items=None,block_size=100):
+  '''
+  Bootstrap Krippendorff's alpha by resampling units or coders with replacement.
+  
+  data: in any of the formats accepted by alpha()
+  n_boot: number of bootstrap replicates
+  n_jobs: number of processes over which to spread the replicates (-1 uses every core)
+  seed: seed for the resampling; replicates are drawn in blocks, each from its own stream spawned from the seed (see parallel.run())
+  resample: 'units' or 'coders'
+  metric: function calculating the pairwise distance (must accept numpy arrays)
+  level: coverage of the percentile confidence interval (default: 0.95)
+  block_size: number of replicates computed together
+  
+  For the interval and nominal metrics, each block of replicates is computed at
+  once from resampling weights; other metrics recompute alpha for each replicate.
+  N.B., when coders are resampled, a coder drawn more than once agrees perfectly
+  with their own copies, which biases the replicates upwards.
+  
+  Returns alpha, the bootstrap distribution (an array of n_boot alphas, which
+  are nan for replicates with fewer than two pairable values or no expected
+  disagreement), and the (lower, upper) percentile confidence interval.
+  '''
+  
+  if resample not in ['units','coders']:
+    raise ValueError('resample should be either "units" or "coders"')
+  matrix,mask = reliability_matrix(data,convert_items,missing_items)
+  estimate = alpha_from_values(*matrix_values(matrix,mask),metric=metric)
+  distribution = parallel.run(Bootstrap(matrix,mask,metric,resample),n_boot,n_jobs,seed,block_size)
+  tail = 50.*(1.-level)
+  interval = np.nanpercentile(distribution,[tail,100.-tail])
+  return estimate,distribution,(interval[0],interval[1])
+
+class Bootstrap:
+  '''
+  Computes alpha under blocks of bootstrap replicates for parallel.run().
+  
+  Resampling with replacement is expressed as a weight (the number of times it
+  is drawn) on each unit or coder. For the interval metric, a unit's
+  contribution to alpha only depends on the weighted count, sum, and sum of
+  squares of its values, and for the nominal metric on its weighted count of
+  each value, so a block of replicates takes a few matrix products.
+  '''
+  
+  def __init__(self,matrix,mask,metric,resample):
+    self.metric = metric
+    self.resample = resample
+    if resample == 'units':
+      # units with fewer than two values never become pairable
+      pairable = mask.sum(axis=0) > 1
+      matrix,mask = matrix[:,pairable],mask[:,pairable]
+    self.matrix = matrix
+    self.mask = mask
+    if metric == interval_metric:
+      # centre on the overall mean (for the expected disagreement) and on the
+      # unit means (for the observed disagreement)
+      counts = mask.sum(axis=0).astype(float)
+      values = np.where(mask,matrix,0.).astype(float)
+      unit_means = values.sum(axis=0)/np.maximum(counts,1.)
+      self.overall = np.where(mask,values-values[mask].mean(),0.)
+      self.within = np.where(mask,values-unit_means,0.)
+    elif metric == nominal_metric:
+      codes = np.unique(matrix[mask],return_inverse=True)[1]
+      self.indicators = np.zeros((codes.max()+1,)+mask.shape)
+      self.indicators[(codes,)+np.nonzero(mask)] = 1.
+  
+  def __call__(self,size,random_state):
+    n_items = self.mask.shape[1 if self.resample == 'units' else 0]
+    draws = random_state.randint(0,n_items,size=(size,n_items))
+    if self.metric not in [interval_metric,nominal_metric]:
+      return np.array([self.replicate_alpha(d) for d in draws])
+    weights = np.bincount((draws+n_items*np.arange(size)[:,np.newaxis]).ravel(),minlength=size*n_items).reshape((size,n_items)).astype(float)
+    if self.resample == 'units':
+      # a unit drawn k times counts as k separate units
+      unit_weights = weights
+      total = lambda coder_unit: coder_unit.sum(axis=0)[np.newaxis,:]
+    else:
+      # a coder drawn k times contributes each of their values k times
+      unit_weights = 1.
+      total = lambda coder_unit: np.dot(weights,coder_unit)
+    counts = total(self.mask.astype(float))
+    pairable = counts > 1
+    unit_weights = np.where(pairable,unit_weights,0.)
+    counts = np.where(pairable,counts,2.)
+    n = (unit_weights*counts).sum(axis=1)
+    if self.metric == interval_metric:
+      s1,s2 = total(self.within),total(self.within**2)
+      Do = (unit_weights*2.*(counts*s2-s1**2)/(counts-1.)).sum(axis=1)/n
+      t1,t2 = [(unit_weights*total(x)).sum(axis=1) for x in [self.overall,self.overall**2]]
+      De = 2.*(n*t2-t1**2)/(n*(n-1.))
+    else:
+      value_counts = np.array([total(indicator) for indicator in self.indicators])
+      Do = (unit_weights*(counts**2-(value_counts**2).sum(axis=0))/(counts-1.)).sum(axis=1)/n
+      De = (n**2-((unit_weights*value_counts).sum(axis=2)**2).sum(axis=0))/(n*(n-1.))
+    with np.errstate(divide='ignore',invalid='ignore'):
+      return np.where((n > 1) & (De > 0),1.-Do/De,np.nan)
+  
+  def replicate_alpha(self,draw):
+    if self.resample == 'units':
+      units,values = matrix_values(self.matrix[:,draw],self.mask[:,draw])
+    else:
+      units,values = matrix_values(self.matrix[draw],self.mask[draw])
+    if len(values) < 2:
+      return np.nan
+    return alpha_from_values(units,values,self.metric)
@@ -5,10 +5,10 @@
 # Licensed under the terms of the MIT License
 
 import numpy as np
-from itertools import permutations
-from scipy import spatial, stats
+from itertools import islice, permutations
+import parallel
 
-def test(X, Y, perms=10000, method='pearson', tail='upper'):
+def test(X, Y, perms=10000, method='pearson', tail='upper', block_size=100, n_jobs=1, seed=None, alpha=None, error=0.001, z_error=None, distribution='permutations'):
   """
   Takes two distance matrices (either redundant matrices or condensed vectors)
   and performs a Mantel test. The Mantel test is a significance test of the
@@ -32,6 +32,41 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
   tail : str, optional
       Which tail to test in the calculation of the empirical p-value; either
       'upper' or 'lower' (default: 'upper').
+  block_size : int, optional
+      The number of random permutations that are computed together in one
+      vectorized block (default: 100). Memory use grows with block_size times
+      the length of the condensed distance matrix. Without a seed, the results
+      do not depend on it. A deterministic test enumerates the permutations in
+      blocks of its own (see enumerated_covariances()).
+  n_jobs : int, optional
+      Number of processes over which to spread the random permutations
+      (default: 1). Set to -1 to use every core.
+  seed : int, optional
+      Seed for the random permutations (default: None). Each block of
+      permutations draws from its own stream spawned from the seed, so the
+      results are reproducible whatever the value of n_jobs. If no seed is
+      given, the global numpy random number generator is used.
+  alpha : float, optional
+      Significance level for sequential stopping (default: None). If set, the
+      random permutations stop, after any block, once an exact binomial bound
+      on the p-value lies wholly above or below alpha, so that the outcome of
+      the test at this level is decided.
+  error : float, optional
+      The probability that each bound used by alpha is wrong (default: 0.001).
+  z_error : float, optional
+      Target standard error of the z-score for sequential stopping (default:
+      None). If set, the random permutations stop, after any block, once the
+      z-score's standard error falls below this value. If both alpha and
+      z_error are set, the permutations stop when either is met. Neither
+      applies to a deterministic test.
+  distribution : str, optional
+      How to obtain the null distribution of the statistic; either
+      'permutations' (default) or 'moments'. With 'moments', no permutations
+      are run: the z-score is computed from the exact mean and variance of the
+      statistic over all m! permutations (see permutation_moments()), so it
+      equals the z-score of a deterministic test, and p is its normal
+      approximation. The perms, block_size, n_jobs, seed, alpha, error, and
+      z_error arguments are then ignored.
 
   Returns
   -------
@@ -41,8 +76,16 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
       Empirical p-value
   z : float
       Standard score (z-score)
+  n : int
+      The number of permutations used, including the veridical one (only
+      returned if alpha or z_error is set)
   """
 
+  # SciPy is only imported once a test is run, which keeps importing this module
+  # cheap.
+
+  from scipy import spatial, stats
+
   # Ensure that X and Y are formatted as Numpy arrays.
 
   X = np.asarray(X, dtype=float)
@@ -90,6 +133,20 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
   if tail != 'upper' and tail != 'lower':
     raise ValueError('The tail should be set to "upper" or "lower"')
 
+  # Check for valid distribution parameter.
+
+  if distribution != 'permutations' and distribution != 'moments':
+    raise ValueError('The distribution should be set to "permutations" or "moments"')
+
+  # Sequential stopping is requested by setting alpha and/or z_error.
+
+  sequential = alpha != None or z_error != None
+
+  # Check for valid block_size parameter.
+
+  if block_size < 1:
+    raise ValueError('The block_size should be at least 1')
+
   # Now we're ready to start the Mantel test using a number of optimizations:
   #
   # 1. We don't need to recalculate the pairwise distances between the Y objects
@@ -109,7 +166,19 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
   # 4. If the number of possible permutations is less than the number of
   #    permutations that were requested, we'll run a deterministic test where
   #    we try all possible permutations rather than sample the permutation
-  #    space. This gives a faster, deterministic result.
+  #    space. This gives a faster, deterministic result. The enumeration moves
+  #    from one order to the next by swapping two objects (Heap's algorithm),
+  #    which only changes 2(m-2) entries of the condensed vector, so each
+  #    covariance is updated from the last one in O(m) time, and only running
+  #    totals of the covariances are kept.
+  #
+  # 5. Rather than permute the matrix one order at a time, we'll build a block
+  #    of orders, gather all the permuted condensed vectors in one go, and
+  #    compute the block's covariances together.
+  #
+  # 6. If sequential stopping is requested, we'll stop sampling permutations as
+  #    soon as the p-value is decided at the given level or the z-score is known
+  #    precisely enough, rather than always running the full number.
 
   # First, calculate the X and Y residuals, which will be used to compute the
   # covariance under each permutation.
@@ -120,33 +189,52 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
   # Expand the Y residuals to a redundant matrix format.
   Y_residuals_as_matrix = spatial.distance.squareform(Y_residuals, force='tomatrix', checks=False)
 
+  # Calculate the veridical covariance.
+  covariance = (X_residuals * Y_residuals).sum()
+
+  # If the moments of the permutation distribution are requested, compute the
+  # z-score from them and return without running any permutations.
+
+  if distribution == 'moments':
+    mean, variance = permutation_moments(spatial.distance.squareform(X_residuals, force='tomatrix', checks=False), Y_residuals_as_matrix)
+    r = covariance / np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum())
+    z = standard_score(2.0 * covariance, mean, variance, 2.0 * np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum())) # The moments are of the sum over the redundant matrix
+    if tail == 'upper':
+      p = stats.norm.sf(z)
+    else:
+      p = stats.norm.cdf(z)
+    return r, p, z
+
   m = Y_residuals_as_matrix.shape[0] # Number of objects
   n = np.math.factorial(m) # Number of possible matrix permutations
 
-  # Initialize an empty array to store temporary permutations of Y_residuals.
-  Y_residuals_permuted = np.zeros(Y_residuals.shape[0], dtype=float)
-
   # If the number of requested permutations is greater than the number of
   # possible permutations (m!) or the perms parameter is set to 0, then run a
   # deterministic Mantel test ...
 
   if perms >= n or perms == 0:
 
-    # Initialize an empty array to store the covariances.
-    covariances = np.zeros(n, dtype=float)
-
-    # Enumerate all permutations of row/column orders and iterate over them.
-    for i, order in enumerate(permutations(range(m))):
-
-      # Take a permutation of the matrix.
-      Y_residuals_as_matrix_permuted = Y_residuals_as_matrix[order, :][:, order]
-
-      # Condense the permuted version of the matrix. Rather than use
-      # distance.squareform(), we call directly into the C wrapper for speed.
-      spatial.distance._distance_wrap.to_vector_from_squareform_wrap(Y_residuals_as_matrix_permuted, Y_residuals_permuted)
-
-      # Compute and store the covariance.
-      covariances[i] = (X_residuals * Y_residuals_permuted).sum()
+    # Enumerate the covariances under all permutations of row/column orders
+    # block by block, keeping running totals of their differences from the
+    # veridical covariance. The covariances are updated incrementally, so
+    # those that equal the veridical one may differ from it by rounding error;
+    # differences within a tolerance relative to the largest possible
+    # covariance are counted as ties.
+    tolerance = 1e-10 * np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum())
+    exceeding = differences = squared_differences = 0.0
+    for covariances in enumerated_covariances(X_residuals, Y_residuals_as_matrix):
+      covariances -= covariance
+      if tail == 'upper':
+        exceeding += (covariances >= -tolerance).sum()
+      else:
+        exceeding += (covariances <= tolerance).sum()
+      differences += covariances.sum()
+      squared_differences += (covariances ** 2).sum()
+
+    # Calculate the exact p-value and standard score.
+    p = exceeding / float(n)
+    mean_difference = differences / n
+    z = -mean_difference / np.sqrt((squared_differences / n) - (mean_difference ** 2))
 
   # ... otherwise run a stochastic Mantel test.
 
@@ -155,40 +243,446 @@ def test(X, Y, perms=10000, method='pearson', tail='upper'):
     # Initialize an empty array to store the covariances.
     covariances = np.zeros(perms, dtype=float)
 
-    # Initialize an array to store the permutation order.
-    order = np.arange(m)
-
     # Store the veridical covariance in 0th position...
-    covariances[0] = (X_residuals * Y_residuals).sum()
+    covariances[0] = covariance
+
+    # ...and then run the random permutations in blocks, which may be spread
+    # over several processes. In sequential mode, stop once the stopping rule
+    # is met and keep only the covariances computed so far.
+    sampler = Sampler(X_residuals, Y_residuals_as_matrix)
+    if sequential == True:
+      stop = parallel.StoppingRule(covariances[0], tail, alpha, error, z_error)
+      covariances = np.concatenate((covariances[:1], parallel.run_until(sampler, perms - 1, stop, n_jobs, seed, block_size)))
+    else:
+      covariances[1:] = parallel.run(sampler, perms - 1, n_jobs, seed, block_size)
 
-    # ...and then run the random permutations.
-    for i in range(1, perms):
+    # Calculate the empirical p-value for the upper or lower tail.
 
-      # Choose a random order in which to permute the rows and columns.
-      np.random.shuffle(order)
+    if tail == 'upper':
+      p = (covariances >= covariances[0]).sum() / float(covariances.shape[0])
 
-      # Take a permutation of the matrix.
-      Y_residuals_as_matrix_permuted = Y_residuals_as_matrix[order, :][:, order]
+    elif tail == 'lower':
+      p = (covariances <= covariances[0]).sum() / float(covariances.shape[0])
 
-      # Condense the permuted version of the matrix. Rather than use
-      # distance.squareform(), we call directly into the C wrapper for speed.
-      spatial.distance._distance_wrap.to_vector_from_squareform_wrap(Y_residuals_as_matrix_permuted, Y_residuals_permuted)
+    # Calculate the standard score.
+    z = (covariances[0] - covariances.mean()) / covariances.std()
 
-      # Compute and store the covariance.
-      covariances[i] = (X_residuals * Y_residuals_permuted).sum()
+    if sequential == True:
+      n = covariances.shape[0]
 
   # Calculate the veridical correlation coefficient from the veridical covariance.
-  r = covariances[0] / np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum())
+  r = covariance / np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum())
 
-  # Calculate the empirical p-value for the upper or lower tail.
+  if sequential == True:
+    return r, p, z, n
 
-  if tail == 'upper':
-    p = (covariances >= covariances[0]).sum() / float(covariances.shape[0])
+  return r, p, z
+
+def test_many(X, Ys, perms=10000, method='pearson', tail='upper', correction=None, block_size=100, n_jobs=1, seed=None):
+  """
+  Takes one distance matrix and a list of K candidate distance matrices and
+  performs a Mantel test of the correlation between the first matrix and each
+  candidate. The permutations are shared: each one reorders X once, and the
+  covariances with all K candidates are computed together.
+
+  Parameters
+  ----------
+  X : array_like
+      Distance matrix (condensed or redundant).
+  Ys : list of array_like
+      Candidate distance matrices (condensed or redundant), where the order of
+      elements corresponds to the order of elements in X.
+  perms : int, optional
+      The number of permutations to perform (default: 10000). If the actual
+      number of possible permutations is smaller, the program will enumerate
+      all permutations. Enumeration can be forced by setting this argument to 0.
+  method : str, optional
+      Type of correlation coefficient to use; either 'pearson' or 'spearman'
+      (default: 'pearson').
+  tail : str, optional
+      Which tail to test in the calculation of the empirical p-values; either
+      'upper' or 'lower' (default: 'upper').
+  correction : str, optional
+      Correction of the p-values for testing K candidates; either None
+      (default) or 'max'. With 'max', each candidate's correlation is compared
+      with the largest (or, for the lower tail, smallest) correlation over all
+      K candidates under each permutation, so the p-values control the
+      familywise error rate, e.g. when the best of the K candidates is picked.
+  block_size, n_jobs, seed : optional
+      As for test().
+
+  Returns
+  -------
+  r : ndarray
+      Veridical correlation for each candidate
+  p : ndarray
+      Empirical p-value for each candidate
+  z : ndarray
+      Standard score (z-score) for each candidate
+  """
+
+  from scipy import spatial, stats
+
+  # Format X and the candidates as condensed vectors, and check them.
+
+  X = np.asarray(X, dtype=float)
+  if spatial.distance.is_valid_dm(X) == False and spatial.distance.is_valid_y(X) == False:
+    raise ValueError('X is not a valid condensed or redundant distance matrix')
+  if len(X.shape) == 2:
+    X = spatial.distance.squareform(X, force='tovector', checks=False)
+
+  Y = []
+  for Y_k in Ys:
+    Y_k = np.asarray(Y_k, dtype=float)
+    if spatial.distance.is_valid_dm(Y_k) == False and spatial.distance.is_valid_y(Y_k) == False:
+      raise ValueError('Ys should only contain valid condensed or redundant distance matrices')
+    if len(Y_k.shape) == 2:
+      Y_k = spatial.distance.squareform(Y_k, force='tovector', checks=False)
+    if Y_k.shape[0] != X.shape[0]:
+      raise ValueError('X and Ys are not of equal size')
+    Y.append(Y_k)
+
+  if len(Y) == 0:
+    raise ValueError('Ys should contain at least one distance matrix')
+
+  if X.shape[0] < 3:
+    raise ValueError('X and Ys should represent at least 3 objects')
+
+  # If Spearman correlation is requested, convert X and Ys to ranks.
+
+  if method == 'spearman':
+    X = stats.rankdata(X)
+    Y = [stats.rankdata(Y_k) for Y_k in Y]
+  elif method != 'pearson':
+    raise ValueError('The method should be set to "pearson" or "spearman"')
+
+  if tail != 'upper' and tail != 'lower':
+    raise ValueError('The tail should be set to "upper" or "lower"')
+
+  if correction != None and correction != 'max':
+    raise ValueError('The correction should be set to None or "max"')
+
+  if block_size < 1:
+    raise ValueError('The block_size should be at least 1')
+
+  # The candidates' residuals are the columns of one matrix, so the covariances
+  # for a block of permutations are one matrix product. The covariances are
+  # then scaled to correlations so that the candidates can be compared with
+  # each other under the max correction.
+
+  X_residuals = X - X.mean()
+  Y_residuals = np.column_stack([Y_k - Y_k.mean() for Y_k in Y])
+  norms = np.sqrt((X_residuals ** 2).sum() * (Y_residuals ** 2).sum(axis=0))
+  X_residuals_as_matrix = spatial.distance.squareform(X_residuals, force='tomatrix', checks=False)
+  sampler = ManySampler(X_residuals_as_matrix, Y_residuals)
+
+  m = X_residuals_as_matrix.shape[0] # Number of objects
+  n = np.math.factorial(m) # Number of possible matrix permutations
+
+  # Deterministic test - try all possible permutations...
+
+  if perms >= n or perms == 0:
+    correlations = np.zeros((n, len(Y)), dtype=float)
+    enumeration = permutations(range(m))
+    for start in range(0, n, block_size):
+      orders = np.array(list(islice(enumeration, block_size)), dtype=int)
+      correlations[start:start+orders.shape[0]] = sampler.covariances(orders) / norms
 
-  elif tail == 'lower':
-    p = (covariances <= covariances[0]).sum() / float(covariances.shape[0])
+  # ... otherwise, stochastic test, with the veridical correlations in the 0th
+  # row.
 
-  # Calculate the standard score.
-  z = (covariances[0] - covariances.mean()) / covariances.std()
+  else:
+    correlations = np.zeros((perms, len(Y)), dtype=float)
+    correlations[0] = np.dot(X_residuals, Y_residuals) / norms
+    if perms > 1:
+      correlations[1:] = parallel.run(sampler, perms - 1, n_jobs, seed, block_size) / norms
+
+  r = correlations[0]
+
+  # Compare each candidate with its own permutation distribution, or with the
+  # distribution of the most extreme correlation over all candidates.
+
+  if correction == 'max':
+    if tail == 'upper':
+      extremes = correlations.max(axis=1)
+    else:
+      extremes = correlations.min(axis=1)
+    null = extremes[:, np.newaxis]
+  else:
+    null = correlations
+
+  if tail == 'upper':
+    p = (null >= r).sum(axis=0) / float(correlations.shape[0])
+  else:
+    p = (null <= r).sum(axis=0) / float(correlations.shape[0])
+
+  z = (r - correlations.mean(axis=0)) / correlations.std(axis=0)
 
   return r, p, z
+
+def permutation_moments(A, B):
+  """
+  Computes the exact mean and variance of the statistic
+
+      sum over i != j of A[i, j] * B[order[i], order[j]]
+
+  over all m! orders of the m objects (Mantel, 1967; Hubert, 1987). This
+  takes O(m^2) time.
+
+  Parameters
+  ----------
+  A, B : array_like
+      Symmetric, redundant m x m matrices with zero diagonals.
+
+  Returns
+  -------
+  mean : float
+      Mean of the statistic over all orders
+  variance : float
+      Variance of the statistic over all orders
+  """
+
+  A = np.asarray(A, dtype=float)
+  B = np.asarray(B, dtype=float)
+  m = float(A.shape[0])
+  off_diagonal = ~np.eye(A.shape[0], dtype=bool)
+
+  # The mean only depends on the sums of the two matrices.
+  mean = A.sum() * B.sum() / (m * (m - 1))
+
+  # Subtracting a constant from the off-diagonal entries of A (or B) shifts the
+  # statistic by a constant, so the variance can be computed from the centered
+  # matrices, whose sums are zero. This avoids taking the difference of two
+  # large, nearly equal numbers.
+  A = np.where(off_diagonal, A - A[off_diagonal].mean(), 0.0)
+  B = np.where(off_diagonal, B - B[off_diagonal].mean(), 0.0)
+  A2, B2 = (A ** 2).sum(), (B ** 2).sum()
+  A3, B3 = (A.sum(axis=1) ** 2).sum(), (B.sum(axis=1) ** 2).sum()
+
+  # Sum the contributions of pairs of entries that share both, one, or none of
+  # their objects, each divided by the number of ways of choosing those objects.
+  variance = 2.0 * A2 * B2 / (m * (m - 1))
+  if m > 2:
+    variance += 4.0 * (A3 - A2) * (B3 - B2) / (m * (m - 1) * (m - 2))
+  if m > 3:
+    variance += (2.0 * A2 - 4.0 * A3) * (2.0 * B2 - 4.0 * B3) / (m * (m - 1) * (m - 2) * (m - 3))
+
+  # The variance is zero if either matrix is constant off the diagonal, but
+  # rounding error can leave it slightly negative.
+  return mean, max(variance, 0.0)
+
+def standard_score(statistic, mean, variance, scale):
+  """
+  Computes the standard score of a statistic against the mean and variance of
+  its permutation distribution. If the variance is zero (to within rounding
+  error relative to scale), every permutation gives the same statistic, so the
+  statistic is no further from the mean than any other and the score is 0.
+
+  Parameters
+  ----------
+  statistic : float
+      The veridical statistic.
+  mean, variance : float
+      Mean and variance of the statistic over the permutations.
+  scale : float
+      A bound on the magnitude of the statistic.
+
+  Returns
+  -------
+  z : float
+      The standard score
+  """
+
+  if variance <= (1e-12 * scale) ** 2:
+    return 0.0
+  return (statistic - mean) / np.sqrt(variance)
+
+def enumerated_covariances(X_residuals, Y_residuals_as_matrix, k=7):
+  """
+  Generates the covariance between the X residuals and the Y residuals under
+  every one of the m! row/column orders, in blocks of k! orders (the first
+  covariance of the first block is the veridical one).
+
+  Within a block, the last m - k positions of the order are fixed, and Heap's
+  algorithm runs through all arrangements of the first k positions, swapping
+  two of them at each step. Swapping the objects at positions a and b changes
+  the covariance by
+
+      sum over c of (X[a, c] - X[b, c]) * (Y[o[b], o[c]] - Y[o[a], o[c]])
+
+  (where c is neither a nor b, and o is the order before the swap), which
+  takes O(m) time. The positions swapped at each step are the same in every
+  block, so these changes are computed for a whole block at once and summed
+  cumulatively from the block's first covariance, which is computed in full.
+
+  Parameters
+  ----------
+  X_residuals : array_like
+      Condensed vector of X residuals.
+  Y_residuals_as_matrix : array_like
+      Redundant matrix of Y residuals.
+  k : int, optional
+      Number of positions rearranged within each block (default: 7).
+
+  Yields
+  ------
+  covariances : ndarray
+      Covariance under each order in the next block
+  """
+
+  from scipy import spatial
+
+  m = Y_residuals_as_matrix.shape[0]
+  k = min(k, m)
+  X_residuals_as_matrix = spatial.distance.squareform(X_residuals, force='tomatrix', checks=False)
+  rows, cols = np.triu_indices(m, 1)
+
+  # Record the arrangement of positions before each of Heap's swaps.
+  swaps = heap_swaps(k)
+  steps = np.arange(swaps.shape[0])
+  arrangement = np.arange(m)
+  arrangements = np.zeros((swaps.shape[0], m), dtype=int)
+  for step, (a, b) in enumerate(swaps):
+    arrangements[step] = arrangement
+    arrangement[a], arrangement[b] = arrangement[b], arrangement[a]
+
+  # Weights of the changes in the Y residuals at each swap, which don't depend
+  # on the block, and the flat indices of the Y residuals that change.
+  a, b = swaps[:, 0], swaps[:, 1]
+  weights = X_residuals_as_matrix[a] - X_residuals_as_matrix[b]
+  weights[steps, a] = 0.0
+  weights[steps, b] = 0.0
+  from_a = arrangements[steps, a][:, np.newaxis] * m + arrangements
+  from_b = arrangements[steps, b][:, np.newaxis] * m + arrangements
+
+  # Each block starts from an order with a different selection and ordering of
+  # objects in its last m - k positions. The first block starts from the
+  # veridical order.
+  objects = range(k, m) + range(0, k)
+  for suffix in permutations(objects, m - k):
+    order = np.array(sorted(set(range(m)) - set(suffix)) + list(suffix), dtype=int)
+    Y_residuals_permuted = Y_residuals_as_matrix[np.ix_(order, order)]
+    start = (Y_residuals_permuted[rows, cols] * X_residuals).sum()
+    changes = (weights * (Y_residuals_permuted.take(from_b) - Y_residuals_permuted.take(from_a))).sum(axis=1)
+    yield start + np.concatenate(([0.0], np.cumsum(changes)))
+
+def heap_swaps(k):
+  """
+  Lists the pairs of positions swapped by Heap's algorithm to run through all
+  k! arrangements of k objects.
+
+  Parameters
+  ----------
+  k : int
+      Number of objects.
+
+  Returns
+  -------
+  swaps : ndarray
+      The k! - 1 swaps, one pair of positions per row
+  """
+
+  swaps = []
+  counters = [0] * k
+  i = 1
+  while i < k:
+    if counters[i] < i:
+      if i % 2 == 0:
+        swaps.append((0, i))
+      else:
+        swaps.append((counters[i], i))
+      counters[i] += 1
+      i = 1
+    else:
+      counters[i] = 0
+      i += 1
+  return np.array(swaps, dtype=int).reshape(-1, 2)
+
+def permuted_covariances(X_residuals, Y_residuals_as_matrix, orders, rows, cols):
+  """
+  Computes the covariance between the X residuals and the Y residuals under each
+  of a block of row/column orders.
+
+  Parameters
+  ----------
+  X_residuals : array_like
+      Condensed vector of X residuals.
+  Y_residuals_as_matrix : array_like
+      Redundant matrix of Y residuals.
+  orders : array_like
+      Block of row/column orders, one per row.
+  rows, cols : array_like
+      Row and column indices of the condensed vector's entries in the redundant
+      matrix, as given by numpy.triu_indices(m, 1).
+
+  Returns
+  -------
+  covariances : ndarray
+      Covariance under each order
+  """
+
+  # Gather the permuted, condensed Y residuals for every order in the block.
+  # Row k is Y_residuals_as_matrix[order, :][:, order] in condensed form. The
+  # gather goes through flat indices so that the block is laid out row by row.
+  m = Y_residuals_as_matrix.shape[0]
+  Y_residuals_permuted = Y_residuals_as_matrix.take(orders[:, rows] * m + orders[:, cols])
+
+  # Multiply by the X residuals and sum along each row. This is the
+  # matrix-vector product of the block with the X residuals, but the row sums
+  # use the same summation order as the one-at-a-time computation, so the
+  # covariances are identical to it bit-for-bit.
+  return (Y_residuals_permuted * X_residuals).sum(axis=1)
+
+class Sampler:
+  """
+  Permutation statistic for parallel.run(). Each call draws a block of random
+  row/column orders and returns the covariance between the X residuals and the
+  Y residuals under each of them. The order is shuffled in place from one
+  permutation to the next, so a serial run on the global random number
+  generator reproduces the one-at-a-time loop.
+  """
+
+  def __init__(self, X_residuals, Y_residuals_as_matrix):
+    self.X_residuals = X_residuals
+    self.Y_residuals_as_matrix = Y_residuals_as_matrix
+    self.m = Y_residuals_as_matrix.shape[0]
+    self.rows, self.cols = np.triu_indices(self.m, 1)
+    self.order = np.arange(self.m)
+
+  def __call__(self, size, random_state):
+
+    # Choose a random order for each permutation in the block.
+    orders = np.zeros((size, self.m), dtype=int)
+    for i in range(size):
+      random_state.shuffle(self.order)
+      orders[i] = self.order
+
+    return permuted_covariances(self.X_residuals, self.Y_residuals_as_matrix, orders, self.rows, self.cols)
+
+class ManySampler:
+  """
+  Permutation statistic for parallel.run() used by test_many(). Each call draws
+  a block of random row/column orders and returns the covariance between the
+  permuted X residuals and each of the K candidates' residuals under each of
+  them, as a (size, K) array.
+  """
+
+  def __init__(self, X_residuals_as_matrix, Y_residuals):
+    self.X_residuals_as_matrix = X_residuals_as_matrix
+    self.Y_residuals = Y_residuals
+    self.m = X_residuals_as_matrix.shape[0]
+    self.rows, self.cols = np.triu_indices(self.m, 1)
+    self.order = np.arange(self.m)
+
+  def __call__(self, size, random_state):
+    orders = np.zeros((size, self.m), dtype=int)
+    for i in range(size):
+      random_state.shuffle(self.order)
+      orders[i] = self.order
+    return self.covariances(orders)
+
+  def covariances(self, orders):
+    # Gather the permuted, condensed X residuals for the block, one order per
+    # row, and multiply them by all the candidates at once.
+    X_residuals_permuted = self.X_residuals_as_matrix.take(orders[:, self.rows] * self.m + orders[:, self.cols])
+    return np.dot(X_residuals_permuted, self.Y_residuals)
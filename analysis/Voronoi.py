@@ -1,143 +1,176 @@
-#############################################################
-# Adapted from: https://gist.github.com/neothemachine/8803860
-#############################################################
-
 from __future__ import division
 import numpy as np
-from collections import defaultdict
-from scipy.spatial import Delaunay, KDTree
-import Polygon # http://www.j-raedler.de/projects/polygon/
 
-def voronoi(P):
-  delauny = Delaunay(P)
-  triangles = delauny.points[delauny.vertices]
-  circum_centers = np.array([triangle_csc(tri) for tri in triangles])
-  long_lines_endpoints = []
-  lineIndices = []
-  for i, triangle in enumerate(triangles):
-    circum_center = circum_centers[i]
-    for j, neighbor in enumerate(delauny.neighbors[i]):
-      if neighbor != -1:
-        lineIndices.append((i, neighbor))
-      else:     
-        ps = triangle[(j+1)%3] - triangle[(j-1)%3]
-        ps = np.array((ps[1], -ps[0]))
-        middle = (triangle[(j+1)%3] + triangle[(j-1)%3]) * 0.5
-        di = middle - triangle[j]
-        ps /= np.linalg.norm(ps)
-        di /= np.linalg.norm(di)
-        if np.dot(di, ps) < 0.0:
-          ps *= -1000.0
-        else:
-          ps *= 1000.0
-        long_lines_endpoints.append(circum_center + ps)                
-        lineIndices.append((i, len(circum_centers) + len(long_lines_endpoints)-1))
-  vertices = np.vstack((circum_centers, long_lines_endpoints))
-  lineIndicesSorted = np.sort(lineIndices) # make (1,2) and (2,1) both (1,2)
-  lineIndicesTupled = [tuple(row) for row in lineIndicesSorted]
-  lineIndicesUnique = sorted(set(lineIndicesTupled))
-  return vertices, lineIndicesUnique
- 
-def triangle_csc(pts):
-  rows, cols = pts.shape
-  A = np.bmat([[2 * np.dot(pts, pts.T), np.ones((rows, 1))], [np.ones((1, rows)), np.zeros((1, 1))]])
-  b = np.hstack((np.sum(pts * pts, axis=1), np.ones((1))))
-  x = np.linalg.solve(A,b)
-  bary_coords = x[:-1]
-  return np.sum(pts * np.tile(bary_coords.reshape((pts.shape[0], 1)), (1, pts.shape[1])), axis=0)
- 
-def voronoi_cell_lines(points, vertices, lineIndices):
-  kd = KDTree(points)
-  cells = defaultdict(list)
-  for i1,i2 in lineIndices:
-    v1,v2 = vertices[i1], vertices[i2]
-    mid = (v1+v2)/2
-    _, (p1Idx,p2Idx) = kd.query(mid, 2)
-    cells[p1Idx].append((i1,i2))
-    cells[p2Idx].append((i1,i2))
-  return cells
- 
-def voronoi_polygons(cells):
-  for pIdx,lineIndices_ in cells.items():
-    dangling_lines = []
-    for i1,i2 in lineIndices_:
-      connections = list(filter(lambda i12_: (i1,i2) != (i12_[0],i12_[1]) and (i1==i12_[0] or i1==i12_[1] or i2==i12_[0] or i2==i12_[1]), lineIndices_))
-      assert 1 <= len(connections) <= 2
-      if len(connections) == 1:
-        dangling_lines.append((i1,i2))
-    assert len(dangling_lines) in [0,2]
-    if len(dangling_lines) == 2:
-      (i11,i12), (i21,i22) = dangling_lines
-      connected = list(filter(lambda i12_: (i12_[0],i12_[1]) != (i11,i12) and (i12_[0] == i11 or i12_[1] == i11), lineIndices_))
-      i11Unconnected = len(connected) == 0
-      connected = list(filter(lambda i12_: (i12_[0],i12_[1]) != (i21,i22) and (i12_[0] == i21 or i12_[1] == i21), lineIndices_))
-      i21Unconnected = len(connected) == 0
-      startIdx = i11 if i11Unconnected else i12
-      endIdx = i21 if i21Unconnected else i22
-      cells[pIdx].append((startIdx, endIdx))
-  polys = dict()
-  for pIdx,lineIndices_ in cells.items():
-    directedGraph = lineIndices_ + [(i2,i1) for (i1,i2) in lineIndices_]
-    directedGraphMap = defaultdict(list)
-    for (i1,i2) in directedGraph:
-      directedGraphMap[i1].append(i2)
-    orderedEdges = []
-    currentEdge = directedGraph[0]
-    while len(orderedEdges) < len(lineIndices_):
-      i1 = currentEdge[1]
-      i2 = directedGraphMap[i1][0] if directedGraphMap[i1][0] != currentEdge[0] else directedGraphMap[i1][1]
-      nextEdge = (i1, i2)
-      orderedEdges.append(nextEdge)
-      currentEdge = nextEdge
-    polys[pIdx] = [i1 for (i1,i2) in orderedEdges]
-  return polys
+# SciPy is imported by the function that uses it
+
+# Voronoi polygons for a set of points, bounded by a box (given by its corners,
+# and assumed to be aligned with the axes). Each point is mirrored across the
+# four edges of the box, so that in the Voronoi tessellation of the points and
+# their mirror images, the edges of the box lie on the ridges between the
+# points and their images. The cells of the original points are then exactly
+# their cells clipped to the box, and no clipping is needed. The tessellation is
+# read off the Delaunay triangulation: the vertices of a point's cell are the
+# circumcentres of the triangles around it. Returns an object array holding
+# each cell as an array of vertices in anticlockwise order. Repeated points are
+# triangulated once and share a cell; a ValueError is raised if qhull leaves
+# any other point out of the triangulation.
+#
+# If neighbours is True, an object array of the cells' neighbours is returned
+# as well: for each cell, the index of the point on the other side of each edge
+# (the edge from vertex k to vertex k+1, wrapping around), or -1 where the edge
+# lies on the box. Two points are neighbours if their cells share a Voronoi
+# ridge, which is read off the Delaunay edge between them, so no coordinates
+# are compared. The copies of a repeated point are named by the first of them.
+def polygons(points, bounding_box, neighbours=False):
+  from scipy.spatial import Delaunay
+  points = np.asarray(points, dtype=float)
+  n = points.shape[0]
+  unique_points, inverse = np.unique(points, axis=0, return_inverse=True)
+  if len(unique_points) < n:
+    if neighbours == False:
+      return polygons(unique_points, bounding_box)[inverse]
+    polylist, neighbour_list = polygons(unique_points, bounding_box, True)
+    first = np.zeros(len(unique_points), dtype=int)
+    first[inverse[::-1]] = np.arange(n)[::-1]
+    return polylist[inverse], np.array([np.where(labels >= 0, first[labels], -1) for labels in neighbour_list[inverse]] + [None], dtype=object)[:-1]
+  box_min, box_max = np.min(bounding_box, axis=0), np.max(bounding_box, axis=0)
+  mirrored = [points]
+  for axis in [0, 1]:
+    for edge in [box_min[axis], box_max[axis]]:
+      images = points.copy()
+      images[:, axis] = (2.0 * edge) - images[:, axis]
+      mirrored.append(images)
+  triangulation = Delaunay(np.vstack(mirrored))
+  centres = circumcentres(triangulation.points[triangulation.simplices])
+
+  # Pair each original point with the triangles around it, and sort each
+  # point's triangles by the angle of their centroids around the point. The
+  # triangles form a fan of wedges around the point, so this puts them in order
+  # (as it does their circumcentres, the vertices of the cell) even where
+  # several of them share a circumcentre.
+  corners = triangulation.simplices.ravel()
+  original = corners < n
+  cells = corners[original]
+  triangles = np.repeat(np.arange(triangulation.simplices.shape[0]), 3)[original]
+  offsets = triangulation.points[triangulation.simplices].mean(axis=1)[triangles] - points[cells]
+  order = np.lexsort((np.arctan2(offsets[:, 1], offsets[:, 0]), cells))
+  cells, triangles = cells[order], triangles[order]
+  vertices = centres[triangles]
+  starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+  if len(starts) < n:
+    missing = np.setdiff1d(np.arange(n), cells[starts])
+    raise ValueError('Points left out of the triangulation: %s' % ', '.join(map(str, missing)))
+
+  # Each vertex's predecessor around its cell, wrapping around at the start
+  previous = np.arange(len(cells)) - 1
+  previous[starts] = np.r_[starts[1:], len(cells)] - 1
+
+  # Consecutive triangles around a point share the Delaunay edge to one of the
+  # point's neighbours, and the edge of the cell between their circumcentres is
+  # the ridge with that neighbour. Label each vertex by the edge leading to it.
+  others = triangulation.simplices[triangles]
+  others = others[others != cells[:, np.newaxis]].reshape(-1, 2)
+  shared = (others[:, 0] == others[previous, 0]) | (others[:, 0] == others[previous, 1])
+  labels = np.where(shared, others[:, 0], others[:, 1])
+
+  # Where four or more points lie on a circle (which mirroring makes common),
+  # neighbouring triangles share a circumcentre, so drop repeated vertices (and
+  # the empty edges leading to them)
+  repeated = np.abs(vertices - vertices[previous]).max(axis=1) < 1e-12
+  cells, vertices, labels = cells[~repeated], vertices[~repeated], labels[~repeated]
+
+  # Vertices on the edges of the box are circumcentres, so snap off any
+  # rounding error that puts them outside it
+  vertices = np.clip(vertices, box_min, box_max)
+
+  # Split the vertices into cells, and store each cell under its point
+  starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+  polylist = np.empty(n, dtype=object)
+  neighbour_list = np.empty(n, dtype=object)
+  for cell, polygon, cell_labels in zip(cells[starts], np.split(vertices, starts[1:]), np.split(labels, starts[1:])):
+    polylist[cell] = polygon
+    cell_labels = np.roll(cell_labels, -1)
+    neighbour_list[cell] = np.where(cell_labels < n, cell_labels, -1)
+  if neighbours == True:
+    return polylist, neighbour_list
+  return polylist
+
+# Circumcentres of a stack of triangles, given as an (N, 3, 2) array
+def circumcentres(triangles):
+  a = triangles[:, 0]
+  b = triangles[:, 1] - a
+  c = triangles[:, 2] - a
+  b_squared = (b ** 2).sum(axis=1)
+  c_squared = (c ** 2).sum(axis=1)
+  d = 2.0 * ((b[:, 0] * c[:, 1]) - (b[:, 1] * c[:, 0]))
+  x = ((c[:, 1] * b_squared) - (b[:, 1] * c_squared)) / d
+  y = ((b[:, 0] * c_squared) - (c[:, 0] * b_squared)) / d
+  return a + np.column_stack((x, y))
+
+# Given a set of Voronoi cells, join the ones that share a ridge together into
+# regions. The cells are given with their neighbours, as returned by polygons()
+# with neighbours=True, and cells names the point of each cell (by default, its
+# position in the list). The regions are the connected components of the cells
+# under ridge adjacency, found by union-find. The boundary of a region is made
+# up of the edges of its cells whose neighbours are not in the list, and is
+# traced into closed rings by walking from each boundary edge to the next: at
+# the end of an edge, the walk turns around the vertex through the region's
+# cells (crossing each shared ridge into the cell beyond it) until it reaches
+# another boundary edge. Returns a list of regions, each a list of rings
+# (arrays of vertices): a region has one ring unless it has holes or cells that
+# meet only at a corner, and its area is the area enclosed by its rings under
+# the nonzero winding rule.
+def join_contiguous_polygons(polys, neighbours, cells=None):
+  polys = [np.asarray(poly, dtype=float) for poly in polys]
+  if cells == None:
+    cells = range(len(polys))
+  positions = dict((cell, k) for k, cell in enumerate(cells))
 
-# Takes the intersection of the polygon and bounding box, such that polygons
-# that lie partially out of the bounding box will be clipped
-def clip_to_bounding_box(poly, bounding_box):
-  p = Polygon.Polygon(poly)
-  b = Polygon.Polygon(bounding_box)
-  return list(p & b)[0]
+  # The position in the list of the cell across each edge (-1 if there is none
+  # in the list), and the edge of each cell on the ridge with each of its
+  # neighbours in the list
+  across = [[positions.get(neighbour, -1) for neighbour in cell_neighbours] for cell_neighbours in neighbours]
+  ridges = {}
+  for k in range(len(polys)):
+    for e, m in enumerate(across[k]):
+      if m >= 0:
+        ridges[(k, m)] = e
 
-def polygons(points, bounding_box):
-  vertices, lineIndices = voronoi(points)
-  cells = voronoi_cell_lines(points, vertices, lineIndices)
-  polys = voronoi_polygons(cells)
-  polylist = []
-  for i in range(len(points)):
-    poly = vertices[np.asarray(polys[i])]
-    clipped_poly = clip_to_bounding_box(poly, bounding_box)
-    polylist.append(clipped_poly)
-  return np.asarray(polylist)
+  # Union the cells on either side of every shared ridge
+  parents = range(len(polys))
+  def root(i):
+    while parents[i] != i:
+      parents[i] = parents[parents[i]]
+      i = parents[i]
+    return i
+  for (k, m) in ridges:
+    parents[root(k)] = root(m)
 
-# Given a set of Voronoi polygons, find the cells that are contiguous and
-# join them together into a set of regions
-def join_contiguous_polygons(polys):
-  if len(polys) == 1:
-    return polys
-  adjustment_made = False
-  contiguous_polygons = []
-  matched_indices = []
-  for i in range(0, len(polys)):
-    if i in matched_indices:
-      continue
-    matched_indices.append(i)
-    p = Polygon.Polygon(polys[i])
-    for j in range(i+1, len(polys)):
-      if j in matched_indices:
+  # Trace the boundary edges of each region into rings
+  regions = {}
+  order = []
+  visited = set()
+  for k in range(len(polys)):
+    for e in range(len(polys[k])):
+      if across[k][e] >= 0 or (k, e) in visited:
         continue
-      if contiguous(list(p)[0], polys[j]) == True:
-        p = p | Polygon.Polygon(polys[j])
-        matched_indices.append(j)
-        adjustment_made = True
-    contiguous_polygons.append(list(p)[0])
-  if adjustment_made == True:
-    return join_contiguous_polygons(contiguous_polygons)
-  return polys
+      ring = []
+      edge = (k, e)
+      while edge not in visited:
+        visited.add(edge)
+        c, f = edge
+        ring.append(polys[c][f])
+        f = (f + 1) % len(polys[c])
+        while across[c][f] >= 0:
+          m = across[c][f]
+          c, f = m, (ridges[(m, c)] + 1) % len(polys[m])
+        edge = (c, f)
+      if root(k) not in regions:
+        order.append(root(k))
+      regions.setdefault(root(k), []).append(np.array(ring))
+  return [regions[component] for component in order]
 
-def contiguous(poly1, poly2):
-  for vertex1 in poly1:
-    for vertex2 in poly2:
-      if abs(vertex1[0] - vertex2[0]) < 0.001 and abs(vertex1[1] - vertex2[1]) < 0.001:
-        return True
-  return False
+# Signed area of a polygon, which is positive if its vertices run anticlockwise
+def signed_area(poly):
+  x, y = poly[:, 0], poly[:, 1]
+  return ((x * np.roll(y, -1)) - (np.roll(x, -1) * y)).sum() / 2.0
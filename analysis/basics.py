@@ -1,11 +1,24 @@
 import numpy as np
 from datetime import timedelta
 from random import randrange
-from os import getenv
+from os import getenv, path
+import subprocess
+import sys
+import datastore
+import string_distance
 
 chain_codes = [["A", "B", "C", "D"], ["E", "F", "G", "H"], ["I", "J", "K", "L"]]
 desktop_location = getenv('HOME') + '/Desktop/'
 
+# What to do when some output would overwrite existing output (or data): 'ask'
+# at the keyboard, 'overwrite' without asking, or 'skip' it. Set this to
+# 'overwrite' or 'skip' for batch runs that shouldn't wait for input.
+overwrite_policy = 'ask'
+
+# Import-time budget (in seconds) for the analysis modules. Importing a module
+# should not load any data or compute any results; that happens on first use.
+import_time_budget = 0.25
+
 # Determine which experiment number a chain belongs to
 def determine_experiment_number(chain):
   for experiment in range(0, len(chain_codes)):
@@ -13,27 +26,36 @@ def determine_experiment_number(chain):
       return experiment + 1
   return None
 
+# Decide whether to go ahead and overwrite something, according to an overwrite
+# policy (by default, overwrite_policy). The question is only asked under the
+# 'ask' policy.
+def confirm_overwrite(question, policy=None):
+  if policy == None:
+    policy = overwrite_policy
+  if policy == 'ask':
+    return raw_input(question + ' (y/n) ') == 'y'
+  if policy == 'overwrite':
+    return True
+  if policy == 'skip':
+    return False
+  raise ValueError('The overwrite policy should be ask, overwrite, or skip')
+
 # Get the words for a given set
 def getWords(experiment, chain, generation, set_type):
-  if set_type == "c":
-    data = load(experiment, chain, generation, "d") + load(experiment, chain, generation, "s")
-  else:
-    data = load(experiment, chain, generation, set_type)
-  return [data[x][0] for x in range(0,len(data))]
+  return datastore.get().words(experiment, chain, generation, set_type).tolist()
+
+# Get the response timestamps (in seconds since midnight) for a given set
+def getTimestamps(experiment, chain, generation, set_type):
+  return datastore.get().timestamps(experiment, chain, generation, set_type).tolist()
+
+# Get the response times (in seconds since the previous response) for a given set
+def getResponseTimes(experiment, chain, generation, set_type):
+  return datastore.get().response_times(experiment, chain, generation, set_type).tolist()
 
 # Get the triangles for a given set
 def getTriangles(experiment, chain, generation, set_type):
-  if set_type == "c":
-    data = load(experiment, chain, generation, "d") + load(experiment, chain, generation, "s")
-  else:
-    data = load(experiment, chain, generation, set_type)
-  triangles = []
-  for row in data:
-    x1, y1 = row[1].split(',')
-    x2, y2 = row[2].split(',')
-    x3, y3 = row[3].split(',')
-    triangles.append(np.array([[x1,y1],[x2,y2],[x3,y3]], dtype=float))
-  return triangles
+  triangles = datastore.get().triangles(experiment, chain, generation, set_type)
+  return list(triangles.astype(float))
 
 # Return a count of the number of unique strings in a given set
 def uniqueStrings(experiment, chain, generation, set_type):
@@ -74,11 +96,10 @@ def trainingError(experiment, chain, generation, subject=False):
 
 # Calculate the average amount of time spent on each test item
 def timePerItem(experiment, chain, generation):
-  set_d = load(experiment, chain, generation, "d")
-  timestamp_1 = stringToTimeStamp(set_d[0][4])
-  timestamp_50 = stringToTimeStamp(set_d[47][4])
-  difference = timestamp_50 - timestamp_1
-  time_per_item_set_d = difference.total_seconds() / 94.0
+  timestamps = getTimestamps(experiment, chain, generation, "d")
+  if timestamps[0] == -1 or timestamps[47] == -1:
+    raise ValueError('Set d of chain %s, generation %s, is missing timestamps' % (chain, generation))
+  time_per_item_set_d = (timestamps[47] - timestamps[0]) / 94.0
   return time_per_item_set_d
 
 # Calcualte total time spent on the experiment
@@ -119,41 +140,23 @@ def overuseCount(chain, generation, subject):
 
 # Take a list of strings, conpute the distance between every pair, and return condensed distance matrix
 def stringDistances(strings):
-  distances = []
-  for i in range(0,len(strings)):
-    for j in range(i+1,len(strings)):
-      distances.append(LevenshteinDistance(strings[i], strings[j]))
-  return distances
+  return string_distance.distances(strings).tolist()
 
 # Compute mean normalized Levenshtein distance between consecutive static sets
 def meanNormLevenshtein(strings1, strings2):
   total = 0.0
-  for i in range(0, len(strings1)):
-    total += LevenshteinDistance(strings1[i], strings2[i])
+  for distance in string_distance.paired_distances(strings1, strings2):
+    total += distance
   return total/float(len(strings1))
 
 # Calculate the normalized Levenshtein distance between two strings
 def LevenshteinDistance(s1, s2):
-  if len(s1) > len(s2):
-    s1, s2 = s2, s1
-  distances = range(len(s1) + 1)
-  for index2, char2 in enumerate(s2):
-    newDistances = [index2 + 1]
-    for index1, char1 in enumerate(s1):
-      if char1 == char2:
-        newDistances.append(distances[index1])
-      else:
-        newDistances.append(1 + min((distances[index1], distances[index1+1], newDistances[-1])))
-    distances = newDistances
-  return float(distances[-1]) / max(len(s1), len(s2))
-
-# Load in a data file
+  return string_distance.distance(s1, s2)
+
+# Load in a data file (the rows are copied from the data store, so callers are
+# free to modify them)
 def load(experiment, chain, generation, set_type):
-  filename = "../data/experiment_" + str(experiment) + "/" + chain + "/" + str(generation) + set_type
-  f = open(filename, 'r')
-  data = f.read()
-  f.close()
-  return [row.split('\t') for row in data.split('\n')]
+  return [list(row) for row in datastore.get().rows(experiment, chain, generation, set_type)]
 
 # Write out a matrix to a file on the desktop
 def writeOut(matrix, filename='file'):
@@ -202,3 +205,21 @@ def assign_to_chain(chain_codes, start_gen, end_gen):
       chain_codes.remove(code)
     random_assignment.append( code+str(gen) )
   return random_assignment
+
+# Measure how long a module takes to import in a fresh interpreter (the best of
+# several runs, in seconds)
+def import_time(module, runs=5):
+  code = 'import time; start = time.time(); import %s; print(time.time() - start)' % module
+  directory = path.dirname(path.abspath(__file__))
+  times = [float(subprocess.check_output([sys.executable, '-c', code], cwd=directory)) for i in range(runs)]
+  return min(times)
+
+# Check the import time of each module against the budget and return the
+# modules that exceed it, along with their import times
+def check_import_times(modules=['structure', 'word_length', 'expressivity', 'transmission_error', 'sound_symbolism', 'geometrical_distance', 'rater_analysis', 'communication', 'mds', 'plot'], budget=import_time_budget):
+  over_budget = {}
+  for module in modules:
+    seconds = import_time(module)
+    if seconds > budget:
+      over_budget[module] = seconds
+  return over_budget
@@ -1,10 +1,12 @@
 from collections import defaultdict
-import matplotlib.pyplot as plt
 from numpy import corrcoef, mean
 from copy import deepcopy
 import basics
+import datastore
 import Krippendorff
 
+# matplotlib is imported by Rater.Hist(), which keeps importing this module cheap
+
 ########################################################################################
 
 class Rater:
@@ -28,12 +30,10 @@ class Rater:
   # Read in a ratings file
   def ReadFile(self):
     try:
-      f = open('../data/task_2/' + self.ID)
+      rows = datastore.get().rater_rows('task_2', self.ID)
     except IOError:
       raise ValueError(self.ID + ' is not a valid rater')
-    content = f.read()
-    f.close()
-    return [line.split('\t') for line in content.split('\n')]
+    return [list(row) for row in rows]
 
   # Read in a comments file
   def ReadInComments(self):
@@ -84,6 +84,7 @@ class Rater:
 
   # Produce a histogram of the actual ratings (raw or normalized)
   def Hist(self, normalize=False, savefig=False):
+    import matplotlib.pyplot as plt
     if normalize == True:
       ratings = self.GetRatings('normalized')
       plt.hist(ratings, bins=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
@@ -107,7 +108,7 @@ class Rater:
     if self.normalized_ratings == False:
       return None
     if distances == None:
-      distances = all_distances
+      distances = all_distances()
     x = []
     y = []
     for row in self.normalized_ratings:
@@ -129,6 +130,7 @@ def AverageRatings(agreement_filter=None, test_filter=None, distances=None, krip
   ka_ignore = []
   rater_n = 0
   rater_i = -1
+  raters = get_raters()
   for rater in raters.keys():
     rater_i += 1
     if raters[rater].normalized_ratings == False:
@@ -178,7 +180,7 @@ def AverageRatings(agreement_filter=None, test_filter=None, distances=None, krip
 # Measure communicative error
 def CommError(chain, generation, distances=None):
   if distances == None:
-    distances = reliable_distances
+    distances = reliable_distances()
   dynamic_set = basics.load(3, chain, generation, "d")
   static_set = basics.load(3, chain, generation, "s")
   triangle_pairs = []
@@ -224,20 +226,53 @@ def accuracy_results():
 
 rater_ids = ['RMta7V', 'OkC5LB', '6qLDuu', 'GHenhK', 'foMrWq', 'epHboY', 'bskf5M', 'NKSxRE', 'aXemPV', 'cVaABH', 'Ce4mEV', 'UBEEJA', '0PW6xm', 'tHDQaA', 'EnDYyj', 'U3zEci', 'jIIGEq', 'LbhJA2', 'eQP8Fm', 'SodXwQ', 'iWsaSj', '7LBzg2', 'frx7RY', 'RsEzuJ', '3ZyRRQ', 'cXAjeA', 'ZAihTJ', 'zfRLjU', 'cStvq7', 'hsFArm', 'tk0W7z', 'NQY9bH', 'P1riul', 'UhIFMT', 'AtRWfx', '5yeIpA', 'u6zH8w', 'rltdaN', 'mqsczS', 'PLB9jo', '03n4Ps', 'e5eCFn', 'Xa0q7w', 'x69VP4', 'HIdxeo', 'KUEtYW', '9D3B3k', 'lekIGt', 'EOT6sn', 'T1raSK', 'e0rZ1Y', 'twLkTs', '7tEgXa', 'C1k7uB', 'qpoRlE', 'GnYZ2D', 'OS1YmD', 'hlsn85', 'jkN91v', 'gkgIxF', 'tQWwcZ', 'NdMcUG', 'iRlbmk', '5Pnkze', 'adWJUA', 'lPi5if', 'AQpNFI', 'NMeQyt', 'rwDh1S', 'sbJbvJ', 'zGovuZ', 'B6NxzU', 'blmZFW', 'FHxs7m', 'K7SpWm', 'qoC9Iq', 'a7Ouyu', 'umI9vl', 'fEICAJ', 'n7ESGD', 'mqjvzr', 'N0D9Dj', 'J1Ev8v', 'zms547', '4p0l19', 'dAkLBc', 'qKvAD6', 'j6euM6', 'krwnGt', 'TOs2fl', 'p78HV9', 'w9W551', '4035mM', '1MiLH7', 'YPHNwF', 'LZSGOC', 'fBfJk5', 'xsBBiP', 'InoQiR', '3Z9qcH', 'FXFtPV', '7KLEnT', '7BEQRV', 'YTBdAV', 'sx1DHV', 'J2jvhY', 'U5NmXx', '5Dm1B0', '3g4sob', 'zhBLCn', 'ocN3sS', '7wwEFS', 'g1lqlK', 'WBbYCs', 'DiDOZd', 'R3DMso', '5CqAjK', 'YgkDcT', 'Oq4clq', 'bE170R', 'UGIp7F', 'OydqKh', 'fuFez9', 'jsJmSI', 'MRWJIw', 'Igmw1w', 'kviCDe', 'sKW5iW', 'lRKFkQ', 'pqJ71a', '0UWPAh', 'ieo3JV', 'jAdzzP', 'jErsKs', 'FcVU5v', 'PDKIV3', 'HNIGDC', 'euXIPq', 'Zm4M8U', 'iybJZk', 'BRX5W8', 'ai6GyL', 'svubHN', 'IMiD1n', 'RkECnA', 'XKJ88u', 'tPPoxT', '1vrqxm', 'EBXy1C', 'OMMo1f', '8f7Vtq', 'SsoWcI', 'k3QKem', '2rTLol', '8fOexH', 'JhcpFr', 'SwD4VX', 'cTLzII', 'AE7xKk', 'FtkDMy', 'TkQuHF', 'Zqx2gw', 'LbAjaI', 'rao4KK', 'aH5Dtg', 'dbGgGg', 'LkOM9Y', 'QEA8a8', 'Qadkgy', 'aXg9KI', 'nGLzOJ', 'yTqaYe', 'irnFKd', 'pJzjUt', 'w4bgNR', 'LWwJAo', 'BHVA24', 'btQfPF', 'wzldxs', 'rIhZPZ', 'XJj8D0', 'qDCJXQ', 'bZw1Ek', 'y0wVo3']
 
+# The Rater objects and the two passes of averaging are only computed when they
+# are first asked for, and are then cached for the rest of the session
+cache = {}
+
 # Initialize a Rater object for each rater
-raters = {}
-for rater_id in rater_ids:
-  raters[rater_id] = Rater(rater_id)
+def get_raters():
+  if 'raters' not in cache:
+    raters = {}
+    for rater_id in rater_ids:
+      raters[rater_id] = Rater(rater_id)
+    cache['raters'] = raters
+  return cache['raters']
 
 # First Pass
 # Average everyone's ratings together, but ignore raters whose mean reliability
-# rating is > 100.
-all_distances, all_counts, all_rater_n, ka_data = AverageRatings(None, 100, None, False)
+# rating is > 100. Returns the mean distances, counts, number of raters, and
+# Krippendorff data (None for this pass).
+def first_pass():
+  if 'first_pass' not in cache:
+    cache['first_pass'] = AverageRatings(None, 100, None, False)
+  return cache['first_pass']
 
 # Second Pass
 # Average everyone's ratings together again, this time filtering out raters whose
 # agreement with the average ratings of all raters in the first pass is < 0.4.
-reliable_distances, reliable_counts, reliable_rater_n, ka_data = AverageRatings(0.4, 100, all_distances, True)
+def second_pass():
+  if 'second_pass' not in cache:
+    cache['second_pass'] = AverageRatings(0.4, 100, all_distances(), True)
+  return cache['second_pass']
+
+# Mean distances between pairs of triangles, as rated by all raters
+def all_distances():
+  return first_pass()[0]
+
+# Mean distances between pairs of triangles, as rated by the reliable raters
+def reliable_distances():
+  return second_pass()[0]
+
+# The reliable raters' ratings in the format used by Krippendorff.alpha()
+def ka_data():
+  return second_pass()[3]
+
+# Krippendorff's alpha for the reliable raters' ratings (interval metric)
+def reliability():
+  return Krippendorff.fast_alpha(ka_data())
 
-# Calculate Krippendorff's alpha - this is very slow
-#print(Krippendorff.alpha(ka_data))
+# Bootstrap Krippendorff's alpha for the reliable raters' ratings. Returns alpha,
+# the bootstrap distribution, and the percentile confidence interval.
+def reliability_bootstrap(n_boot=10000, n_jobs=1, seed=None, resample='units', level=0.95):
+  return Krippendorff.alpha_bootstrap(ka_data(), n_boot, n_jobs, seed, resample, level=level)
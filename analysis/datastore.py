@@ -0,0 +1,313 @@
+from os import getpid, listdir, path, rename, stat
+import json
+import re
+import numpy as np
+
+# Location of the data directory, relative to this module
+data_location = path.join(path.dirname(path.abspath(__file__)), '..', 'data')
+
+# Location of the binary cache of the parsed data, which sits next to the data
+# directory
+cache_location = path.join(path.dirname(path.abspath(__file__)), '..', 'data.cache')
+
+# Experiment data filenames: generation number followed by the file type
+filename_pattern = re.compile(r'^(\d+)(d|s|log|logSubA|logSubB)$')
+
+# Rating task directories
+rater_tasks = ['task_1', 'task_2']
+
+# Version of the cache layout; bump this if the layout changes
+cache_version = 2
+
+########################################
+
+# Columnar view of a dynamic or static set file
+
+class SetTable:
+
+  def __init__(self, words, triangles, timestamps, response_times):
+    self.n = len(words)
+    self.words = words
+    self.triangles = triangles
+    self.timestamps = timestamps
+    self.response_times = response_times
+
+  def __len__(self):
+    return self.n
+
+########################################
+
+# The parsed contents of every experiment data file and rating task file. Each
+# file is read once: the raw rows are kept for anything that needs them (log
+# files, the matcher columns of Experiment 3, the raters' files), and dynamic
+# and static set files are also held as typed columns. Experiment files are
+# indexed by (experiment, chain, generation, set_type), and rating task files by
+# (task, rater ID).
+#
+# The parsed data is saved to a binary cache file. On later runs, if none of the
+# source files has changed, the set columns are memory-mapped straight from the
+# cache and the raw rows of a file are only split when they are first needed.
+
+class DataStore:
+
+  def __init__(self, location=data_location, cache=cache_location):
+    self.location = location
+    self.sources = list_sources(location)
+    self.index = dict((source_key(source[0]), i) for i, source in enumerate(self.sources))
+    arrays = None
+    if cache != None:
+      arrays = read_cache(cache, self.sources)
+    if arrays == None:
+      self.parse()
+      if cache != None:
+        write_cache(cache, self.sources, self.to_arrays())
+    else:
+      self.from_arrays(arrays)
+
+  # Read and parse every source file
+  def parse(self):
+    self.files = [read_rows(path.join(self.location, source[0])) for source in self.sources]
+    self.text = None
+    self.sets = []
+    for source, rows in zip(self.sources, self.files):
+      if is_set_file(source[0]):
+        self.sets.append(parse_set(rows))
+      else:
+        self.sets.append(None)
+
+  # Pack the parsed data into flat arrays for the cache
+  def to_arrays(self):
+    texts = ['\n'.join(['\t'.join(row) for row in rows]) for rows in self.files]
+    set_tables = [table for table in self.sets if table != None]
+    set_sizes = [len(table) for table in set_tables]
+    triangles = [table.triangles if table.triangles is not None else np.zeros((len(table), 3, 2), dtype=np.float32) for table in set_tables]
+    return {
+      'text': np.fromstring(''.join(texts), dtype=np.uint8),
+      'text_offsets': np.cumsum([0] + [len(text) for text in texts]).astype(np.int64),
+      'set_files': np.array([i for i, table in enumerate(self.sets) if table != None], dtype=np.int32),
+      'set_offsets': np.cumsum([0] + set_sizes).astype(np.int64),
+      'set_has_triangles': np.array([table.triangles is not None for table in set_tables], dtype=bool),
+      'set_words': np.concatenate([table.words for table in set_tables]),
+      'set_triangles': np.concatenate(triangles),
+      'set_timestamps': np.concatenate([table.timestamps for table in set_tables]),
+      'set_response_times': np.concatenate([table.response_times for table in set_tables]),
+    }
+
+  # Rebuild the store from the (memory-mapped) arrays of the cache
+  def from_arrays(self, arrays):
+    self.text = arrays['text']
+    self.text_offsets = arrays['text_offsets']
+    self.files = [None] * len(self.sources)
+    self.sets = [None] * len(self.sources)
+    offsets = arrays['set_offsets']
+    for set_i, file_i in enumerate(arrays['set_files']):
+      start, end = offsets[set_i], offsets[set_i+1]
+      triangles = None
+      if arrays['set_has_triangles'][set_i] == True:
+        triangles = arrays['set_triangles'][start:end]
+      self.sets[file_i] = SetTable(arrays['set_words'][start:end], triangles, arrays['set_timestamps'][start:end], arrays['set_response_times'][start:end])
+
+  # Find the position of a file in the store
+  def lookup(self, key):
+    try:
+      return self.index[key]
+    except KeyError:
+      raise IOError('No data file for ' + ', '.join([str(part) for part in key]))
+
+  # The raw rows of a file, each row being a list of tab-separated cells
+  def file_rows(self, i):
+    if self.files[i] == None:
+      text = self.text[self.text_offsets[i]:self.text_offsets[i+1]].tostring()
+      self.files[i] = [row.split('\t') for row in text.split('\n')]
+    return self.files[i]
+
+  # The raw rows of an experiment data file
+  def rows(self, experiment, chain, generation, set_type):
+    return self.file_rows(self.lookup((experiment, chain, generation, set_type)))
+
+  # The raw rows of a rater's file from one of the rating tasks
+  def rater_rows(self, task, rater_id):
+    return self.file_rows(self.lookup((task, rater_id)))
+
+  # The columnar view of a set file
+  def table(self, experiment, chain, generation, set_type):
+    return self.sets[self.lookup((experiment, chain, generation, set_type))]
+
+  # The words of a set ("c" is the dynamic set followed by the static set)
+  def words(self, experiment, chain, generation, set_type):
+    if set_type == 'c':
+      return np.concatenate([self.words(experiment, chain, generation, 'd'), self.words(experiment, chain, generation, 's')])
+    return self.table(experiment, chain, generation, set_type).words
+
+  # The triangles of a set as an (n, 3, 2) array of vertex coordinates
+  def triangles(self, experiment, chain, generation, set_type):
+    if set_type == 'c':
+      return np.concatenate([self.triangles(experiment, chain, generation, 'd'), self.triangles(experiment, chain, generation, 's')])
+    triangles = self.table(experiment, chain, generation, set_type).triangles
+    if triangles is None:
+      raise ValueError('Set %s of chain %s, generation %s, has no triangle coordinates' % (set_type, chain, generation))
+    return triangles
+
+  # The response timestamps of a set, in seconds since midnight (-1 if missing)
+  def timestamps(self, experiment, chain, generation, set_type):
+    if set_type == 'c':
+      return np.concatenate([self.timestamps(experiment, chain, generation, 'd'), self.timestamps(experiment, chain, generation, 's')])
+    return self.table(experiment, chain, generation, set_type).timestamps
+
+  # The response times of a set, in seconds since the previous response (-1
+  # for the first response, or if its timestamp is missing)
+  def response_times(self, experiment, chain, generation, set_type):
+    if set_type == 'c':
+      return np.concatenate([self.response_times(experiment, chain, generation, 'd'), self.response_times(experiment, chain, generation, 's')])
+    return self.table(experiment, chain, generation, set_type).response_times
+
+########################################
+
+# List the source files under the data directory as (relative path,
+# modification time, size) triples
+
+def list_sources(location):
+  relative_paths = []
+  for directory in sorted(listdir(location)):
+    if directory.startswith('experiment_'):
+      for chain in sorted(listdir(path.join(location, directory))):
+        for filename in sorted(listdir(path.join(location, directory, chain))):
+          if filename_pattern.match(filename) != None:
+            relative_paths.append(directory + '/' + chain + '/' + filename)
+    elif directory in rater_tasks:
+      for filename in sorted(listdir(path.join(location, directory))):
+        if path.isfile(path.join(location, directory, filename)):
+          relative_paths.append(directory + '/' + filename)
+  sources = []
+  for relative_path in relative_paths:
+    status = stat(path.join(location, relative_path))
+    sources.append([relative_path, status.st_mtime, status.st_size])
+  return sources
+
+# Determine the index key of a source file from its relative path
+
+def source_key(relative_path):
+  parts = relative_path.split('/')
+  if len(parts) == 2:
+    return (parts[0], parts[1])
+  match = filename_pattern.match(parts[2])
+  return (int(parts[0].split('_')[1]), parts[1], int(match.group(1)), match.group(2))
+
+# Is the source file a dynamic or static set file?
+
+def is_set_file(relative_path):
+  return relative_path.startswith('experiment_') and relative_path[-1] in ['d', 's']
+
+# Read a data file and split it into rows of tab-separated cells
+
+def read_rows(filename):
+  f = open(filename, 'r')
+  data = f.read()
+  f.close()
+  return [row.split('\t') for row in data.split('\n')]
+
+# Parse the rows of a set file into columns
+
+def parse_set(rows):
+  words = np.array([row[0] for row in rows], dtype=str)
+  timestamps = np.array([parse_timestamp(row) for row in rows], dtype=np.int32)
+  return SetTable(words, parse_triangles(rows), timestamps, response_times(timestamps))
+
+# Parse the three vertex columns of a set file into a float32 array, or return
+# None if some rows do not have triangle coordinates
+
+def parse_triangles(rows):
+  try:
+    coordinates = [','.join(row[1:4]).split(',') for row in rows]
+    triangles = np.array(coordinates, dtype=np.float32)
+  except (ValueError, IndexError):
+    return None
+  if triangles.ndim != 2 or triangles.shape[1] != 6:
+    return None
+  return triangles.reshape((len(rows), 3, 2))
+
+# Parse a row's timestamp column (HH:MM:SS) into seconds since midnight
+
+def parse_timestamp(row):
+  try:
+    hours, minutes, seconds = row[4].split(':')
+    return (int(hours) * 3600) + (int(minutes) * 60) + int(seconds)
+  except (ValueError, IndexError):
+    return -1
+
+# Seconds between each response and the one before it in time (the rows of a
+# static set are not stored in the order they were answered in). The first
+# response, and any whose timestamp is missing, is given -1.
+def response_times(timestamps):
+  times = np.full(len(timestamps), -1, dtype=np.int32)
+  present = np.flatnonzero(timestamps >= 0)
+  order = present[np.argsort(timestamps[present], kind='mergesort')]
+  times[order[1:]] = timestamps[order[1:]] - timestamps[order[:-1]]
+  return times
+
+########################################
+
+# The cache file starts with a one-line JSON header, which records the cache
+# version, the source files it was built from, and the dtype, shape, and byte
+# offset of each array. The raw array data follows, with each array aligned to
+# 64 bytes so that it can be memory-mapped in place.
+
+def write_cache(filename, sources, arrays):
+  names = sorted(arrays.keys())
+  specs = {}
+  offset = 0
+  for name in names:
+    specs[name] = [arrays[name].dtype.str, list(arrays[name].shape), offset]
+    offset += aligned(arrays[name].nbytes)
+  header = json.dumps({'version':cache_version, 'sources':sources, 'arrays':specs}) + '\n'
+  header += ' ' * (aligned(len(header)) - len(header))
+  temp_filename = filename + '.' + str(getpid()) + '.tmp'
+  try:
+    f = open(temp_filename, 'wb')
+    f.write(header)
+    for name in names:
+      data = np.ascontiguousarray(arrays[name]).tostring()
+      f.write(data + ('\0' * (aligned(len(data)) - len(data))))
+    f.close()
+    rename(temp_filename, filename)
+  except (IOError, OSError):
+    pass # If the cache can't be written, the data is simply parsed again next time
+
+# Memory-map the arrays in the cache file, or return None if there is no valid
+# cache for the current source files
+
+def read_cache(filename, sources):
+  try:
+    f = open(filename, 'rb')
+    header = json.loads(f.readline())
+    data_start = f.tell()
+    f.close()
+  except (IOError, OSError, ValueError):
+    return None
+  if header.get('version') != cache_version or header.get('sources') != sources:
+    return None
+  data_start = aligned(data_start)
+  arrays = {}
+  for name, (dtype, shape, offset) in header['arrays'].items():
+    if np.prod(shape) == 0:
+      arrays[name] = np.zeros(shape, dtype=dtype)
+    else:
+      arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=data_start+offset, shape=tuple(shape))
+  return arrays
+
+# Round a number of bytes up to a multiple of 64
+
+def aligned(n_bytes):
+  return ((n_bytes + 63) // 64) * 64
+
+########################################
+
+# The store is built on first use and shared by everything in the process
+
+store = None
+
+def get():
+  global store
+  if store == None:
+    store = DataStore()
+  return store
@@ -1,9 +1,10 @@
+from functools import partial
 import basics
+import scheduler
 
-def experiment_results(experiment, set_type='s'):
-  results = []
-  for chain in basics.chain_codes[experiment-1]:
-    results.append(chain_results(chain, set_type, experiment))
+def experiment_results(experiment, set_type='s', n_jobs=1):
+  generation_function = partial(generation_results, set_type=set_type, experiment=experiment)
+  results = scheduler.experiment_results(generation_function, experiment, range(0, 11), n_jobs)
   dataset = {'data':results, 'experiment': experiment, 'starting_generation':0,
     'y_range':(0,50), 'y_label':'Expressivity', 'data_type':'expressivity_' + set_type}
   return dataset
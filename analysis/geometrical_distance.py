@@ -1,32 +1,37 @@
+from functools import partial
 from itertools import combinations
-from scipy.spatial import distance
-from scipy.stats import rankdata
 import numpy as np
 import basics
 import geometry
+import Mantel
+import scheduler
+
+# SciPy is imported by the functions that use it, which keeps importing this
+# module cheap
 
 ########################################
 
-# Generate a rank distance matrix for a given geometrical metric
+# Generate a rank distance matrix for a given geometrical metric, which takes a
+# geometry.TriangleSet and returns the distances between all pairs of its
+# triangles as a condensed array
 
 def feature_matrix(triangles, distance_metric):
-  n = len(triangles)
-  # Store the distance between each pair of triangles
-  distance_array = []
-  for i in range(0, n):
-    for j in range(i+1, n):
-      distance_array.append(distance_metric(triangles[i], triangles[j]))
+  from scipy.stats import rankdata
+  if not isinstance(triangles, geometry.TriangleSet):
+    triangles = geometry.TriangleSet(triangles)
   # Convert to ranks to remove distributional effects of each metric
-  return rankdata(distance_array)
+  return rankdata(distance_metric(triangles))
 
 # Generate a set of feature matrices given a set of geometrical metrics
 
 def feature_matrices(triangles, distance_metrics):
+  # Compute the features of the triangles once for all the metrics
+  triangle_set = geometry.TriangleSet(triangles)
   matrices = []
   # For each distance metric (i.e. each feature)...
   for metric in distance_metrics:
     # Compute and store the distance matrix
-    matrices.append(feature_matrix(triangles, metric))
+    matrices.append(feature_matrix(triangle_set, metric))
   return matrices
 
 # Enumerate all combinations of matrices and sum them together
@@ -47,44 +52,59 @@ def combination_matrices(matrices):
 
 ########################################
 
+# Distances between all pairs of triangles in a geometry.TriangleSet, in the
+# order of a condensed distance matrix
+
 # Euclidean distance between centroids
 
-def location_distance(t1, t2):
-  return geometry.ED(geometry.centroid(t1), geometry.centroid(t2))
+def location_distances(triangle_set):
+  rows, cols = np.triu_indices(len(triangle_set), 1)
+  return geometry.distances(triangle_set.centroids[rows], triangle_set.centroids[cols])
 
 # Shortest radial distance by orienting spot
 
-def orientation_distance(t1, t2):
-  t1_rot = geometry.rotation(t1)
-  t2_rot = geometry.rotation(t2)
-  # If both rotations have the same sign...
-  if t1_rot * t2_rot > 0:
-    # ... just return the absolute difference
-    return abs(t1_rot - t2_rot)
-  else:
-    # Sum the rotations
-    theta = abs(t1_rot) + abs(t2_rot)
-    # If the sum of rotations is greater than pi
-    if theta > np.pi:
-      # ... subtract the sum from 2pi
-      return (2 * np.pi) - theta
-    return theta
+def orientation_distances(triangle_set):
+  rows, cols = np.triu_indices(len(triangle_set), 1)
+  rot_1, rot_2 = triangle_set.rotations[rows], triangle_set.rotations[cols]
+  # Where the rotations have different signs, sum them, and if the sum is
+  # greater than pi, subtract it from 2pi
+  theta = np.abs(rot_1) + np.abs(rot_2)
+  theta = np.where(theta > np.pi, (2 * np.pi) - theta, theta)
+  # Where both rotations have the same sign, just take the absolute difference
+  return np.where(rot_1 * rot_2 > 0, np.abs(rot_1 - rot_2), theta)
 
 # Absolute distance between cetroid sizes
 
-def size_distance(t1, t2):
-  return abs(geometry.centroid_size(t1) - geometry.centroid_size(t2))
+def size_distances(triangle_set):
+  rows, cols = np.triu_indices(len(triangle_set), 1)
+  return np.abs(triangle_set.centroid_sizes[rows] - triangle_set.centroid_sizes[cols])
 
 # Absolute difference between equilateralness ratios
 
+def shape_distances(triangle_set):
+  rows, cols = np.triu_indices(len(triangle_set), 1)
+  return np.abs(triangle_set.equilateralnesses[rows] - triangle_set.equilateralnesses[cols])
+
+# The same distances for a single pair of triangles
+
+def location_distance(t1, t2):
+  return location_distances(geometry.TriangleSet([t1, t2]))[0]
+
+def orientation_distance(t1, t2):
+  return orientation_distances(geometry.TriangleSet([t1, t2]))[0]
+
+def size_distance(t1, t2):
+  return size_distances(geometry.TriangleSet([t1, t2]))[0]
+
 def shape_distance(t1, t2):
-  return abs(geometry.equilateralness(t1) - geometry.equilateralness(t2))
+  return shape_distances(geometry.TriangleSet([t1, t2]))[0]
 
 ########################################
 
 # Given a distance matrix, return the most similar and most dissimilar pairs
 
 def most_and_least_similar_pairs(distance_matrix):
+  from scipy.spatial import distance
   if distance.is_valid_dm(distance_matrix) == False:
     if distance.is_valid_y(distance_matrix) == False:
       raise ValueError('Invalid distance matrix. Please supply a condensed or redundant distance matrix.')
@@ -147,37 +167,97 @@ def latex_table(results, experiment):
 
 # Functions for generating experiment, chain, or generation results
 
-def experiment_results(experiment):
-  results = []
-  for chain in basics.chain_codes[experiment-1]:
-    results.append(chain_results(experiment, chain))
+def experiment_results(experiment, n_jobs=1, permutations=None):
+  all_combination_matrices() # Compute these up front so that worker processes inherit them
+  if permutations == None:
+    return experiments_results([experiment])[0]
+  return scheduler.experiment_results(partial(generation_results, experiment, permutations=permutations), experiment, range(0, 11), n_jobs)
+
+# Results for several experiments at once (a list of [chain][generation]
+# results per experiment). The string distances for every generation are
+# stacked and compared with all the combination matrices together.
+
+def experiments_results(experiments=[1, 2, 3]):
+  results = [[[None] * 11 for chain in basics.chain_codes[experiment-1]] for experiment in experiments]
+  positions, string_distances = [], []
+  for i, experiment in enumerate(experiments):
+    for j, chain in enumerate(basics.chain_codes[experiment-1]):
+      for generation in range(0, 11):
+        strings = basics.getWords(experiment, chain, generation, 's')
+        # Leave the result as None if there are < 3 unique strings
+        if len(set(strings)) > 2:
+          positions.append((i, j, generation))
+          string_distances.append(basics.stringDistances(strings))
+  best_matrices, best_rs = best_combinations(string_distances, all_combination_matrices())
+  for (i, j, generation), best_matrix, best_r in zip(positions, best_matrices, best_rs):
+    results[i][j][generation] = (int(best_matrix) + 1, best_r)
   return results
 
-def chain_results(experiment, chain):
+def chain_results(experiment, chain, permutations=None):
   results = []
   for generation in range(0,11):
-    results.append(generation_results(experiment, chain, generation))
+    results.append(generation_results(experiment, chain, generation, permutations))
   return results
 
-def generation_results(experiment, chain, generation):
+# If a number of permutations is given, the best correlation is also tested
+# against the best correlation under each permutation of the strings (see
+# Mantel.test_many), and its p-value is returned as a third element
+
+def generation_results(experiment, chain, generation, permutations=None):
   strings = basics.getWords(experiment, chain, generation, 's')
   # Return None if there are < 3 unique strings
   if len(set(strings)) > 2:
     string_distances = basics.stringDistances(strings)
-    # Iterate through feature combinations to find the best correlation
-    best_r = -1
-    for i in range(0, len(all_combination_matrices)):
-      r = np.corrcoef(string_distances, all_combination_matrices[i])[0,1]
-      if r > best_r:
-        best_matrix = i
-        best_r = r
+    # Find the combination of features with the strongest correlation
+    matrices = all_combination_matrices()
+    best_matrices, best_rs = best_combinations([string_distances], matrices)
+    best_matrix, best_r = int(best_matrices[0]), best_rs[0]
     # Return type number and correlation coefficient for combination of features with strongest correlation
-    return best_matrix + 1, best_r
+    if permutations == None:
+      return best_matrix + 1, best_r
+    p = Mantel.test_many(string_distances, matrices, permutations, correction='max')[1]
+    return best_matrix + 1, best_r, p[best_matrix]
   return None
 
+# Given a stack of string distance arrays and a list of feature combination
+# matrices, return the index of the best correlated matrix for each string
+# distance array, and the correlation. The arrays are standardized so that all
+# the correlations are given by one matrix product.
+
+def best_combinations(string_distances, matrices):
+  correlations = np.dot(standardize(string_distances), standardize(matrices).T)
+  best_matrices = correlations.argmax(axis=1)
+  return best_matrices, correlations[np.arange(correlations.shape[0]), best_matrices]
+
+# Center each row of a stack of arrays and scale it to unit length
+
+def standardize(arrays):
+  arrays = np.asarray(arrays, dtype=float)
+  arrays = arrays - arrays.mean(axis=1)[:, np.newaxis]
+  return arrays / np.sqrt((arrays ** 2).sum(axis=1))[:, np.newaxis]
+
 ########################################
 
-metrics = [location_distance, orientation_distance, shape_distance, size_distance]
-static_set_triangles = basics.getTriangles(1, 'A', 0, 's')
-individual_matrices = feature_matrices(static_set_triangles, metrics)
-all_combination_matrices = combination_matrices(individual_matrices)
+metrics = [location_distances, orientation_distances, shape_distances, size_distances]
+
+# The feature matrices for the static set triangles are only computed when they
+# are first asked for, and are then cached for the rest of the session. The
+# matrices for any other set of triangles can be computed by passing them in.
+cache = {}
+
+# Rank distance matrices for each of the four features
+def individual_matrices(triangles=False):
+  if not (type(triangles) == bool and triangles == False):
+    return feature_matrices(triangles, metrics)
+  if 'individual_matrices' not in cache:
+    static_set_triangles = basics.getTriangles(1, 'A', 0, 's')
+    cache['individual_matrices'] = feature_matrices(static_set_triangles, metrics)
+  return cache['individual_matrices']
+
+# Composite distance matrices for all 15 combinations of the four features
+def all_combination_matrices(triangles=False):
+  if not (type(triangles) == bool and triangles == False):
+    return combination_matrices(individual_matrices(triangles))
+  if 'all_combination_matrices' not in cache:
+    cache['all_combination_matrices'] = combination_matrices(individual_matrices())
+  return cache['all_combination_matrices']
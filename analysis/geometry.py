@@ -1,28 +1,50 @@
 import numpy as np
 
+# Each function comes in two versions: a batched kernel, which takes a stack of
+# triangles as an (N, 3, 2) array (or a stack of points as an (..., 2) array)
+# and returns one value per triangle, and a scalar function, which takes one
+# triangle and wraps the kernel.
+
 #############################################################################
 #   CALCULATE THE EUCLIDEAN DISTANCE BETWEEN TWO POINTS
 
 def ED(a, b):
-  return np.sqrt(((a[0]-b[0])**2.0)+((a[1]-b[1])**2.0))
+  return distances(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+
+def distances(a, b):
+  return np.sqrt(square(a[...,0]-b[...,0])+square(a[...,1]-b[...,1]))
+
+#############################################################################
+#   CALCULATE THE LENGTHS OF THE SIDES (1-2, 2-3, 3-1) OF EACH TRIANGLE
+
+def sides(T):
+  return np.column_stack((distances(T[:,0],T[:,1]), distances(T[:,1],T[:,2]), distances(T[:,2],T[:,0])))
 
 #############################################################################
 #   CALCULATE THE ANGLE OF A VERTEX
 
 def angle(A, vertex):
-  if vertex == 1:
-    p, q, r = ED(A[2],A[0]), ED(A[0],A[1]), ED(A[1],A[2])
-  elif vertex == 2:
-    p, q, r = ED(A[0],A[1]), ED(A[1],A[2]), ED(A[2],A[0])
-  elif vertex == 3:
-    p, q, r = ED(A[1],A[2]), ED(A[2],A[0]), ED(A[0],A[1])
-  return np.arccos(((p**2.0)+(q**2.0)-(r**2.0))/(2.0*p*q))
+  return angles(triangle_stack(A))[0, vertex-1]
+
+# Angles of vertices 1, 2, and 3 of each triangle as an (N, 3) array
+
+def angles(T):
+  S = sides(T)
+  result = np.zeros(S.shape, dtype=float)
+  for vertex in range(1, 4):
+    p, q, r = S[:,(vertex+1)%3], S[:,vertex-1], S[:,vertex%3]
+    result[:,vertex-1] = np.arccos((square(p)+square(q)-square(r))/(2.0*p*q))
+  return result
 
 #############################################################################
 #   CALCULATE THE AREA OF TRIANGLE A
 
 def area(A):
-  a, b, c = ED(A[0],A[1]), ED(A[1],A[2]), ED(A[2],A[0])
+  return areas(triangle_stack(A))[0]
+
+def areas(T):
+  S = sides(T)
+  a, b, c = S[:,0], S[:,1], S[:,2]
   s = (a+b+c)/2.0
   return np.sqrt(s*(s-a)*(s-b)*(s-c))
 
@@ -30,46 +52,100 @@ def area(A):
 #   CALCULATE THE PERIMETER OF TRIANGLE A
 
 def perimeter(A):
-  return ED(A[0],A[1])+ED(A[1],A[2])+ED(A[2],A[0])
+  return perimeters(triangle_stack(A))[0]
+
+def perimeters(T):
+  S = sides(T)
+  return S[:,0]+S[:,1]+S[:,2]
 
 #############################################################################
 #   CALCULATE THE CENTROID SIZE OF TRIANGLE A
 
 def centroid_size(A):
-  c = centroid(A)
-  centroid_size = 0.0
-  for vertex in A:
-    centroid_size += ED(vertex, c)**2
-  return np.sqrt(centroid_size)
+  return centroid_sizes(triangle_stack(A))[0]
+
+def centroid_sizes(T):
+  c = centroids(T)
+  return np.sqrt(square(distances(T[:,0],c))+square(distances(T[:,1],c))+square(distances(T[:,2],c)))
 
 #############################################################################
 #   FIND THE CENTROID OF TRIANGLE A
 
 def centroid(A):
-  return np.array([(A[0][0]+A[1][0]+A[2][0])/3.0,(A[0][1]+A[1][1]+A[2][1])/3.0])
+  return centroids(triangle_stack(A))[0]
+
+def centroids(T):
+  return np.column_stack(((T[:,0,0]+T[:,1,0]+T[:,2,0])/3.0, (T[:,0,1]+T[:,1,1]+T[:,2,1])/3.0))
 
 #############################################################################
 # ROTATE TRIANGLE A SO THAT IT IS POINTING NORTH
 
 def rotate(A):
-  theta = rotation(A)
-  c = centroid(A)
-  return np.dot(A-c,np.array([[np.cos(theta),np.sin(theta)],[-np.sin(theta),np.cos(theta)]]))+c
+  return rotate_all(triangle_stack(A))[0]
+
+def rotate_all(T):
+  theta = rotations(T)[:,np.newaxis]
+  c = centroids(T)[:,np.newaxis,:]
+  B = T - c
+  x = (B[:,:,0]*np.cos(theta)) + (B[:,:,1]*-np.sin(theta))
+  y = (B[:,:,0]*np.sin(theta)) + (B[:,:,1]*np.cos(theta))
+  return np.stack((x, y), axis=2) + c
 
 #############################################################################
 # RETURN THE ANGULAR DISTANCE FROM NORTH FOR TRIANGLE A BY ORIENTING SPOT
 
 def rotation(A):
-  B = A - centroid(A)
-  return np.arctan2(B[0,0], B[0,1])
+  return rotations(triangle_stack(A))[0]
+
+def rotations(T):
+  B = T[:,0] - centroids(T)
+  return np.arctan2(B[:,0], B[:,1])
 
 #############################################################################
 # EQUILATERALNESS RATIO
 
 def upper_bound_on_area(p):
-  return p**2.0 / 20.784609690826528
+  return square(p) / 20.784609690826528
 
 def equilateralness(A):
-  a = area(A)
-  p = perimeter(A)
-  return a / upper_bound_on_area(p)
+  return equilateralnesses(triangle_stack(A))[0]
+
+def equilateralnesses(T):
+  return areas(T) / upper_bound_on_area(perimeters(T))
+
+#############################################################################
+# FEATURE TABLE FOR A SET OF TRIANGLES
+
+# Computes every feature of a set of triangles once, so that the features can
+# be looked up by the analyses that need them
+
+class TriangleSet:
+
+  def __init__(self, triangles):
+    self.triangles = triangle_stack(triangles)
+    self.centroids = centroids(self.triangles)
+    self.rotations = rotations(self.triangles)
+    self.centroid_sizes = centroid_sizes(self.triangles)
+    self.angles = angles(self.triangles)
+    self.areas = areas(self.triangles)
+    self.perimeters = perimeters(self.triangles)
+    self.equilateralnesses = self.areas / upper_bound_on_area(self.perimeters)
+
+  def __len__(self):
+    return self.triangles.shape[0]
+
+#############################################################################
+# SQUARE BY pow() RATHER THAN MULTIPLICATION (WHICH ARRAY ** 2.0 USES), SO THAT
+# THE KERNELS GIVE BIT-FOR-BIT THE SAME RESULTS AS SCALAR ARITHMETIC
+
+def square(x):
+  return np.power(x, 2.0)
+
+#############################################################################
+# FORMAT ONE TRIANGLE OR A LIST OF TRIANGLES AS AN (N, 3, 2) ARRAY
+
+def triangle_stack(triangles):
+  T = np.asarray(triangles, dtype=float)
+  if T.ndim == 2:
+    return T[np.newaxis]
+  return T.reshape(-1, 3, 2)
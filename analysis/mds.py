@@ -1,45 +1,97 @@
-from matplotlib import pyplot as plt, patches
-from scipy.spatial import distance
-from sklearn.manifold import MDS
+from StringIO import StringIO
 import numpy as np
+import hashlib
+import json
 import os
+import re
+import zipfile
 import basics
+import parallel
 import rater_analysis
+import smacof
 import svg_polygons
 import Voronoi
 import geometry
 
+# SciPy and matplotlib are imported by the functions that use them
+
 
 # Globals
 label_font_size = 10 # points
 axis_font_size = 8 # points
 legend_font_size = 10 # points
 figure_width = 5.5 # inches
+report_diagnostics = False # print the stress-1 and correspondence of each MDS solution
+palette_cache_location = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'palettes.cache') # directory of saved colour palettes; None to keep them in memory only
+palette_cache_version = 1 # bump this if the way palettes are computed changes
+svg_id_pattern = re.compile(r"""(\bid=["']|url\(#|href=["']#)""") # IDs and references to them in SVG code
 
 
-def plot_all(chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, save_location=False):
+def plot_all(chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, save_location=False, random_seed=False, overwrite=None, n_jobs=1, archive=False):
+  tasks = []
   for experiment in range(0, len(basics.chain_codes)):
-    plot_experiment(experiment+1, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, save_location)
+    tasks += experiment_tasks(experiment+1, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, save_location, random_seed, overwrite, archive)
+  run_chain_tasks(tasks, n_jobs)
+
+
+def plot_experiment(experiment, chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, save_location=False, random_seed=False, overwrite=None, n_jobs=1, archive=False):
+  run_chain_tasks(experiment_tasks(experiment, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, save_location, random_seed, overwrite, archive), n_jobs)
 
 
-def plot_experiment(experiment, chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, save_location=False):
+# The plot_chain() arguments for each chain in an experiment. The directory for
+# the experiment is set up here, so that any question about overwriting it is
+# asked before any plotting starts, and each chain is given its own random seed
+# (unless one has been specified).
+def experiment_tasks(experiment, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, save_location, random_seed, overwrite, archive=False):
 
   # Set directory for saving, and create it if it doesn't exist
   if save_location == False:
     save_location = basics.desktop_location
   save_location += str(experiment) + '/'
   if os.path.exists(save_location) == True:
-    if raw_input(save_location + ' already exists. Do you want to overwrite? (y/n) ') != 'y':
-      return
+    if basics.confirm_overwrite(save_location + ' already exists. Do you want to overwrite?', overwrite) == False:
+      return []
   else:
     os.makedirs(save_location)
 
+  tasks = []
   for chain in basics.chain_codes[experiment-1]:
-    print('Chain: ' + chain)
-    plot_chain(chain, experiment, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, False, save_location)
+    if type(random_seed) == int:
+      seed = random_seed
+    else:
+      seed = np.random.randint(1, 1000000)
+    tasks.append((chain, experiment, chain_wide_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, seed, save_location, 'overwrite', archive))
+  return tasks
+
+
+# Run plot_chain() for each of a list of argument tuples, in a pool of n_jobs
+# processes (-1 to use every core). The MDS solution and Voronoi cells are
+# computed first, so that the worker processes share them.
+def run_chain_tasks(tasks, n_jobs=1):
+  n_jobs = parallel.number_of_jobs(n_jobs)
+  if n_jobs == 1 or len(tasks) < 2:
+    for task in tasks:
+      run_chain_task(task)
+  else:
+    voronoi_polygons()
+    parallel.pool_map(run_chain_task, tasks, n_jobs, initializer=clear_font_cache)
+
+
+# Drop the FreeType fonts that matplotlib has loaded. A worker process forked
+# after the parent has drawn text inherits the parent's open font objects, which
+# can't be shared between processes (FreeType then fails to load glyphs), so
+# each worker loads its own.
+def clear_font_cache():
+  from matplotlib import font_manager
+  font_manager._get_font.cache_clear()
+
 
+def run_chain_task(task):
+  print('Chain: ' + task[0])
+  plot_chain(*task)
 
-def plot_chain(chain, experiment=None, chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, random_seed=False, save_location=False):
+
+def plot_chain(chain, experiment=None, chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, random_seed=False, save_location=False, overwrite=None, archive=False):
 
   # Determine experiment number if none is supplied
   if experiment == None:
@@ -55,23 +107,90 @@ def plot_chain(chain, experiment=None, chain_wide_palette=True, use_rgb=False, s
   else:
     colour_palette = None
 
-  # Set directory for saving, and create it if it doesn't exist
+  # Otherwise, each generation's palette is started from, and aligned with, the
+  # word coordinates of the previous generations
+  warm_start = {}
+
+  # Set directory (or zip archive) for saving, and create it if it doesn't exist
   if save_location == False:
     save_location = basics.desktop_location
-  save_location += chain + '_' + str(random_seed) + '/'
+  save_location += chain + '_' + str(random_seed)
+  if archive == True:
+    save_location += '.zip'
+  else:
+    save_location += '/'
   if os.path.exists(save_location) == True:
-    if raw_input(save_location + ' already exists. Do you want to overwrite? (y/n) ') != 'y':
+    if basics.confirm_overwrite(save_location + ' already exists. Do you want to overwrite?', overwrite) == False:
       return
-  else:
+  elif archive == False:
     os.makedirs(save_location)
+  if archive == True:
+    archive = zipfile.ZipFile(save_location, 'w', zipfile.ZIP_DEFLATED)
+    save_location = ''
+  else:
+    archive = None
 
-  # Produce a plot for each generation
+  # Produce a plot for each generation, all drawn on the same figure
   print('Generating graphics...')
+  renderer = ChainRenderer(show_prototypes, label_cells, join_contiguous_cells)
+  try:
+    for generation in range(0, 11):
+      plot(chain, generation, experiment, colour_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, False, random_seed, save_location, warm_start, renderer, archive)
+  finally:
+    if archive != None:
+      archive.close()
+
+
+# Produce a single animated SVG of a chain, showing each generation in turn for
+# frame_duration seconds. The arguments are as for plot_chain().
+def animate_chain(chain, experiment=None, chain_wide_palette=True, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, random_seed=False, save_location=False, frame_duration=1.0):
+
+  # Determine experiment number if none is supplied
+  if experiment == None:
+    experiment = basics.determine_experiment_number(chain)
+
+  # Get the strings and triangles of each generation
+  strings = [basics.getWords(experiment, chain, generation, 's') for generation in range(0, 11)]
+  triangles = [basics.getTriangles(experiment, chain, generation, 's') for generation in range(0, 11)]
+
+  # Pick one palette for the whole chain, or one per generation, each started
+  # from the word coordinates of the previous generations
+  if chain_wide_palette == True:
+    colour_palette, random_seed = generate_colour_palette(sum(strings, []), use_rgb, spectrum, random_seed)
+    palettes = [colour_palette] * 11
+  else:
+    warm_start = {}
+    palettes = []
+    for generation in range(0, 11):
+      colour_palette, seed = generate_colour_palette(strings[generation], use_rgb, spectrum, random_seed, warm_start)
+      if generation == 0:
+        random_seed = seed
+      palettes.append(colour_palette)
+
+  # Draw each generation once to find its layout, and then fix the narrowest
+  # layout (the one that leaves most room for the legend) for every frame, so
+  # that the axes stay still
+  renderer = ChainRenderer(show_prototypes, label_cells, join_contiguous_cells)
+  layouts = []
   for generation in range(0, 11):
-    plot(chain, generation, experiment, colour_palette, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, False, random_seed, save_location)
+    renderer.draw(strings[generation], triangles[generation], palettes[generation])
+    layouts.append(renderer.layout)
+  renderer.fixed_layout = min(layouts, key=lambda layout: layout['right'] - layout['left'])
 
+  # Draw each generation again and combine the frames
+  frames = []
+  for generation in range(0, 11):
+    renderer.draw(strings[generation], triangles[generation], palettes[generation])
+    frames.append(renderer.render())
+
+  if type(save_location) == bool and save_location == False:
+    save_location = basics.desktop_location
+  f = open(save_location + chain + '_' + str(random_seed) + '_animated.svg', 'w')
+  f.write(animate_svg(frames, frame_duration))
+  f.close()
 
-def plot(chain, generation, experiment=None, colour_palette=None, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, colour_candidates=False, random_seed=False, save_location=False):
+
+def plot(chain, generation, experiment=None, colour_palette=None, use_rgb=False, spectrum=[0.5, 1.0], show_prototypes=False, label_cells=False, join_contiguous_cells=False, colour_candidates=False, random_seed=False, save_location=False, warm_start=None, renderer=None, archive=None):
 
   # Determine experiment number if none supplied
   if experiment == None:
@@ -81,128 +200,252 @@ def plot(chain, generation, experiment=None, colour_palette=None, use_rgb=False,
   strings = basics.getWords(experiment, chain, generation, 's')
   triangles = basics.getTriangles(experiment, chain, generation, 's')
 
-  # Pick a colour palette if none has been supplied
+  # Pick a colour palette if none has been supplied. If multiple colour palette
+  # candidates have been requested, pick one for each of a set of random seeds;
+  # the candidates share the words' MDS solution (see word_coordinates()) and
+  # the figure, so only their rotations differ.
   if colour_palette == None:
-    colour_palette, random_seed = generate_colour_palette(strings, use_rgb, spectrum, random_seed)
+    palettes = []
+    for seed in candidate_seeds(colour_candidates, random_seed):
+      palettes.append(generate_colour_palette(strings, use_rgb, spectrum, seed, warm_start))
     chain_palette = False
   else:
+    palettes = [(colour_palette, random_seed)]
     chain_palette = True
 
-  if type(colour_candidates) == int:
-    candidate_num = '_' + str(random_seed)
-  else:
-    candidate_num = ''
-
-  # Organize strings and triangles into categories
-  word_dict = {}
-  triangle_dict = {}
-  for i in range(0, len(strings)):
-    if strings[i] in word_dict.keys():
-      word_dict[strings[i]].append(i)
-      triangle_dict[strings[i]].append(triangles[i])
-    else:
-      word_dict[strings[i]] = [i]
-      triangle_dict[strings[i]] = [triangles[i]]
-
-  # Set up subplot in top left
-  plt.subplots(figsize=(figure_width, figure_width/1.375))
-  ax1 = plt.subplot2grid((11,2), (0,0), rowspan=7)
+  # Set up the figure, unless one has been supplied (e.g. by plot_chain())
+  if renderer == None:
+    renderer = ChainRenderer(show_prototypes, label_cells, join_contiguous_cells)
 
-  # Determine the optimum size for the grid of triangle images / grid of legend labels
-  # (a square number larger than the number of unique strings)
-  for square in [1, 4, 9, 16, 25, 36, 49]:
-    if square >= len(word_dict.keys()):
-      break
-  grid_size = int(np.sqrt(square))
-
-  # Rearrange words so that they'll appear in alphabetical order along rows of the legend
-  words = rearrange(word_dict.keys(), grid_size)
-
-  # Plot MDS coordinates and the Voronoi polygons
-  for word in words:
-    indices = word_dict[word]
-    colour, colour_light = colour_palette[word]
-    X, Y = triangle_coordinates[indices, 0], triangle_coordinates[indices, 1]
-    plt.scatter(X, Y, c=colour_light, label=word, marker='o', s=12, linewidth=0, zorder=0)
-    plt.scatter(X, Y, c=colour, marker='o', s=12, linewidth=0, zorder=2)
-    if join_contiguous_cells == True:
-      regional_polys = Voronoi.join_contiguous_polygons(voronoi_polygons[indices])
-      for poly in regional_polys:
-        ax1.add_patch(patches.Polygon(poly, facecolor=colour_light, edgecolor='white', linewidth=0.5, zorder=1))
-    else:
-      for i in indices:
-        ax1.add_patch(patches.Polygon(voronoi_polygons[i], facecolor=colour_light, edgecolor='white', linewidth=0.5, zorder=0))
-        if label_cells == True:
-          x, y = centroid(voronoi_polygons[i])
-          ax1.text(x, y, word, {'fontsize':5}, ha='center', va='center')
-  
-  # Set axis style
-  plt.xlim(-1, 1)
-  plt.ylim(-1, 1)
-  plt.xlabel("MDS dimension 1", fontsize=label_font_size)
-  plt.ylabel("MDS dimension 2", fontsize=label_font_size)
-  plt.xticks(fontsize=axis_font_size)
-  plt.yticks(fontsize=axis_font_size)
-
-  # Set up subplot at bottom for legend
-  ax2 = plt.subplot2grid((11,2), (7,0), colspan=2)
-  plt.axis('off')
-
-  # Produce the legend
-  handles, labels = ax1.get_legend_handles_labels()
-  ax2.legend(handles, labels, loc='upper center', bbox_to_anchor=[0.45, 0.5], frameon=False, prop={'size':legend_font_size}, ncol=grid_size, scatterpoints=1, handletextpad=0.01, markerscale=2.5)
-  
-  # Tighten plot layout
-  plt.tight_layout(pad=0.2, h_pad=0.0)
-
-  # Determine filename and directory if none has been specified
+  # Determine directory if none has been specified
   if type(save_location) == bool and save_location == False:
     save_location = basics.desktop_location
 
-  if chain_palette == True:
-    filename = save_location + chain + str(generation) + '.svg'
-  else:
-    filename = save_location + chain + str(generation) + '_' + str(random_seed) + '.svg'
-
-  # Save matplotlib plot as SVG file
+  # Produce a figure for each colour palette
+  for colour_palette, random_seed in palettes:
+    renderer.draw(strings, triangles, colour_palette)
+    if chain_palette == True:
+      filename = save_location + chain + str(generation) + '.svg'
+    else:
+      filename = save_location + chain + str(generation) + '_' + str(random_seed) + '.svg'
+    renderer.save(filename, archive)
+
+
+# Draws the figures for the generations of a chain. The parts of a figure that
+# are the same in every generation (the axes, the MDS points, and the Voronoi
+# cells and their label positions) are built once; drawing a generation only
+# recolours them and replaces the legend and the triangle panel.
+class ChainRenderer:
+
+  def __init__(self, show_prototypes=False, label_cells=False, join_contiguous_cells=False):
+    from matplotlib import patches
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.gridspec import GridSpec
+    self.show_prototypes = show_prototypes
+    self.join_contiguous_cells = join_contiguous_cells
+    self.figure = Figure(figsize=(figure_width, figure_width/1.375))
+    FigureCanvasAgg(self.figure)
+    self.default_layout = subplot_params(self.figure)
+    self.layouts = {}
+    self.layout = None
+    self.fixed_layout = None
+    grid = GridSpec(11, 2)
+
+    # Set up subplot in top left
+    self.ax1 = self.figure.add_subplot(grid[0:7, 0])
+
+    # Plot MDS coordinates and the Voronoi polygons, which are hidden if
+    # contiguous cells are to be joined
+    coordinates = triangle_coordinates()
+    polygons = voronoi_polygons()
+    self.light_points = self.ax1.scatter(coordinates[:, 0], coordinates[:, 1], marker='o', s=12, linewidth=0, zorder=0)
+    self.points = self.ax1.scatter(coordinates[:, 0], coordinates[:, 1], marker='o', s=12, linewidth=0, zorder=2)
+    self.cells = []
+    for polygon in polygons:
+      cell = patches.Polygon(polygon, edgecolor='white', linewidth=0.5, zorder=0, visible=join_contiguous_cells == False)
+      self.cells.append(self.ax1.add_patch(cell))
+    self.regions = []
+    self.labels = []
+    if label_cells == True and join_contiguous_cells == False:
+      for polygon in polygons:
+        x, y = centroid(polygon)
+        self.labels.append(self.ax1.text(x, y, '', {'fontsize':5}, ha='center', va='center'))
+
+    # Set axis style
+    self.ax1.set_xlim(-1, 1)
+    self.ax1.set_ylim(-1, 1)
+    self.ax1.set_xlabel("MDS dimension 1", fontsize=label_font_size)
+    self.ax1.set_ylabel("MDS dimension 2", fontsize=label_font_size)
+    self.ax1.tick_params(labelsize=axis_font_size)
+
+    # Set up subplot at bottom for legend
+    self.ax2 = self.figure.add_subplot(grid[7, 0:2])
+    self.ax2.axis('off')
+    self.triangle_canvas = None
+
+  # Draw a generation: its strings, its triangles, and a colour palette that
+  # covers the strings
+  def draw(self, strings, triangles, colour_palette):
+    from matplotlib import patches
+    from matplotlib.lines import Line2D
+    from matplotlib.path import Path
+
+    # Organize strings and triangles into categories
+    word_dict = {}
+    triangle_dict = {}
+    for i in range(0, len(strings)):
+      if strings[i] in word_dict:
+        word_dict[strings[i]].append(i)
+        triangle_dict[strings[i]].append(triangles[i])
+      else:
+        word_dict[strings[i]] = [i]
+        triangle_dict[strings[i]] = [triangles[i]]
+
+    # Determine the optimum size for the grid of triangle images / grid of legend labels
+    # (a square number larger than the number of unique strings)
+    for square in [1, 4, 9, 16, 25, 36, 49]:
+      if square >= len(word_dict.keys()):
+        break
+    grid_size = int(np.sqrt(square))
+
+    # Rearrange words so that they'll appear in alphabetical order along rows of the legend
+    words = rearrange(word_dict.keys(), grid_size)
+
+    # Recolour the points and the cells, and relabel the cells
+    colours = [colour_palette[string][0] for string in strings]
+    light_colours = [colour_palette[string][1] for string in strings]
+    self.points.set_facecolors(colours)
+    self.light_points.set_facecolors(light_colours)
+    if self.join_contiguous_cells == True:
+      for region in self.regions:
+        region.remove()
+      self.regions = []
+      for word in words:
+        for rings in joined_regions(word_dict[word]):
+          path = Path.make_compound_path(*[Path(np.vstack((ring, ring[:1])), closed=True) for ring in rings])
+          self.regions.append(self.ax1.add_patch(patches.PathPatch(path, facecolor=colour_palette[word][1], edgecolor='white', linewidth=0.5, zorder=1)))
+    else:
+      for cell, colour in zip(self.cells, light_colours):
+        cell.set_facecolor(colour)
+    for label, string in zip(self.labels, strings):
+      label.set_text(string)
+
+    # Produce the legend
+    handles = [Line2D([], [], linestyle='', marker='o', markersize=np.sqrt(12), markeredgewidth=0, markerfacecolor=colour_palette[word][1]) for word in words]
+    self.ax2.legend(handles, words, loc='upper center', bbox_to_anchor=[0.45, 0.5], frameon=False, prop={'size':legend_font_size}, ncol=grid_size, numpoints=1, handletextpad=0.01, markerscale=2.5)
+
+    # Tighten plot layout, starting from the default layout, as a new figure
+    # would, unless a layout has been fixed. The layout depends only on the
+    # legend, so it is remembered for each set of words.
+    if self.fixed_layout != None:
+      self.layout = self.fixed_layout
+    elif tuple(words) in self.layouts:
+      self.layout = self.layouts[tuple(words)]
+    else:
+      self.figure.subplots_adjust(**self.default_layout)
+      self.figure.tight_layout(pad=0.2, h_pad=0.0)
+      self.layout = subplot_params(self.figure)
+      self.layouts[tuple(words)] = self.layout
+    self.figure.subplots_adjust(**self.layout)
+
+    # Draw the triangle images
+    self.triangle_canvas = draw_triangles(triangle_dict, colour_palette, self.show_prototypes, grid_size)
+
+  # Write the SVG code for the figure as it has been drawn to a file-like
+  # stream. The figure is rendered into memory and written up to its closing
+  # tag, followed by the triangle images and the closing tag.
+  def write(self, stream):
+    buffer = StringIO()
+    self.figure.savefig(buffer, format='svg')
+    graph_code = buffer.getvalue()
+    end = graph_code.rindex('</svg>')
+    stream.write(graph_code[:end])
+    if self.triangle_canvas != None:
+      self.triangle_canvas.write(stream)
+    stream.write(graph_code[end:])
+
+  # Return the SVG code for the figure as it has been drawn
+  def render(self):
+    buffer = StringIO()
+    self.write(buffer)
+    return buffer.getvalue()
+
+  # Save the figure as an SVG file, or as a file called filename in a zip
+  # archive, if one is given
+  def save(self, filename, archive=None):
+    if archive != None:
+      archive.writestr(filename, self.render())
+    else:
+      f = open(filename, 'w')
+      self.write(f)
+      f.close()
 
-  plt.savefig(filename)
-  plt.close()
 
-  # Draw the triangle images and splice them into the matplotlib SVG file
-  triangle_code = draw_triangles(triangle_dict, colour_palette, show_prototypes, grid_size)
-  splice_in_triangles(filename, triangle_code)
+# The subplot parameters (margins and spacing) of a figure
+def subplot_params(figure):
+  return dict((param, getattr(figure.subplotpars, param)) for param in ['left', 'right', 'bottom', 'top', 'wspace', 'hspace'])
 
-  # If multiple colour palette candidates have been requested, run plot() again.
-  if colour_candidates > 1:
-    plot(chain, generation, experiment, None, use_rgb, spectrum, show_prototypes, label_cells, join_contiguous_cells, colour_candidates-1, False, save_location)
 
+# The random seed picks the rotation of the words' MDS solution, and so the
+# palette. If a warm_start dictionary of word coordinates is given (see
+# word_coordinates()), it is updated with these words' coordinates. Palettes are
+# looked up by a hash of everything they depend on (see palette_key()), and are
+# only computed the first time they are asked for.
+def generate_colour_palette(strings, use_rgb=False, spectrum=[0.0, 1.0], random_seed=False, warm_start=None):
 
-def generate_colour_palette(strings, use_rgb=False, spectrum=[0.0, 1.0], random_seed=False):
+  # Get sorted list of unique strings
+  words = sorted(set(strings))
 
-  # Get list of unique strings
-  words = list(set(strings))
+  if type(random_seed) != int:
+    # Pick a random number for the rotation of the MDS solution
+    random_seed = np.random.randint(1, 1000000)
 
   # If there's only one word, just map that word to a grey colour and return, since
   # it won't make sense to arrange the words in colour space.
   if len(words) == 1:
-    return {words[0] : ('#B1B0CB', '#D8D8E5')}
+    return {words[0] : ('#B1B0CB', '#D8D8E5')}, random_seed
+
+  # Only the coordinates of the words that are already in warm_start affect the palette
+  if use_rgb == True:
+    n_components = 3
+  else:
+    n_components = 2
+  anchors = {}
+  if warm_start != None:
+    for word in words:
+      if word in warm_start and len(warm_start[word]) == n_components:
+        anchors[word] = warm_start[word]
+
+  key = palette_key(words, use_rgb, spectrum, random_seed, anchors)
+  entry = cached_palette(key)
+  if entry == None:
+    entry = compute_colour_palette(words, use_rgb, spectrum, random_seed, anchors)
+    store_palette(key, entry)
+  colour_palette, coordinates = entry
+  if warm_start != None:
+    warm_start.update(coordinates)
+  return dict(colour_palette), random_seed
+
+
+# Compute the colour palette for a sorted list of words, along with the words'
+# coordinates in MDS space (keyed by word)
+def compute_colour_palette(words, use_rgb, spectrum, random_seed, anchors):
+  from scipy.spatial import distance
 
   # Create distance matrix giving normalized Levenshtein distances between the words
   string_distances = np.array(basics.stringDistances(words), dtype=float)
   string_distance_matrix = distance.squareform(string_distances, 'tomatrix')
 
-  if type(random_seed) != int:
-    # Pick a random number for the MDS algorithm
-    random_seed = np.random.randint(1, 1000000)
+  # Start from any anchored coordinates, which are replaced by the new ones
+  coordinates = dict(anchors)
 
   hex_colour_values = []
 
   if use_rgb == True:
 
     # Run distance matrix through MDS to determine the position of each word in 3-dimensional space
-    string_mds = MDS(dissimilarity='precomputed', n_components=3, n_init=25, max_iter=2000, random_state=random_seed)
-    string_coordinates = string_mds.fit_transform(string_distance_matrix)
+    string_coordinates = word_coordinates(words, string_distance_matrix, 3, random_seed, coordinates)
 
     # Scale the dimensions of the space over the interval [0, 255] to create an RGB colour space.
     # The spectrum argument determines how much of the colour space will be used, allowing you to
@@ -221,8 +464,7 @@ def generate_colour_palette(strings, use_rgb=False, spectrum=[0.0, 1.0], random_
   else:
 
     # Run distance matrix through MDS to determine the position of each word in 2-dimensional space
-    string_mds = MDS(dissimilarity='precomputed', n_components=2, n_init=25, max_iter=2000, random_state=random_seed)
-    string_coordinates = string_mds.fit_transform(string_distance_matrix)
+    string_coordinates = word_coordinates(words, string_distance_matrix, 2, random_seed, coordinates)
 
     # Convert Cartesian coordinates to polar coordinates
     polar_coordinates = np.array([polarize(point) for point in string_coordinates])
@@ -239,21 +481,54 @@ def generate_colour_palette(strings, use_rgb=False, spectrum=[0.0, 1.0], random_
       hex_colour_light = rgb_to_hex(hsv_to_rgb(h, s, 1.0))
       hex_colour_values.append((hex_colour, hex_colour_light))
 
-  #print('Correspondence: %s' % correspondence_correlation(string_distances, string_coordinates))
-  #print('Stress-1: %s' % stress_1(string_mds.stress_, string_distances))
-
-  # Return the colour palette and the random seed
-  return dict(zip(words, hex_colour_values)), random_seed
-
-
+  # Return the colour palette and the coordinates
+  return dict(zip(words, hex_colour_values)), coordinates
+
+
+# Position words in n_components-dimensional space by MDS of their string
+# distances. The solution starts from classical MDS and is rotated at random by
+# the seed, unless a warm_start dictionary holds coordinates for some of the
+# words (e.g. from the previous generation): then the solution is started from
+# those coordinates and rotated to match them, so that the words keep their
+# colours, and the dictionary is updated with the new coordinates. Without a warm
+# start, the solution doesn't depend on the seed until it is rotated, so it is
+# cached by the words and shared by every seed.
+def word_coordinates(words, string_distance_matrix, n_components, random_seed, warm_start=None):
+  from scipy.spatial import distance
+  if warm_start != None:
+    shared = [i for i, word in enumerate(words) if word in warm_start and len(warm_start[word]) == n_components]
+  else:
+    shared = []
+  if len(shared) > 0:
+    target = np.array([warm_start[words[i]] for i in shared])
+    init = smacof.align(smacof.classical(string_distance_matrix, n_components), shared, target)
+    init[shared] = target
+    coordinates, raw_stress, iterations = smacof.fit(string_distance_matrix, n_components, init)
+    coordinates = smacof.align(coordinates, shared, target)
+  else:
+    key = ('word_solution', tuple(words), n_components)
+    if key not in cache:
+      coordinates, raw_stress, iterations = smacof.fit(string_distance_matrix, n_components)
+      cache[key] = coordinates, raw_stress
+    coordinates, raw_stress = cache[key]
+    coordinates = smacof.random_rotation(coordinates, random_seed)
+  if report_diagnostics == True:
+    report(distance.squareform(string_distance_matrix, 'tovector'), coordinates, raw_stress)
+  if warm_start != None:
+    # Copy the rows, since the caller may rescale the coordinates in place
+    warm_start.update(zip(words, coordinates.copy()))
+  return coordinates
+
+
+# Draw the triangles labelled by each word in a grid of boxes, returning the
+# svg_polygons.Canvas
 def draw_triangles(triangles, colour_palette, show_prototypes, grid_size):
 
   # Alphabetize words so they can be plotted alphabetically
   words = sorted(triangles.keys())
 
-  # Set up a Canvas object and clear it (WHY THE HELL DOES IT NEED TO BE CLEARED!!!)
+  # Set up a Canvas object
   canvas = svg_polygons.Canvas(figure_width*72, (figure_width/1.375)*72)
-  canvas.clear()
 
   # Determine the size of each triangle cell, giving 5 points of cell spacing
   point_size = (171.2 / grid_size) - 5.0
@@ -298,41 +573,31 @@ def draw_triangles(triangles, colour_palette, show_prototypes, grid_size):
       x_position = 0
       y_position += 1
 
-  # Turn the canvas objects into SVG code
-  canvas.write_everything()
-
-  # Return the SVG code for the canvas
-  return canvas.canvas
+  return canvas
 
 
 def make_prototype(triangles, spot_based=True):
-  trans_triangles = []
-  for t in triangles:
 
-    # Centralize the triangle in the plane
-    t += np.array([250.0, 250.0]) - geometry.centroid(t)
+  # Stack the triangles into an (N, 3, 2) array and centralize them in the plane
+  triangles = geometry.triangle_stack(triangles)
+  triangles = triangles + (np.array([250.0, 250.0]) - geometry.centroids(triangles))[:, np.newaxis, :]
 
-    # If non-spot-based pototype is requested, swap the vertices around so that vertex 1 is
-    # the pointiest one.
-    if spot_based == False:
-      angles = [geometry.angle(t,1), geometry.angle(t,2), geometry.angle(t,3)]
-      min_angle = angles.index(min(angles))
-      if min_angle == 0: t = np.array([t[0], t[1], t[2]])
-      elif min_angle == 1: t = np.array([t[1], t[2], t[0]])
-      elif min_angle == 2: t = np.array([t[2], t[0], t[1]])
+  # If non-spot-based pototype is requested, swap the vertices around so that vertex 1 is
+  # the pointiest one.
+  if spot_based == False:
+    min_angles = geometry.angles(triangles).argmin(axis=1)
+    vertex_orders = (min_angles[:, np.newaxis] + np.arange(3)) % 3
+    triangles = triangles[np.arange(triangles.shape[0])[:, np.newaxis], vertex_orders]
 
-    # Rotate the triangle around its centroid so that vertex 1 points North
-    t = geometry.rotate(t)
+  # Rotate the triangles around their centroids so that vertex 1 points North
+  triangles = geometry.rotate_all(triangles)
 
-    # Ensure that vertex 2 is to the left of vertex 3 to prevent cancelling out
-    if t[1,0] > t[2,0]:
-      t = np.array([t[0], t[2], t[1]])
+  # Ensure that vertex 2 is to the left of vertex 3 to prevent cancelling out
+  flipped = triangles[:, 1, 0] > triangles[:, 2, 0]
+  triangles[flipped] = triangles[flipped][:, [0, 2, 1]]
 
-    trans_triangles.append(t)
-
-  # Reformat as Numpy array and take the mean of the coordinates to form the prototype
-  trans_triangles = np.asarray(trans_triangles, dtype=float)
-  prototype = trans_triangles.mean(axis=0)
+  # Take the mean of the coordinates to form the prototype
+  prototype = triangles.mean(axis=0)
 
   # Shift the prototype such that its bounding box is vertically centralized in the plane
   prototype[:, 1] += ((500.0 - (max([prototype[1,1], prototype[2,1]]) - prototype[0,1])) / 2.0) - prototype[0,1]
@@ -354,15 +619,22 @@ def rearrange(words, grid_size):
   return words_rearranged
 
 
-# Opens an SVG file and splices in some extra SVG code at the end
-def splice_in_triangles(filename, triangle_code):
-  f = open(filename, 'r')
-  graph_code = f.read()
-  f.close()
-  final_code = graph_code.replace('</svg>', triangle_code + '\n\n</svg>')
-  f = open(filename, 'w')
-  f.write(final_code)
-  f.close()
+# Combine the SVG code of several figures of the same size into one animated SVG
+# that shows each figure in turn for frame_duration seconds, using SMIL
+# animation. The IDs in each figure are prefixed with its frame number, so that
+# they stay unique. Viewers without SMIL support show the first figure.
+def animate_svg(frames, frame_duration=1.0):
+  n = len(frames)
+  header = frames[0][:frames[0].index('>', frames[0].index('<svg')) + 1]
+  key_times = ';'.join(['%.6f' % (i / float(n)) for i in range(0, n)])
+  groups = []
+  for i, frame in enumerate(frames):
+    body = frame[frame.index('>', frame.index('<svg')) + 1:frame.rindex('</svg>')]
+    body = svg_id_pattern.sub(r'\1f%s_' % i, body)
+    values = ';'.join(['visible' if j == i else 'hidden' for j in range(0, n)])
+    visibility = 'visible' if i == 0 else 'hidden'
+    groups.append('<g visibility="%s">\n<animate attributeName="visibility" values="%s" keyTimes="%s" dur="%ss" calcMode="discrete" repeatCount="indefinite"/>%s</g>' % (visibility, values, key_times, n * frame_duration, body))
+  return header + '\n' + '\n'.join(groups) + '\n</svg>\n'
 
 
 # Convert RGB value to hexadecimal triplet
@@ -426,33 +698,132 @@ def polarize(xy):
 # Calculate the correspondence correlation - how well do the distances in
 # MDS space correlate with the original distances
 def correspondence_correlation(distances, mds_coordinates):
-  n = len(mds_coordinates)
-  mds_distances = [ED(mds_coordinates[i], mds_coordinates[j]) for i in range(n) for j in range(i+1, n)]
-  return np.corrcoef(distances, mds_distances)[0,1]
+  return smacof.correspondence_correlation(distances, np.asarray(mds_coordinates, dtype=float))
 
 
 # Calculate stress-1
 def stress_1(raw_stress, distances):
-  return np.sqrt(raw_stress / sum(distances ** 2))
-
-
-# Get dissimilarity ratings and format as square distance matrix
-triangle_distances = rater_analysis.reliable_distance_array
-triangle_distance_matrix = distance.squareform(triangle_distances, 'tomatrix')
-
-# Run ratings through MDS to get coordinates in 2-dimensional space
-triangle_mds = MDS(dissimilarity="precomputed", n_components=2, n_init=25, max_iter=2000, random_state=10)
-triangle_coordinates = triangle_mds.fit_transform(triangle_distance_matrix)
-
-# Scale each dimension over the interval [-0.9, 0.9] for a tidy plot
-for dim in range(0, triangle_coordinates.shape[1]):
-  minimum = triangle_coordinates[:, dim].min()
-  difference = triangle_coordinates[:, dim].max() - minimum
-  triangle_coordinates[:, dim] = (((triangle_coordinates[:, dim] - minimum) / difference) * 1.8) - 0.9
-
-# Compute the Voronoi polygons for these MDS coordinates
-voronoi_polygons = Voronoi.polygons(triangle_coordinates, [[-1,-1], [-1,1], [1,1], [1,-1]])
-
-# Print MDS goodness-of-fit stats
-#print('Correspondence: %s' % correspondence_correlation(triangle_distances, triangle_coordinates))
-#print('Stress-1: %s' % stress_1(triangle_mds.stress_, triangle_distances))
+  return smacof.stress_1(raw_stress, distances)
+
+
+# Print the goodness-of-fit of an MDS solution
+def report(distances, mds_coordinates, raw_stress):
+  print('Correspondence: %s' % correspondence_correlation(distances, mds_coordinates))
+  print('Stress-1: %s' % stress_1(raw_stress, distances))
+
+
+# The MDS solution for the triangles and its Voronoi tessellation are only
+# computed when they are first asked for, and are then cached for the rest of
+# the session
+cache = {}
+
+
+# MDS coordinates of the 48 triangles, scaled over the interval [-0.9, 0.9]
+def triangle_coordinates():
+  from scipy.spatial import distance
+  if 'triangle_coordinates' not in cache:
+
+    # Get dissimilarity ratings and format as square distance matrix
+    triangle_distances = rater_analysis.reliable_distance_array()
+    triangle_distance_matrix = distance.squareform(triangle_distances, 'tomatrix')
+
+    # Run ratings through MDS to get coordinates in 2-dimensional space
+    coordinates, raw_stress, iterations = smacof.fit(triangle_distance_matrix, 2)
+    if report_diagnostics == True:
+      report(triangle_distances, coordinates, raw_stress)
+
+    # Scale each dimension over the interval [-0.9, 0.9] for a tidy plot
+    for dim in range(0, coordinates.shape[1]):
+      minimum = coordinates[:, dim].min()
+      difference = coordinates[:, dim].max() - minimum
+      coordinates[:, dim] = (((coordinates[:, dim] - minimum) / difference) * 1.8) - 0.9
+
+    cache['triangle_coordinates'] = coordinates
+  return cache['triangle_coordinates']
+
+
+# Voronoi polygons for the MDS coordinates, bounded by the plot area
+def voronoi_polygons():
+  if 'voronoi_polygons' not in cache:
+    cache['voronoi_polygons'], cache['voronoi_neighbours'] = Voronoi.polygons(triangle_coordinates(), [[-1,-1], [-1,1], [1,1], [1,-1]], neighbours=True)
+  return cache['voronoi_polygons']
+
+
+# The neighbours across the edges of each Voronoi polygon (see Voronoi.polygons)
+def voronoi_neighbours():
+  voronoi_polygons()
+  return cache['voronoi_neighbours']
+
+
+# Regions formed by joining the contiguous Voronoi cells of a set of triangles
+# (see Voronoi.join_contiguous_polygons), cached by the set of triangle indices
+# so that a word that labels the same triangles in several generations is only
+# joined once
+def joined_regions(indices):
+  key = ('joined_regions', frozenset(indices))
+  if key not in cache:
+    indices = sorted(set(indices))
+    cache[key] = Voronoi.join_contiguous_polygons(voronoi_polygons()[indices], voronoi_neighbours()[indices], indices)
+  return cache[key]
+
+
+# Pick the random seeds for a number of colour palette candidates, starting with
+# the given seed (if any). If no candidates have been requested, there is one.
+def candidate_seeds(colour_candidates, random_seed=False):
+  if type(colour_candidates) != int or colour_candidates < 1:
+    colour_candidates = 1
+  seeds = []
+  if type(random_seed) == int:
+    seeds.append(random_seed)
+  while len(seeds) < colour_candidates:
+    seed = np.random.randint(1, 1000000)
+    if seed not in seeds:
+      seeds.append(seed)
+  return seeds
+
+
+# Hash of everything a colour palette depends on: the sorted unique words, the
+# colour space, the spectrum, and either the random seed or, if the palette was
+# warm started, the coordinates of the words it was anchored to
+def palette_key(words, use_rgb, spectrum, random_seed, anchors):
+  if len(anchors) > 0:
+    rotation = [[word, [float(x) for x in anchors[word]]] for word in sorted(anchors.keys())]
+  else:
+    rotation = int(random_seed)
+  inputs = [palette_cache_version, list(words), use_rgb == True, [float(x) for x in spectrum], rotation]
+  return hashlib.sha1(json.dumps(inputs)).hexdigest()
+
+
+# Look up a colour palette and its word coordinates in memory, and failing that
+# on disk, or return None if it hasn't been computed before
+def cached_palette(key):
+  if ('colour_palette', key) not in cache and palette_cache_location != None:
+    try:
+      f = open(os.path.join(palette_cache_location, key + '.json'), 'r')
+      entry = json.load(f)
+      f.close()
+    except (IOError, OSError, ValueError):
+      return None
+    colour_palette = dict((word.encode('utf-8'), (str(colour), str(colour_light))) for word, (colour, colour_light) in entry['palette'].items())
+    coordinates = dict((word.encode('utf-8'), np.array(point, dtype=float)) for word, point in entry['coordinates'].items())
+    cache[('colour_palette', key)] = colour_palette, coordinates
+  return cache.get(('colour_palette', key))
+
+
+# Keep a colour palette and its word coordinates in memory and save them to disk
+def store_palette(key, entry):
+  cache[('colour_palette', key)] = entry
+  if palette_cache_location == None:
+    return
+  colour_palette, coordinates = entry
+  filename = os.path.join(palette_cache_location, key + '.json')
+  temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+  try:
+    if os.path.exists(palette_cache_location) == False:
+      os.makedirs(palette_cache_location)
+    f = open(temp_filename, 'w')
+    json.dump({'palette':colour_palette, 'coordinates':dict((word, [float(x) for x in point]) for word, point in coordinates.items())}, f)
+    f.close()
+    os.rename(temp_filename, filename)
+  except (IOError, OSError):
+    pass # If the palette can't be saved, it is simply computed again next time
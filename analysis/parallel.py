@@ -0,0 +1,225 @@
+from copy import deepcopy
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+########################################
+
+# Run a Monte Carlo permutation statistic over a number of permutations. The
+# permutations are split into blocks and each block is handed to the statistic
+# along with a random number generator to draw from. Blocks are independent, so
+# they can be spread over a pool of worker processes.
+
+def run(statistic, perms, n_jobs=1, seed=None, block_size=100):
+  """
+  Runs a permutation statistic over a number of permutations, split into blocks.
+
+  Parameters
+  ----------
+  statistic : callable
+      Called as statistic(size, random_state) and returns an array holding the
+      statistic under each of size random permutations drawn from random_state.
+      If n_jobs is not 1, it must be picklable (e.g. a module-level function, a
+      functools.partial of one, or an instance of a module-level class).
+  perms : int
+      The total number of permutations to run.
+  n_jobs : int, optional
+      Number of worker processes (default: 1). Set to -1 to use every core.
+  seed : int, optional
+      Seed for the permutation blocks (default: None). Block b draws from its
+      own stream, numpy.random.RandomState([seed, b]), so results depend on the
+      seed and block_size but not on n_jobs. If no seed is given and n_jobs is
+      1, the global numpy random number generator is used, as in a plain loop.
+  block_size : int, optional
+      The number of permutations per block (default: 100).
+
+  Returns
+  -------
+  values : ndarray
+      The statistic under each permutation, concatenated block by block
+  """
+
+  sizes = block_sizes(perms, block_size)
+  if len(sizes) == 0:
+    return np.zeros(0, dtype=float)
+  n_jobs = number_of_jobs(n_jobs)
+
+  # Plain serial run on the global random number generator
+  if n_jobs == 1 and seed == None:
+    return np.concatenate([statistic(size, np.random) for size in sizes])
+
+  # Otherwise, give each block its own stream spawned from the seed
+  if seed == None:
+    seed = np.random.randint(0, 2**31 - 1)
+  tasks = [(size, seed, block) for block, size in enumerate(sizes)]
+  if n_jobs == 1:
+    return np.concatenate([compute_block(statistic, task) for task in tasks])
+  return np.concatenate(pool_map(run_block, tasks, n_jobs, initializer=set_worker_statistic, initargs=(statistic,)))
+
+# Sequential version of run(): the blocks are computed in order (n_jobs at a
+# time) and after each one, stop() is given the values so far. Once it returns
+# True, the remaining blocks are skipped. Since the blocks are checked in order,
+# a seeded run stops at the same point whatever the value of n_jobs.
+
+def run_until(statistic, perms, stop, n_jobs=1, seed=None, block_size=100):
+  """
+  Runs a permutation statistic block by block until a stopping rule is met.
+
+  Parameters
+  ----------
+  statistic : callable
+      As for run().
+  perms : int
+      The maximum number of permutations to run.
+  stop : callable
+      Called as stop(values) with the statistic under every permutation run so
+      far, after each block. Returns True to stop.
+  n_jobs, seed, block_size : optional
+      As for run().
+
+  Returns
+  -------
+  values : ndarray
+      The statistic under each permutation that was run, up to and including
+      the block after which stop() returned True
+  """
+
+  sizes = block_sizes(perms, block_size)
+  n_jobs = number_of_jobs(n_jobs)
+  if n_jobs == 1 and seed == None:
+    blocks = (statistic(size, np.random) for size in sizes)
+    pool = None
+  else:
+    if seed == None:
+      seed = np.random.randint(0, 2**31 - 1)
+    tasks = [(size, seed, block) for block, size in enumerate(sizes)]
+    if n_jobs == 1:
+      blocks = (compute_block(statistic, task) for task in tasks)
+      pool = None
+    else:
+      pool = Pool(min(n_jobs, len(tasks)), set_worker_statistic, (statistic,))
+      blocks = (block for start in range(0, len(tasks), n_jobs) for block in pool.map(run_block, tasks[start:start+n_jobs], chunksize=1))
+  values = np.zeros(0, dtype=float)
+  try:
+    for block in blocks:
+      values = np.concatenate((values, block))
+      if stop(values) == True:
+        break
+  finally:
+    if pool != None:
+      pool.close()
+      pool.join()
+  return values
+
+# Stopping rule for run_until() in a permutation test. The test can stop once
+# the empirical p-value of the veridical statistic is decided at level alpha
+# (that is, an exact binomial confidence bound on p, with error probability
+# error, lies wholly on one side of alpha), or once the standard error of the
+# z-score falls below z_error.
+
+class StoppingRule:
+
+  def __init__(self, veridical, tail='upper', alpha=None, error=0.001, z_error=None):
+    if alpha == None and z_error == None:
+      raise ValueError('A stopping rule needs alpha and/or z_error')
+    self.veridical = veridical
+    self.tail = tail
+    self.alpha = alpha
+    self.error = error
+    self.z_error = z_error
+
+  def __call__(self, values):
+    statistics = np.concatenate(([self.veridical], values))
+    if self.alpha != None:
+      lower, upper = p_bounds(exceedances(statistics, self.tail), len(statistics), self.error)
+      if upper < self.alpha or lower > self.alpha:
+        return True
+    if self.z_error != None:
+      if z_standard_error(standard_score(statistics), len(statistics)) < self.z_error:
+        return True
+    return False
+
+# Count the statistics (the first being the veridical one) that are at least as
+# extreme as the veridical statistic
+
+def exceedances(statistics, tail='upper'):
+  if tail == 'upper':
+    return (statistics >= statistics[0]).sum()
+  return (statistics <= statistics[0]).sum()
+
+# Clopper-Pearson bounds on a p-value estimated as k / n, each of which is
+# wrong with probability error
+
+def p_bounds(k, n, error):
+  from scipy.stats import beta
+  lower = beta.ppf(error, k, n - k + 1) if k > 0 else 0.0
+  upper = beta.ppf(1.0 - error, k + 1, n - k) if k < n else 1.0
+  return lower, upper
+
+# Standard score of the veridical statistic (the first) against all of them
+
+def standard_score(statistics):
+  return (statistics[0] - statistics.mean()) / statistics.std()
+
+# Approximate standard error of a z-score estimated from n permutations: the
+# sampling error of the mean contributes 1 / n to its variance and that of the
+# standard deviation z**2 / 2n
+
+def z_standard_error(z, n):
+  return np.sqrt((1.0 + (z ** 2) / 2.0) / n)
+
+# The statistic of the current run. Each worker process is given the statistic
+# once, when it starts, and the tasks only carry the size, seed, and number of
+# each block, so that a statistic holding large arrays isn't sent over again
+# with every block.
+
+worker_statistic = None
+
+def set_worker_statistic(statistic):
+  global worker_statistic
+  worker_statistic = statistic
+
+# Compute one block of permutations on its own random number generator. The
+# statistic is copied for each block, so that no state (such as a shuffled
+# order) carries over from one block to the next.
+
+def compute_block(statistic, task):
+  size, seed, block = task
+  return deepcopy(statistic)(size, block_random_state(seed, block))
+
+# Compute one block in a worker process, with the worker's statistic
+
+def run_block(task):
+  return compute_block(worker_statistic, task)
+
+# Spawn the random number generator for a given block from the master seed
+
+def block_random_state(seed, block):
+  return np.random.RandomState([seed, block])
+
+# Split a number of permutations into block sizes
+
+def block_sizes(perms, block_size):
+  if block_size < 1:
+    raise ValueError('The block_size should be at least 1')
+  return [min(block_size, perms - start) for start in range(0, perms, block_size)]
+
+# Resolve the n_jobs argument to a number of processes
+
+def number_of_jobs(n_jobs):
+  if n_jobs == -1 or n_jobs == None:
+    return cpu_count()
+  if n_jobs < 1:
+    raise ValueError('n_jobs should be a positive integer or -1')
+  return int(n_jobs)
+
+# Map a function over a list of tasks using a pool of worker processes. If an
+# initializer is given, each worker calls it with initargs when it starts.
+
+def pool_map(function, tasks, n_jobs, initializer=None, initargs=()):
+  pool = Pool(min(n_jobs, len(tasks)), initializer, initargs)
+  try:
+    results = pool.map(function, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return results
@@ -1,8 +1,8 @@
 from math import isinf, isnan
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
 import basics
 
+# matplotlib is imported by the methods that use it
+
 # Colour palettes adapted from:
 #   http://wesandersonpalettes.tumblr.com
 #   https://github.com/karthik/wesanderson
@@ -75,6 +75,8 @@ class Plot:
 
   # Make the multipanel plot a reality and save as PDF
   def make(self, save_name=False, save_location=False, legend_in_gap=False, per_column_legend=False):
+    import matplotlib.pyplot as plt
+    from matplotlib import gridspec
     if legend_in_gap == True and self.__number_of_empty_positions() == 0:
       legend_in_gap = False
     self.fig = plt.figure(figsize=(self.width, self.height))
@@ -177,12 +179,13 @@ class Plot:
         print('Plot shape is %ix%i. Use PLOT.reshape() to reshape the plot or specify a different position.' % (self.shape_x, self.shape_y))
         return
       position_x, position_y = position_x-1, position_y-1
-    if self.datasets[position_y][position_x] != None and raw_input('Position %i,%i is in use. Overwrite? (y/n) ' % (position_x+1, position_y+1)) != 'y':
+    if self.datasets[position_y][position_x] != None and basics.confirm_overwrite('Position %i,%i is in use. Overwrite?' % (position_x+1, position_y+1)) == False:
       return
     self.datasets[position_y][position_x] = dataset
 
   # Make a subplot
   def __make_subplot(self, position_x, position_y, subplot_i, one_y_label):
+    import matplotlib.pyplot as plt
     dataset = self.datasets[position_y][position_x]
     matrix = self.__remove_NaN(dataset['data'])
     experiment = dataset['experiment']
@@ -220,6 +223,7 @@ class Plot:
 
   # Leave a position empty
   def __make_empty_subplot(self, position_x, position_y):
+    import matplotlib.pyplot as plt
     self.subplots[position_y][position_x] = self.fig.add_subplot(self.grid[position_y, position_x])
     plt.axis('off')
 
@@ -277,12 +281,14 @@ class Plot:
 
   # Add dotted line "confidence intervals" at -1.96 and 1.96"
   def __add_confidence_intervals(self, min_y, n):
+    import matplotlib.pyplot as plt
     plt.plot(range(-1,n+2), [1.959964] * (n+3), color='gray', linestyle=':', linewidth=0.5)
     if min_y < -2:
       plt.plot(range(-1,n+2), [-1.959964] * (n+3), color='gray', linestyle=':', linewidth=0.5)
 
   # Add dotted line for indicating chance level
   def __add_chance_level(self, level, n):
+    import matplotlib.pyplot as plt
     plt.plot(range(-1,n+2), [level] * (n+3), color='gray', linestyle=':', linewidth=0.5)
 
   # Add on one legend for entire plot or one legend per column
@@ -295,6 +301,7 @@ class Plot:
       self.__add_normal_legend()
 
   def __add_normal_legend(self):
+    import matplotlib.pyplot as plt
     legend = self.fig.add_subplot(self.grid[self.shape_y, :])
     plt.axis('off')
     handles, labels = self.subplots[0][0].get_legend_handles_labels()
@@ -306,6 +313,7 @@ class Plot:
     self.subplots[y][x].legend(handles, labels, loc='center', bbox_to_anchor=(0.5, 0.5), frameon=False, prop={'size':self.legend_font_size}, ncol=1, numpoints=1)
 
   def __add_per_column_legend(self):
+    import matplotlib.pyplot as plt
     for x in range(self.shape_x):
       legend = self.fig.add_subplot(self.grid[self.shape_y, x])
       plt.axis('off')
@@ -316,6 +324,7 @@ class Plot:
 
   # Add aubplot labels: (A), (B), (C), etc...
   def __add_subplot_label(self, subplot_i, min_y, max_y, position):
+    import matplotlib.pyplot as plt
     try:
       label = '(' + ('ABCDEFGHIJKLMNOPQRSTUVWXYZ'[subplot_i]) + ')'
     except IndexError:
@@ -359,7 +368,7 @@ class Plot:
     if cells_in_use > 0:
       plural = ''
       if cells_in_use > 1: plural = 's'
-      if raw_input('This will erase %i plot%s. Continue? (y/n) ' % (cells_in_use, plural)) != 'y':
+      if basics.confirm_overwrite('This will erase %i plot%s. Continue?' % (cells_in_use, plural)) == False:
         return False
     for row in self.datasets:
       for i in range(n):
@@ -385,7 +394,7 @@ class Plot:
     if cells_in_use > 0:
       plural = ''
       if cells_in_use > 1: plural = 's'
-      if raw_input('This will erase %i plot%s. Continue? (y/n) ' % (cells_in_use, plural)) != 'y':
+      if basics.confirm_overwrite('This will erase %i plot%s. Continue?' % (cells_in_use, plural)) == False:
         return False
     for i in range(n):
       del self.datasets[-1]
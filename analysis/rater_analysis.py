@@ -1,69 +1,143 @@
-import matplotlib.pyplot as plt
-from numpy import corrcoef, mean, zeros
-from copy import deepcopy
-from scipy import spatial
+import numpy as np
+import datastore
 import Krippendorff
 
+# SciPy and matplotlib are imported by the functions that use them, which keeps
+# importing this module cheap
+
+# Number of triangles rated in task 1, and the number of pairs of them
+n_triangles = 48
+n_pairs = n_triangles * (n_triangles - 1) // 2
+
+# Kinds of rating, in the order in which a rater's rows are kept
+kinds = ['actual', 'test', 'practice']
+
 ########################################################################################
 
+# The task 1 ratings of a set of raters, parsed once and held as arrays. Each
+# rater's rows ([i, j, rating, timestamp], skipping undefined ratings) are kept
+# in one integer array, grouped by rater and kind, so that a rater's rows of
+# each kind are a slice. The actual ratings are also held as a masked (raters x
+# pairs) matrix, in the order of a condensed distance matrix, and each row is
+# normalized over the interval [0,1] at once. Raters who give the same rating
+# to every pair cannot be normalized, and their rows are masked.
+
+class RatingTable:
+
+  def __init__(self, IDs):
+    self.IDs = list(IDs)
+    self.index = dict((ID, r) for r, ID in enumerate(self.IDs))
+    self.orientations, self.ip_addresses, self.completion_codes = [], [], []
+    timestamps, end_timestamps = [], []
+    cells, raters, positions = [], [], []
+    for r, ID in enumerate(self.IDs):
+      matrix = read_rows(ID)
+      self.orientations.append(matrix[0][1])
+      self.ip_addresses.append(matrix[0][2])
+      self.completion_codes.append(matrix[-1][0])
+      timestamps.append([int(matrix[i][3]) for i in range(0, 151)])
+      end_timestamps.append(int(matrix[-2][3]))
+      for position, row in enumerate(matrix[1:-1]):
+        if row[2] == 'undefined':
+          continue # If rating is undefined, skip the row
+        cells.append(' '.join(row[:4]))
+        raters.append(r)
+        positions.append(position)
+    timestamps = np.array(timestamps, dtype=np.int64)
+    self.start_timestamps = timestamps[:, 0]
+    self.end_timestamps = np.array(end_timestamps, dtype=np.int64)
+    self.times_taken = (self.end_timestamps - self.start_timestamps) / 60.0
+    self.timecourses = (timestamps - self.start_timestamps[:, np.newaxis]) / 60.0
+
+    # Parse the cells in one go, and group the rows by rater and kind, keeping the
+    # order of the file. Rows rating a triangle against itself are test ratings,
+    # and the other rows among the first six are practice ratings.
+    rows = np.fromstring(' '.join(cells), dtype=int, sep=' ').reshape(-1, 4)
+    raters = np.array(raters, dtype=int)
+    kind_numbers = np.where(rows[:, 0] == rows[:, 1], 1, np.where(np.array(positions) < 6, 2, 0))
+    order = np.lexsort((kind_numbers, raters))
+    self.rows = rows[order]
+    groups = raters[order] * len(kinds) + kind_numbers[order]
+    self.offsets = np.searchsorted(groups, np.arange(len(self.IDs) * len(kinds) + 1))
+
+    # Matrix of the actual ratings
+    actual = np.flatnonzero(kind_numbers[order] == 0)
+    actual_raters = raters[order][actual]
+    actual_pairs = pair_indices(self.rows[actual, 0], self.rows[actual, 1])
+    ratings = np.zeros((len(self.IDs), n_pairs), dtype=np.float32)
+    rated = np.zeros((len(self.IDs), n_pairs), dtype=bool)
+    ratings[actual_raters, actual_pairs] = self.rows[actual, 2]
+    rated[actual_raters, actual_pairs] = True
+    self.ratings = np.ma.array(ratings, mask=~rated)
+
+    # Normalize each rater's actual ratings
+    minima = self.ratings.min(axis=1).astype(float).filled(0.0)
+    differences = (self.ratings.max(axis=1) - self.ratings.min(axis=1)).astype(float).filled(0.0)
+    self.normalizable = differences > 0.0
+    differences[~self.normalizable] = 1.0
+    self.normalized = (self.ratings.astype(float) - minima[:, np.newaxis]) / differences[:, np.newaxis]
+    self.normalized[~self.normalizable] = np.ma.masked
+    self.normalized_rows = self.rows.astype(float)
+    self.normalized_rows[actual, 2] = self.normalized[actual_raters, actual_pairs].data
+
+    # Mean of each rater's test ratings
+    test = np.flatnonzero(kind_numbers[order] == 1)
+    test_raters = raters[order][test]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      self.mean_test_ratings = np.bincount(test_raters, self.rows[test, 2], len(self.IDs)) / np.bincount(test_raters, None, len(self.IDs))
+
+  def __len__(self):
+    return len(self.IDs)
+
+  # A rater's rows of a given kind
+  def kind_rows(self, r, kind, normalized=False):
+    group = r * len(kinds) + kinds.index(kind)
+    if normalized == True:
+      return self.normalized_rows[self.offsets[group]:self.offsets[group+1]]
+    return self.rows[self.offsets[group]:self.offsets[group+1]]
+
+# Read in a ratings file
+def read_rows(ID):
+  try:
+    return datastore.get().rater_rows('task_1', ID)
+  except IOError:
+    raise ValueError(ID + ' is not a valid rater')
+
+# Positions of the pairs of triangles (i, j) in a condensed distance matrix
+def pair_indices(i, j):
+  i, j = np.minimum(i, j), np.maximum(i, j)
+  return i * n_triangles - (i * (i + 1)) // 2 + (j - i - 1)
+
+########################################################################################
+
+# A view of one rater in a RatingTable. The rows of ratings are slices of the
+# table's arrays, and pair_ratings and normalized_pairs are the rater's rows of
+# its matrices. If no table is given, a table is made for this rater alone.
+
 class Rater:
 
-  def __init__(self, ID):
+  def __init__(self, ID, table=None):
+    if table == None:
+      table = RatingTable([ID])
     self.ID = ID
-    self.matrix = self.ReadFile()
-    self.orientation = self.matrix[0][1]
-    self.ip_address = self.matrix[0][2]
-    self.start_timestamp = int(self.matrix[0][3])
-    self.end_timestamp = int(self.matrix[-2][3])
-    self.time_taken = (self.end_timestamp - self.start_timestamp) / 60.0
-    self.timecourse = [(int(self.matrix[i][3]) - self.start_timestamp) / 60.0 for i in range(0, 151)]
-    self.completion_code = self.matrix[-1][0]
-    del self.matrix[0]
-    del self.matrix[-1]
-    self.ratings, self.test_ratings, self.practice_ratings = self.SeparateMatrix()
-    self.normalized_ratings = self.MakeNormalizedMatrix()
-
-  # Read in a ratings file
-  def ReadFile(self):
-    try:
-      f = open('../data/task_1/' + self.ID)
-    except IOError:
-      raise ValueError(self.ID + ' is not a valid rater')
-    content = f.read()
-    f.close()
-    return [line.split('\t') for line in content.split('\n')]
-
-  # Separate out the raw data into three matrices: actual ratings, practice ratings, and test ratings
-  def SeparateMatrix(self):
-    ratings = []
-    test_ratings = []
-    practice_ratings = []
-    for i in range(0, len(self.matrix)):
-      if self.matrix[i][2] == 'undefined':
-        continue # If rating is undefined, skip the row
-      int_row = [int(self.matrix[i][0]), int(self.matrix[i][1]), int(self.matrix[i][2]), int(self.matrix[i][3])]
-      if int_row[0] == int_row[1]:
-        test_ratings.append(int_row)
-      elif i < 6:
-        practice_ratings.append(int_row)
-      else:
-        ratings.append(int_row)
-    return ratings, test_ratings, practice_ratings
-
-  # Normalize actual ratings over the interval [0,1]
-  def MakeNormalizedMatrix(self):
-    normalized_ratings = deepcopy(self.ratings)
-    ratings = self.GetRatings('actual')
-    try:
-      minimum = min(ratings)
-    except ValueError:
-      print(self.ID, ratings)
-    difference = float(max(ratings) - minimum)
-    if difference == 0.0:
-      return False
-    for row in normalized_ratings:
-      row[2] = (row[2] - minimum) / difference
-    return normalized_ratings
+    self.table = table
+    r = self.row = table.index[ID]
+    self.orientation = table.orientations[r]
+    self.ip_address = table.ip_addresses[r]
+    self.start_timestamp = int(table.start_timestamps[r])
+    self.end_timestamp = int(table.end_timestamps[r])
+    self.time_taken = table.times_taken[r]
+    self.timecourse = table.timecourses[r]
+    self.completion_code = table.completion_codes[r]
+    self.ratings = table.kind_rows(r, 'actual')
+    self.test_ratings = table.kind_rows(r, 'test')
+    self.practice_ratings = table.kind_rows(r, 'practice')
+    self.pair_ratings = table.ratings[r]
+    self.normalized_pairs = table.normalized[r]
+    if table.normalizable[r] == True:
+      self.normalized_ratings = table.kind_rows(r, 'actual', normalized=True)
+    else:
+      self.normalized_ratings = False # The rater gave the same rating to every pair
 
   # Extract ratings of a given kind
   def GetRatings(self, kind):
@@ -73,16 +147,13 @@ class Rater:
     elif kind == 'normalized': target_matrix = self.normalized_ratings
     else:
       return False
-    ratings = []
-    for row in target_matrix:
-      try:
-        ratings.append(row[2])
-      except ValueError:
-        continue
-    return ratings
+    if type(target_matrix) == bool:
+      return False
+    return target_matrix[:, 2]
 
   # Produce a histogram of the actual ratings (raw or normalized)
   def Hist(self, normalize=False, savefig=False):
+    import matplotlib.pyplot as plt
     if normalize == True:
       ratings = self.GetRatings('normalized')
       plt.hist(ratings, bins=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
@@ -103,66 +174,54 @@ class Rater:
 
   # Measure rater agreement by correlating this rater's ratings with the mean ratings of all raters
   def RaterAgreement(self, distances=False):
-    x = []
-    y = []
     if type(distances) == bool and distances == False:
-      distances = all_distance_array
-    distance_matrix = spatial.distance.squareform(distances, 'tomatrix')
-    for row in self.normalized_ratings:
-      x.append(distance_matrix[row[0], row[1]])
-      y.append(row[2])
-    return corrcoef(x, y)[0,1]
+      distances = all_distance_array()
+    return agreements(self.normalized_pairs[np.newaxis], distances)[0]
 
   def MeanTestRating(self):
-    return mean(self.GetRatings('test'))
+    return self.table.mean_test_ratings[self.row]
 
 ########################################################################################
 
-# Average together the normalized ratings of many raters
+# Correlate each row of a masked matrix of normalized ratings with a condensed
+# distance array, over the pairs that the row has ratings for
+def agreements(normalized, distances):
+  present = ~np.ma.getmaskarray(normalized)
+  counts = present.sum(axis=1)
+  x = np.where(present, np.asarray(distances, dtype=float)[np.newaxis], 0.0)
+  y = normalized.filled(0.0)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    x = np.where(present, x - (x.sum(axis=1) / counts)[:, np.newaxis], 0.0)
+    y = np.where(present, y - (y.sum(axis=1) / counts)[:, np.newaxis], 0.0)
+    return (x * y).sum(axis=1) / np.sqrt((x * x).sum(axis=1) * (y * y).sum(axis=1))
+
+# Average together the normalized ratings of many raters. The raters' rows are
+# stacked into one matrix, and the filters and the average are computed over
+# all raters at once.
 def AverageDistanceMatrix(raters, agreement_filter=None, test_filter=None, distances=None, krippendorff=False):
-  count_matrix = zeros([48, 48], dtype=int)
-  sum_distance_matrix = zeros([48, 48], dtype=float)
+  normalized = np.ma.vstack([rater.normalized_pairs for rater in raters])
+  # Skip raters whose ratings cannot be normalized. This can occur if the rater
+  # gives the same rating for every pair of triangles.
+  included = np.array([type(rater.normalized_ratings) != bool for rater in raters], dtype=bool)
+  if agreement_filter != None:
+    if distances is None:
+      distances = all_distance_array()
+    # If agreement filter is being applied, skip the raters who are not good enough
+    included &= ~(agreements(normalized, distances) < agreement_filter)
+  if test_filter != None:
+    # If test filter is being applied, skip the raters who are not good enough
+    included &= ~(np.array([rater.MeanTestRating() for rater in raters], dtype=float) > test_filter)
+  normalized = normalized[included]
+  present = ~np.ma.getmaskarray(normalized)
+  count_array = present.sum(axis=0)
+  mean_distance_array = normalized.filled(0.0).sum(axis=0) / count_array
   ka_data = []
-  rater_n = 0
-  for rater in raters:
-    normalized_matrix = rater.normalized_ratings
-    if normalized_matrix == False:
-      #print('Excluding rater %s because the ratings cannot be normalized' % rater.ID)
-      continue # If the normalized matrix doesn't exist, skip the rater. This can occur if
-               # the rater gives the same rating for every pair of triangles.
-    if agreement_filter != None:
-      rater_agreement = rater.RaterAgreement(distances)
-      if rater_agreement < agreement_filter:
-        #print('Excluding rater %s due to low rater agreement: %f' % (rater.ID, rater_agreement))
-        continue # If agreement filter is being applied and the rater is not good enough, skip the rater
-    if test_filter != None:
-      mean_test_rating = rater.MeanTestRating()
-      if mean_test_rating > test_filter:
-        #print('Excluding rater %s due to a high average test rating: %f' % (rater.ID, mean_test_rating))
-        continue # If test filter is being applied and the rater is not good enough, skip the rater
-    rater_n += 1
-    if krippendorff == True:
-      ka_matrix = [[None]*48 for i in range(48)]
-    for row in normalized_matrix:
-      sum_distance_matrix[row[0], row[1]] += float(row[2])
-      sum_distance_matrix[row[1], row[0]] += float(row[2])
-      count_matrix[row[0], row[1]] += 1
-      count_matrix[row[1], row[0]] += 1
-      if krippendorff == True:
-        ka_matrix[row[0]][row[1]] = float(row[2])
-        ka_matrix[row[1]][row[0]] = float(row[2])
-    if krippendorff == True:
-      ka_array = []
-      for i in range(0, 47):
-        for j in range(i+1, 48):
-          ka_array.append(ka_matrix[i][j])
-      ka_data.append(ka_array)
-  sum_distance_array = spatial.distance.squareform(sum_distance_matrix, 'tovector')
-  count_array = spatial.distance.squareform(count_matrix, 'tovector')
-  mean_distance_array = sum_distance_array / count_array
-  return mean_distance_array, count_array, rater_n, ka_data
+  if krippendorff == True:
+    ka_data = np.where(present, normalized.data, None).tolist()
+  return mean_distance_array, count_array, int(included.sum()), ka_data
 
 def most_and_least_similar_pairs(ratings_array):
+  from scipy import spatial
   matrix = spatial.distance.squareform(ratings_array, 'tomatrix')
   similar_score = 1
   dissimilar_score = 0
@@ -182,18 +241,57 @@ def most_and_least_similar_pairs(ratings_array):
 
 rater_ids = ['1iuoiX', '8lBsLg', 'iomj8H', 'Uv1Cz5', '6pONEP', 'G4jATI', 'FEjjhj', 'WcOyEo', 'Olsg9E', 'ntzryw', 'KU4BU1', 'QNXer0', 'sgu4Zk', 'RhDU4c', 'mqrNYh', 'xS8ZdN', 'y2UU38', 'CFbWtL', 'anrjOY', 'J4i8dm', 'Wfw8of', 'AqTLsh', 'W2JL0h', 'CYSrZk', '277fiX', 'k2AuXE', 'E4SJqH', 'Hl5kUl', 'I2Gbyg', 'wbaSjO', 'a2abMj', 'MTbOAZ', 'aY17za', 'krvm0W', 'eetbYU', 'RMDCcy', 'qEBAaS', 'aBXXiT', 'JLN0dy', '6o8syk', 'aEOaWJ', 'IB4wVt', 'ufeoHf', 'HutG2f', 'vPKCt3', 'rCHzzR', 'K3rvMd', 'qUZtEJ', 'nJmFj7', 'YgyWJ1', 'huX4Jz', 'chua85', 'jvBO9o', 'zUINg8', '0TiUmt', '2yr15o', '0bPp49', 'mbgoLT', 'lKQ2km', 'YM1TCH', 'EBXkBU', 'oXMKVA', 'N0LMRQ', 'MrX3AS', 'kdNtdY', 'pd55KD', 'ArvwOB', '7ysBYc', 'OiBlzF', 'eLBxSN', 'DlS5ut', 'oyh9eG', 'tzcUm5', 'KidSYY', 'ezOZvk', 'w6VA0U', '40THLn', 'kBy8V2', 'tAVMfZ', 'Bfsv32', 'Tx8WDh', 'efcw0Y', 'm3YPGN', 'gmey91', 'CGaUDW', 'JwYg7R', '4tkpPZ', 'jKdogx', 'onef7t', 'MuSqoP', 'o5GLbD', 'wNvkTK', 'wiNvtD', 'GsLucf', 'TcgHzi', 'Be4LKs']
 
-# Initialize a Rater object for each rater
-raters = [Rater(ID) for ID in rater_ids]
+# The rating table, the Rater objects, and the two passes of averaging are only
+# computed when they are first asked for, and are then cached for the rest of
+# the session
+cache = {}
+
+# Parse every rater's ratings into one RatingTable
+def rating_table():
+  if 'table' not in cache:
+    cache['table'] = RatingTable(rater_ids)
+  return cache['table']
+
+# Initialize a Rater object (a view of the table) for each rater
+def get_raters():
+  if 'raters' not in cache:
+    cache['raters'] = [Rater(ID, rating_table()) for ID in rater_ids]
+  return cache['raters']
 
 # First Pass
 # Average everyone's ratings together to form a (condensed) distance matrix, but
-# ignore raters whose mean reliability rating is > 100
-all_distance_array, all_count_array, all_rater_n, ka_data = AverageDistanceMatrix(raters, None, 100, None, True)
+# ignore raters whose mean reliability rating is > 100. Returns the mean distance
+# array, count array, number of raters, and Krippendorff data.
+def first_pass():
+  if 'first_pass' not in cache:
+    cache['first_pass'] = AverageDistanceMatrix(get_raters(), None, 100, None, True)
+  return cache['first_pass']
 
 # Second Pass
 # Average everyone's ratings together again, this time filtering out raters whose
 # agreement with the average ratings of all raters in the first pass is < 0.4.
-reliable_distance_array, reliable_count_array, reliable_rater_n, ka_data = AverageDistanceMatrix(raters, 0.4, 100, all_distance_array, True)
+def second_pass():
+  if 'second_pass' not in cache:
+    cache['second_pass'] = AverageDistanceMatrix(get_raters(), 0.4, 100, all_distance_array(), True)
+  return cache['second_pass']
+
+# Mean distances between the 48 triangles, as rated by all raters
+def all_distance_array():
+  return first_pass()[0]
+
+# Mean distances between the 48 triangles, as rated by the reliable raters
+def reliable_distance_array():
+  return second_pass()[0]
+
+# The reliable raters' ratings in the format used by Krippendorff.alpha()
+def ka_data():
+  return second_pass()[3]
+
+# Krippendorff's alpha for the reliable raters' ratings (interval metric)
+def reliability():
+  return Krippendorff.fast_alpha(ka_data())
 
-# Calculate Krippendorff's alpha - this is very slow
-#print(Krippendorff.alpha(ka_data))
+# Bootstrap Krippendorff's alpha for the reliable raters' ratings. Returns alpha,
+# the bootstrap distribution, and the percentile confidence interval.
+def reliability_bootstrap(n_boot=10000, n_jobs=1, seed=None, resample='units', level=0.95):
+  return Krippendorff.alpha_bootstrap(ka_data(), n_boot, n_jobs, seed, resample, level=level)
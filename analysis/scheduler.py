@@ -0,0 +1,68 @@
+from multiprocessing import Pool
+import numpy as np
+import sys
+import basics
+import parallel
+
+########################################
+
+# Compute the results for every chain and generation of one or more
+# experiments. Each job is an (function, experiment, generations) triple, where
+# function(chain, generation) returns the result for one generation (typically a
+# functools.partial of a module's generation_results() with the other arguments
+# bound). The jobs are flattened into one list of experiment x chain x
+# generation tasks, which are run in a pool of n_jobs processes, and the results
+# are returned as one [chain][generation] matrix per job.
+
+def run(jobs, n_jobs=1, verbose=True):
+  n_jobs = parallel.number_of_jobs(n_jobs)
+  results = []
+  tasks = []
+  for job_i, (function, experiment, generations) in enumerate(jobs):
+    chains = basics.chain_codes[experiment-1]
+    results.append([[None] * len(generations) for chain in chains])
+    for chain_i, chain in enumerate(chains):
+      for generation_i, generation in enumerate(generations):
+        tasks.append((function, job_i, chain_i, generation_i, chain, generation))
+  if n_jobs == 1 or len(tasks) < 2:
+    completed = (run_task(task + (None,)) for task in tasks)
+    pool = None
+  else:
+    # Worker processes inherit copies of the same global random state, so give
+    # each task its own seed, drawn here so that runs remain reproducible
+    # whichever worker picks up a task
+    seeds = np.random.randint(0, 2**31 - 1, len(tasks))
+    tasks = [task + (seed,) for task, seed in zip(tasks, seeds)]
+    pool = Pool(min(n_jobs, len(tasks)))
+    completed = pool.imap_unordered(run_task, tasks)
+  try:
+    for task_n, (job_i, chain_i, generation_i, result) in enumerate(completed):
+      results[job_i][chain_i][generation_i] = result
+      if verbose == True:
+        report_progress(task_n + 1, len(tasks))
+  finally:
+    if pool != None:
+      pool.close()
+      pool.join()
+  return results
+
+# Compute the results for every chain and generation of a single experiment
+
+def experiment_results(function, experiment, generations, n_jobs=1, verbose=True):
+  return run([(function, experiment, generations)], n_jobs, verbose)[0]
+
+# Run a single task and return its result, along with where it belongs
+
+def run_task(task):
+  function, job_i, chain_i, generation_i, chain, generation, seed = task
+  if seed != None:
+    np.random.seed(seed)
+  return job_i, chain_i, generation_i, function(chain, generation)
+
+# Overwrite the progress line with the number of tasks completed so far
+
+def report_progress(completed, total):
+  sys.stdout.write('\rCompleted %i of %i generations' % (completed, total))
+  if completed == total:
+    sys.stdout.write('\n')
+  sys.stdout.flush()
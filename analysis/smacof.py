@@ -0,0 +1,103 @@
+import numpy as np
+
+# Metric multidimensional scaling by SMACOF (de Leeuw, 1977). Rather than
+# running from many random configurations and keeping the best, SMACOF is run
+# once from the classical (Torgerson) solution, or from a given configuration,
+# and stops when the stress stops decreasing.
+
+########################################
+
+# Find coordinates in n_components dimensions for a square distance matrix,
+# starting from the classical solution or from the coordinates given as init.
+# Returns the coordinates, the raw stress (the sum of squared differences
+# between the distances and the distances between the coordinates, over all
+# pairs), and the number of iterations run.
+
+def fit(distances, n_components=2, init=False, max_iter=2000, eps=1e-9):
+  distances = np.asarray(distances, dtype=float)
+  if type(init) == bool and init == False:
+    coordinates = classical(distances, n_components)
+  else:
+    coordinates = np.array(init, dtype=float)
+  n = distances.shape[0]
+  previous_stress = None
+  for iteration in range(1, max_iter + 1):
+    coordinate_distances = pairwise_distances(coordinates)
+    stress = ((distances - coordinate_distances) ** 2).sum() / 2.0
+    # Stop when the relative decrease in stress falls below eps
+    if previous_stress != None and previous_stress - stress <= eps * previous_stress:
+      break
+    previous_stress = stress
+    coordinates = guttman_transform(distances, coordinates, coordinate_distances, n)
+  return coordinates, stress, iteration
+
+# Classical (Torgerson) MDS: the coordinates are the leading eigenvectors of the
+# double-centered matrix of squared distances, scaled by the square roots of
+# their eigenvalues
+
+def classical(distances, n_components=2):
+  distances = np.asarray(distances, dtype=float)
+  n = distances.shape[0]
+  centering = np.eye(n) - (1.0 / n)
+  B = -0.5 * np.dot(np.dot(centering, distances ** 2), centering)
+  eigenvalues, eigenvectors = np.linalg.eigh(B)
+  leading = np.argsort(eigenvalues)[::-1][:n_components]
+  coordinates = eigenvectors[:, leading] * np.sqrt(np.maximum(eigenvalues[leading], 0.0))
+  # Pad with zeros if there are fewer objects than dimensions
+  if coordinates.shape[1] < n_components:
+    coordinates = np.column_stack((coordinates, np.zeros((n, n_components - coordinates.shape[1]))))
+  return coordinates
+
+# One SMACOF update (the Guttman transform) for unit weights
+
+def guttman_transform(distances, coordinates, coordinate_distances, n):
+  ratios = np.zeros(distances.shape, dtype=float)
+  nonzero = coordinate_distances > 0.0
+  ratios[nonzero] = distances[nonzero] / coordinate_distances[nonzero]
+  B = -ratios
+  B[np.diag_indices(n)] = ratios.sum(axis=1)
+  return np.dot(B, coordinates) / n
+
+# Euclidean distances between all rows of a coordinate matrix
+
+def pairwise_distances(coordinates):
+  differences = coordinates[:, np.newaxis, :] - coordinates[np.newaxis, :, :]
+  return np.sqrt((differences ** 2).sum(axis=2))
+
+########################################
+
+# An MDS solution is only defined up to rotation and reflection. These pick one.
+
+# Rotate (and possibly reflect) coordinates about the origin at random, using a
+# seed
+
+def random_rotation(coordinates, seed):
+  random_state = np.random.RandomState(seed)
+  n_components = coordinates.shape[1]
+  Q, R = np.linalg.qr(random_state.normal(size=(n_components, n_components)))
+  return np.dot(coordinates, Q * np.sign(np.diag(R)))
+
+# Rotate (and possibly reflect) coordinates about the origin so that the given
+# rows match a set of target coordinates as closely as possible (orthogonal
+# Procrustes)
+
+def align(coordinates, rows, target):
+  U, S, Vt = np.linalg.svd(np.dot(coordinates[rows].T, np.asarray(target, dtype=float)))
+  return np.dot(coordinates, np.dot(U, Vt))
+
+########################################
+
+# Diagnostics
+
+# Stress-1: the square root of the raw stress over the sum of the squared
+# distances (given as a condensed array)
+
+def stress_1(raw_stress, distances):
+  return np.sqrt(raw_stress / (np.asarray(distances, dtype=float) ** 2).sum())
+
+# Correspondence correlation: the correlation between the distances (given as a
+# condensed array) and the distances between the coordinates
+
+def correspondence_correlation(distances, coordinates):
+  rows, cols = np.triu_indices(coordinates.shape[0], 1)
+  return np.corrcoef(distances, pairwise_distances(coordinates)[rows, cols])[0,1]
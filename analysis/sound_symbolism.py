@@ -1,6 +1,9 @@
+from functools import partial
 import numpy as np
 import basics
 import geometry
+import parallel
+import scheduler
 
 ########################################
 
@@ -15,10 +18,9 @@ bigness_phonemes = [['b', 'd', 'g', 'l', 'm', 'w', 'AA', 'OW', 'AO', 'UW'], ['k'
 
 # Functions for generating experiment, chain, or generation results
 
-def experiment_results(experiment, set_type='s', symbolism='shape', permutations=1000):
-  results = []
-  for chain in basics.chain_codes[experiment-1]:
-    results.append(chain_results(experiment, chain, set_type, symbolism, permutations))
+def experiment_results(experiment, set_type='s', symbolism='shape', permutations=1000, n_jobs=1):
+  generation_function = partial(generation_results, experiment, set_type=set_type, symbolism=symbolism, permutations=permutations)
+  results = scheduler.experiment_results(generation_function, experiment, range(0, 11), n_jobs)
   dataset = {'data':results, 'experiment':experiment, 'starting_generation':0,
     'y_range':(-3,7), 'y_label':'Sound symbolism', 'data_type':'sound_symbolism'}
   return dataset
@@ -33,34 +35,57 @@ def generation_results(experiment, chain, generation, set_type, symbolism='shape
   words = basics.getWords(experiment, chain, generation, set_type)
   triangles = basics.getTriangles(experiment, chain, generation, set_type)
   if symbolism == 'shape':
-    return correlate_form_and_symbolism(words, roundedness_phonemes, triangles, geometry.equilateralness, permutations)
+    return correlate_form_and_symbolism(words, roundedness_phonemes, triangles, geometry.equilateralnesses, permutations)
   elif symbolism == 'size':
-    return correlate_form_and_symbolism(words, bigness_phonemes, triangles, geometry.centroid_size, permutations)
+    return correlate_form_and_symbolism(words, bigness_phonemes, triangles, geometry.centroid_sizes, permutations)
   else:
     raise ValueError('Invalid symbolism argument. Should be "shape" or "size".')
 
 ########################################
 
-# Given words and a list of sound symbolic phonemes, and triangles and a triangle
-# metric, correlate the scores. If monte_carlo is False, just return the Pearson
-# correlation coefficient, else use Monte_Carlo() and return a z-score.
+# Given words and a list of sound symbolic phonemes, and triangles and a batched
+# triangle metric (e.g. geometry.equilateralnesses), which scores all the
+# triangles in one call, correlate the scores using Monte_Carlo() and return a
+# z-score.
 
-def correlate_form_and_symbolism(words, symbolic_phonemes, triangles, triangle_metric, permutations=1000):
+def correlate_form_and_symbolism(words, symbolic_phonemes, triangles, triangle_metric, permutations=1000, n_jobs=1, seed=None, alpha=None, error=0.001, z_error=None):
   word_scores = np.asarray([score_word(word, symbolic_phonemes) for word in words], dtype=int)
-  triangle_scores = np.asarray([triangle_metric(triangle) for triangle in triangles], dtype=float)
-  return Monte_Carlo(word_scores, triangle_scores, permutations)
+  triangle_scores = np.asarray(triangle_metric(geometry.triangle_stack(triangles)), dtype=float)
+  return Monte_Carlo(word_scores, triangle_scores, permutations, n_jobs, seed, alpha, error, z_error)
 
 # Given word scores and triangle scores, randomize the mapping between them a large
-# number of times and compute a z-score for the significance of the veridical correlation
+# number of times and compute a z-score for the significance of the veridical correlation.
+# The permutations can be spread over n_jobs processes; see parallel.run(). Setting alpha
+# and/or z_error stops the permutations early (see parallel.StoppingRule), and the number
+# of permutations used is then returned along with the z-score.
 
-def Monte_Carlo(word_scores, triangle_scores, permutations=1000):
+def Monte_Carlo(word_scores, triangle_scores, permutations=1000, n_jobs=1, seed=None, alpha=None, error=0.001, z_error=None):
   correlations = np.zeros(permutations, dtype=float)
   correlations[0] = np.corrcoef(word_scores, triangle_scores)[0,1]
-  for i in range(1, permutations):
-    np.random.shuffle(word_scores)
-    correlations[i] = np.corrcoef(word_scores, triangle_scores)[0,1]
+  sampler = Sampler(word_scores, triangle_scores)
+  if alpha != None or z_error != None:
+    stop = parallel.StoppingRule(correlations[0], 'upper', alpha, error, z_error)
+    correlations = np.concatenate((correlations[:1], parallel.run_until(sampler, permutations-1, stop, n_jobs, seed)))
+    return (correlations[0] - correlations.mean()) / correlations.std(), correlations.shape[0]
+  correlations[1:] = parallel.run(sampler, permutations-1, n_jobs, seed)
   return (correlations[0] - correlations.mean()) / correlations.std()
 
+# Permutation statistic for parallel.run(): for each permutation in a block,
+# shuffle the word scores and correlate them with the triangle scores
+
+class Sampler:
+
+  def __init__(self, word_scores, triangle_scores):
+    self.word_scores = word_scores
+    self.triangle_scores = triangle_scores
+
+  def __call__(self, size, random_state):
+    correlations = np.zeros(size, dtype=float)
+    for i in range(0, size):
+      random_state.shuffle(self.word_scores)
+      correlations[i] = np.corrcoef(self.word_scores, self.triangle_scores)[0,1]
+    return correlations
+
 ########################################
 
 # Score a word using a list of sound symbolic phonemes
@@ -0,0 +1,178 @@
+import numpy as np
+
+# Normalized Levenshtein distances between strings. (The module is not named
+# Levenshtein so that it does not shadow the python-Levenshtein package, whose
+# distance() gives the unnormalized edit distance.)
+
+# Maximum number of word pairs whose distances are remembered
+cache_size = 100000
+
+# Normalized distances keyed by word pair (the two words in sorted order). Each
+# entry is a (distance, tick) tuple, where tick records the last call that used
+# it, so that the least recently used pairs can be dropped when the cache fills.
+cache = {}
+clock = 0
+
+########################################
+
+# Normalized Levenshtein distance between two strings: the edit distance
+# divided by the length of the longer string
+
+def distance(s1, s2):
+  return paired_distances([s1], [s2])[0]
+
+# Normalized Levenshtein distance between every pair of strings in a list,
+# returned as a condensed distance matrix (an array in the order (0,1), (0,2),
+# ... (1,2), ...). Each distinct word pair is only computed once.
+
+def distances(strings):
+  words = sorted(set(strings))
+  word_indices = dict((word, i) for i, word in enumerate(words))
+  rows, cols = np.triu_indices(len(words), 1)
+  word_matrix = np.zeros((len(words), len(words)), dtype=float)
+  word_matrix[rows, cols] = paired_distances([words[i] for i in rows], [words[j] for j in cols])
+  word_matrix[cols, rows] = word_matrix[rows, cols]
+  string_indices = np.array([word_indices[string] for string in strings], dtype=int)
+  rows, cols = np.triu_indices(len(strings), 1)
+  return word_matrix[string_indices[rows], string_indices[cols]]
+
+# Normalized Levenshtein distance between each string in one list and the
+# string in the same position in another list, returned as an array. Pairs in
+# the cache are looked up; the rest are computed together and cached.
+
+def paired_distances(strings1, strings2):
+  global clock
+  clock += 1
+  keys = pair_keys(strings1, strings2)
+  results = [None] * len(keys)
+  missing = {}
+  for i, key in enumerate(keys):
+    entry = cache.get(key)
+    if entry == None:
+      missing.setdefault(key, []).append(i)
+    else:
+      results[i] = entry[0]
+      cache[key] = (entry[0], clock)
+  if len(missing) > 0:
+    missing_keys = missing.keys()
+    computed = normalized_distances([key[0] for key in missing_keys], [key[1] for key in missing_keys])
+    for key, value in zip(missing_keys, computed):
+      for i in missing[key]:
+        results[i] = value
+      cache[key] = (value, clock)
+    if len(cache) > cache_size:
+      evict()
+  return np.array(results, dtype=float)
+
+# Cache keys for pairs of strings; distance is symmetric, so each pair is
+# sorted
+
+def pair_keys(strings1, strings2):
+  return [(s1, s2) if s1 <= s2 else (s2, s1) for s1, s2 in zip(strings1, strings2)]
+
+# Drop the least recently used pairs, leaving the cache half full
+
+def evict():
+  keys = sorted(cache, key=lambda key: cache[key][1])
+  for key in keys[:len(keys) - (cache_size // 2)]:
+    del cache[key]
+
+# Empty the cache
+
+def clear_cache():
+  cache.clear()
+
+########################################
+
+# Compute normalized distances for lists of string pairs. Pairs in which the
+# shorter string has up to 64 characters go through the bit-parallel kernel;
+# any others fall back to dynamic programming.
+
+def normalized_distances(strings1, strings2):
+  shorter, longer = [], []
+  for s1, s2 in zip(strings1, strings2):
+    if len(s1) > len(s2):
+      s1, s2 = s2, s1
+    shorter.append(s1)
+    longer.append(s2)
+  lengths = np.array([len(s) for s in longer], dtype=float)
+  edits = np.zeros(len(shorter), dtype=int)
+  short_enough = np.array([len(s) <= 64 for s in shorter], dtype=bool)
+  if short_enough.any():
+    indices = np.flatnonzero(short_enough)
+    edits[indices] = bit_parallel_distances([shorter[i] for i in indices], [longer[i] for i in indices])
+  for i in np.flatnonzero(~short_enough):
+    edits[i] = dynamic_programming_distance(shorter[i], longer[i])
+  return edits / lengths
+
+# Myers' bit-parallel edit distance (in Hyyro's formulation), run for many
+# pairs at once. Each pattern (the shorter string of a pair, at most 64
+# characters) is held as bit vectors in a uint64, and all the pairs step
+# through their texts together, one character per step.
+
+def bit_parallel_distances(patterns, texts):
+  n_pairs = len(patterns)
+  pattern_lengths = np.array([len(p) for p in patterns], dtype=int)
+  text_lengths = np.array([len(t) for t in texts], dtype=int)
+
+  # Encode the characters as integers over the alphabet of the batch, encoding
+  # each distinct string once
+  strings = list(set(patterns) | set(texts))
+  alphabet = dict((char, i) for i, char in enumerate(set(''.join(strings))))
+  string_codes = encode(strings, alphabet, max([len(s) for s in strings]))
+  string_indices = dict((string, i) for i, string in enumerate(strings))
+  pattern_codes = string_codes[[string_indices[p] for p in patterns]]
+  text_codes = string_codes[[string_indices[t] for t in texts]]
+
+  # Match masks: bit i of peq[k, c] is set if character i of pattern k is c
+  peq = np.zeros((n_pairs, len(alphabet)), dtype=np.uint64)
+  pairs = np.arange(n_pairs)
+  for i in range(0, pattern_lengths.max()):
+    active = pattern_lengths > i
+    peq[pairs[active], pattern_codes[active, i]] |= np.uint64(1 << i)
+
+  one = np.uint64(1)
+  pv = np.full(n_pairs, np.uint64(2**64 - 1), dtype=np.uint64)
+  mv = np.zeros(n_pairs, dtype=np.uint64)
+  last_bits = np.array([1 << max(m - 1, 0) for m in pattern_lengths], dtype=np.uint64)
+  scores = pattern_lengths.copy()
+  for j in range(0, text_lengths.max()):
+    active = text_lengths > j
+    eq = peq[pairs, text_codes[:, j]]
+    xv = eq | mv
+    xh = (((eq & pv) + pv) ^ pv) | eq
+    ph = mv | ~(xh | pv)
+    mh = pv & xh
+    scores += active & ((ph & last_bits) != 0)
+    scores -= active & ((mh & last_bits) != 0)
+    ph = (ph << one) | one
+    mh = mh << one
+    pv = np.where(active, mh | ~(xv | ph), pv)
+    mv = np.where(active, ph & xv, mv)
+
+  # An empty pattern is text_length edits away from its text
+  return np.where(pattern_lengths == 0, text_lengths, scores)
+
+# Encode a list of strings as a matrix of character codes (padded with 0)
+
+def encode(strings, alphabet, width):
+  codes = np.zeros((len(strings), max(width, 1)), dtype=int)
+  for k, string in enumerate(strings):
+    codes[k, :len(string)] = [alphabet[char] for char in string]
+  return codes
+
+# Unnormalized Levenshtein distance by dynamic programming
+
+def dynamic_programming_distance(s1, s2):
+  if len(s1) > len(s2):
+    s1, s2 = s2, s1
+  distances = range(len(s1) + 1)
+  for index2, char2 in enumerate(s2):
+    newDistances = [index2 + 1]
+    for index1, char1 in enumerate(s1):
+      if char1 == char2:
+        newDistances.append(distances[index1])
+      else:
+        newDistances.append(1 + min((distances[index1], distances[index1+1], newDistances[-1])))
+    distances = newDistances
+  return distances[-1]
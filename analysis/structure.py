@@ -1,15 +1,15 @@
+from functools import partial
 import sublexical_structure
 import Mantel
 import basics
 import rater_analysis
+import scheduler
 
-def experiment_results(experiment, sublexical=False, permutations=1000, meaning_distances=False):
+def experiment_results(experiment, sublexical=False, permutations=1000, meaning_distances=False, n_jobs=1, alpha=None, error=0.001, z_error=None, distribution='permutations'):
   if type(meaning_distances) == bool and meaning_distances == False:
-    meaning_distances = rater_analysis.reliable_distance_array
-  results = []
-  for chain in basics.chain_codes[experiment-1]:
-    print('Chain ' + chain + '...')
-    results.append(chain_results(chain, sublexical, permutations, meaning_distances, experiment))
+    meaning_distances = rater_analysis.reliable_distance_array()
+  generation_function = partial(generation_results, sublexical=sublexical, permutations=permutations, meaning_distances=meaning_distances, experiment=experiment, alpha=alpha, error=error, z_error=z_error, distribution=distribution)
+  results = scheduler.experiment_results(generation_function, experiment, range(0, 11), n_jobs)
   if sublexical == True:
     dataset = {'data':results, 'experiment':experiment, 'starting_generation':0,
       'y_range':(-3,14), 'y_label':'Sublexical structure', 'data_type':'sublexical_structure'}
@@ -18,25 +18,38 @@ def experiment_results(experiment, sublexical=False, permutations=1000, meaning_
       'y_range':(-3,14), 'y_label':'Structure', 'data_type':'structure'}
   return dataset
 
-def chain_results(chain, sublexical=False, permutations=1000, meaning_distances=False, experiment=False):
+def chain_results(chain, sublexical=False, permutations=1000, meaning_distances=False, experiment=False, alpha=None, error=0.001, z_error=None, distribution='permutations'):
   if type(meaning_distances) == bool and meaning_distances == False:
-    meaning_distances = rater_analysis.reliable_distance_array
+    meaning_distances = rater_analysis.reliable_distance_array()
   if type(experiment) == bool and experiment == False:
     experiment = basics.determine_experiment_number(chain)
   results = []
   for generation in range(0, 11):
-    results.append(generation_results(chain, generation, sublexical, permutations, meaning_distances, experiment))
+    results.append(generation_results(chain, generation, sublexical, permutations, meaning_distances, experiment, alpha, error, z_error, distribution))
   return results
 
-def generation_results(chain, generation, sublexical=False, permutations=1000, meaning_distances=False, experiment=False):
+# Setting z_error stops each test's permutations early, once the z-score's
+# standard error is below z_error (see parallel.StoppingRule). The results are
+# z-scores, so alpha can only be set together with z_error: alpha on its own
+# stops a test once the significance of the result is decided, which says
+# nothing about the accuracy of the z-score, and with both set a test stops as
+# soon as either is met. Setting distribution to 'moments' computes exact
+# permutation z-scores without running permutations.
+def generation_results(chain, generation, sublexical=False, permutations=1000, meaning_distances=False, experiment=False, alpha=None, error=0.001, z_error=None, distribution='permutations'):
+  if alpha != None and z_error == None:
+    raise ValueError('The results are z-scores, so alpha should only be set together with z_error')
   if type(meaning_distances) == bool and meaning_distances == False:
-    meaning_distances = rater_analysis.reliable_distance_array
+    meaning_distances = rater_analysis.reliable_distance_array()
   if type(experiment) == bool and experiment == False:
     experiment = basics.determine_experiment_number(chain)
   strings = basics.getWords(experiment, chain, generation, 's')
   if len(set(strings)) > 1:
     if sublexical == True:
+      if distribution == 'moments':
+        return sublexical_structure.test(strings, meaning_distances, permutations, distribution='moments')
+      if alpha != None or z_error != None:
+        return sublexical_structure.test(strings, meaning_distances, permutations, alpha=alpha, error=error, z_error=z_error)[0]
       return sublexical_structure.test(strings, meaning_distances, permutations)
     string_distances = basics.stringDistances(strings)
-    return Mantel.test(string_distances, meaning_distances, permutations)[2]
+    return Mantel.test(string_distances, meaning_distances, permutations, alpha=alpha, error=error, z_error=z_error, distribution=distribution)[2]
   return None
@@ -1,9 +1,22 @@
-from itertools import permutations
+from itertools import islice, permutations
 from math import factorial
-from scipy.spatial.distance import squareform
 import numpy as np
-
-def test(strings, meaning_distances, perms):
+import string_distance
+import Mantel
+import parallel
+
+# Measure sublexical structure as the z-score of the covarience between meaning
+# distances and the distances between category labels. Setting alpha and/or
+# z_error runs the random permutations sequentially, as in Mantel.test(), and
+# the number of permutations used is then returned along with the z-score.
+# Setting distribution to 'moments' computes the z-score from the exact mean and
+# variance over all permutations of the category labels, without running any
+# (the sequential arguments are then ignored, and only the z-score is returned).
+def test(strings, meaning_distances, perms, n_jobs=1, seed=None, block_size=100, alpha=None, error=0.001, z_error=None, distribution='permutations'):
+  from scipy.spatial.distance import squareform
+
+  # Sequential stopping is requested by setting alpha and/or z_error
+  sequential = alpha != None or z_error != None
 
   # Compute meaning distance residuals
   meaning_residuals = residualize(meaning_distances)
@@ -15,12 +28,40 @@ def test(strings, meaning_distances, perms):
   # distance matrix
   label_distances = squareform(pairwise_string_distances(category_labels))
 
-  # Number of strings and number of possible category permutations
+  # Number of strings, number of categories, and number of possible category
+  # permutations
   m = len(strings)
-  n = factorial(len(category_labels))
-
-  # Compute the pairwise string indices to avoid doing this repeatedly in the main loop
-  string_iterator = [(i, j) for i in range(0, m) for j in range(i+1, m)]
+  k = len(category_labels)
+  n = factorial(k)
+
+  # Encode each string as the integer ID of its category, and precompute the
+  # category IDs of the two strings in each pair. Under a permutation of the
+  # category labels, a string's label is its category's position in the
+  # permuted labels, so the string distances for a whole block of permutations
+  # can be gathered from label_distances in one go.
+  string_categories = np.array([category_labels.index(string) for string in strings], dtype=int)
+  rows, cols = np.triu_indices(m, 1)
+  pair_categories = (string_categories[rows], string_categories[cols])
+
+  # A bound on the size of the covarience, against which rounding error in its
+  # spread over the permutations is judged: if every permutation gives the same
+  # covarience, the z-score is 0
+  scale = np.abs(meaning_residuals).sum() * np.abs(label_distances).max()
+
+  # Moments of the permutation distribution - a string pair's distance only
+  # depends on the permuted labels of its two categories, so the covarience is
+  # a Mantel statistic between the category-level sums of meaning residuals and
+  # label_distances, which is permuted as a whole.
+  if distribution == 'moments':
+    category_residuals = np.zeros((k, k), dtype=float)
+    np.add.at(category_residuals, pair_categories, meaning_residuals)
+    category_residuals += category_residuals.T
+    category_residuals[np.diag_indices(k)] = 0.0 # Pairs within a category always have distance 0
+    veridical = (category_residuals * label_distances).sum()
+    mean, variance = Mantel.permutation_moments(category_residuals, label_distances)
+    return Mantel.standard_score(veridical, mean, variance, scale)
+  elif distribution != 'permutations':
+    raise ValueError('The distribution should be set to "permutations" or "moments"')
 
   # Deterministic test - measure every possible category-meaning mapping.
   # This is used where the number of category permutations is less than the
@@ -31,17 +72,11 @@ def test(strings, meaning_distances, perms):
     # Create an empty array to store the covarience for each permutation
     covariences = np.zeros(n, dtype=float)
 
-    # Iterate over an enumeration of all permutations of category labels
-    for p, category_labels in enumerate(permutations(category_labels)):
-
-      # Map each string to its index in the permuted category labels
-      string_remapping = [category_labels.index(string) for string in strings]
-
-      # Compile the string distances from the pre-computed label_distances matrix
-      string_distances = [label_distances[string_remapping[i], string_remapping[j]] for i, j in string_iterator]
-
-      # Store the covarience between meaning distances and string distances
-      covariences[p] = (meaning_residuals * residualize(string_distances)).sum()
+    # Enumerate all permutations of category labels and process them in blocks
+    enumeration = permutations(range(k))
+    for start in range(0, n, block_size):
+      orders = np.array(list(islice(enumeration, block_size)), dtype=int)
+      covariences[start:start+orders.shape[0]] = permuted_covariences(meaning_residuals, label_distances, orders, pair_categories)
 
   # Stochasitc test - randomly sample the space of category-meaning mappings
   else:
@@ -52,23 +87,57 @@ def test(strings, meaning_distances, perms):
     # Compute the veridical covarience and store it in first position
     covariences[0] = (meaning_residuals * residualize(pairwise_string_distances(strings))).sum()
 
-    # For each permutation...
-    for p in range(1, perms):
-
-      # Shuffle the order of category labels
-      np.random.shuffle(category_labels)
-
-      # Map each string to its index in the permuted category_labels
-      string_remapping = [category_labels.index(string) for string in strings]
-
-      # Compile the string distances from the pre-computed label_distances matrix
-      string_distances = [label_distances[string_remapping[i], string_remapping[j]] for i, j in string_iterator]
-
-      # Store the covarience between meaning distances and string distances
-      covariences[p] = (meaning_residuals * residualize(string_distances)).sum()
-
-  # Return standard score (z-score)
-  return (covariences[0] - covariences.mean()) / covariences.std()
+    # Run the remaining permutations in blocks, which may be spread over
+    # several processes
+    sampler = Sampler(meaning_residuals, label_distances, pair_categories)
+    if sequential == True:
+      stop = parallel.StoppingRule(covariences[0], 'upper', alpha, error, z_error)
+      covariences = np.concatenate((covariences[:1], parallel.run_until(sampler, perms - 1, stop, n_jobs, seed, block_size)))
+    else:
+      covariences[1:] = parallel.run(sampler, perms - 1, n_jobs, seed, block_size)
+
+  # Return standard score (z-score), along with the number of permutations in
+  # sequential mode
+  z = Mantel.standard_score(covariences[0], covariences.mean(), covariences.var(), scale)
+  if sequential == True:
+    return z, covariences.shape[0]
+  return z
+
+# Compute the covarience between meaning distances and string distances under
+# each of a block of permutations of the category labels. Each row of orders
+# lists the category IDs in their permuted order.
+def permuted_covariences(meaning_residuals, label_distances, orders, pair_categories):
+
+  # Find each category's position in each permuted order
+  positions = np.zeros(orders.shape, dtype=int)
+  positions[np.arange(orders.shape[0])[:, np.newaxis], orders] = np.arange(orders.shape[1])
+
+  # Gather the string distances for every pair under every permutation
+  k = label_distances.shape[0]
+  string_distances = label_distances.take(positions[:, pair_categories[0]] * k + positions[:, pair_categories[1]])
+
+  # Residualize each permutation's string distances and compute the covariences
+  string_residuals = string_distances - string_distances.mean(axis=1)[:, np.newaxis]
+  return (meaning_residuals * string_residuals).sum(axis=1)
+
+# Permutation statistic for parallel.run(): for each permutation in a block,
+# shuffle the order of category labels, and then compute the covariences
+# between meaning distances and the remapped string distances for the whole
+# block
+class Sampler:
+
+  def __init__(self, meaning_residuals, label_distances, pair_categories):
+    self.meaning_residuals = meaning_residuals
+    self.label_distances = label_distances
+    self.pair_categories = pair_categories
+    self.order = np.arange(label_distances.shape[0])
+
+  def __call__(self, size, random_state):
+    orders = np.zeros((size, len(self.order)), dtype=int)
+    for p in range(0, size):
+      random_state.shuffle(self.order)
+      orders[p] = self.order
+    return permuted_covariences(self.meaning_residuals, self.label_distances, orders, self.pair_categories)
 
 # Return the residuals of an array
 def residualize(distances):
@@ -77,23 +146,8 @@ def residualize(distances):
 
 # Take a list of strings and compute the pairwise edit-distances
 def pairwise_string_distances(strings):
-  distances = []
-  for i in range(0, len(strings)):
-    for j in range(i+1, len(strings)):
-      distances.append(norm_Levenshtein_distance(strings[i], strings[j]))
-  return distances
+  return string_distance.distances(strings).tolist()
 
 # Calculate the normalized Levenshtein distance between two strings
 def norm_Levenshtein_distance(string1, string2):
-  if len(string1) > len(string2):
-    string1, string2 = string2, string1
-  distances = range(len(string1) + 1)
-  for index2, char2 in enumerate(string2):
-    newDistances = [index2 + 1]
-    for index1, char1 in enumerate(string1):
-      if char1 == char2:
-        newDistances.append(distances[index1])
-      else:
-        newDistances.append(1 + min((distances[index1], distances[index1+1], newDistances[-1])))
-    distances = newDistances
-  return float(distances[-1]) / max(len(string1), len(string2))
+  return string_distance.distance(string1, string2)
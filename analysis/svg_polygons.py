@@ -1,192 +1,114 @@
 #! /usr/bin/env python
 
-class Canvas:
+import hashlib
+import numpy as np
+
+# A canvas of polygons, circles, and dashed bounding boxes, written out as SVG
+# code. Each canvas keeps its own shape buffers, and the code is built as a list
+# of strings that is joined once. Shapes that repeat (boxes of one size, circles
+# of one radius) are defined once in <defs> and placed with <use>, and each
+# distinct style is written once as a CSS class. The names of the classes and
+# definitions are derived from their contents, so the code of several canvases
+# can be put in one document.
 
-  width = 0
-  height = 0
-  canvas = ''
-  polygons = []
-  circles = []
-  boxes = []
+class Canvas:
 
   def __init__(self, width=500, height=500):
     self.width = width
     self.height = height
-
-  class Polygon:
-
-    def __init__(self, shape):
-      self.shape = shape
-      self.border_colour = 'black'
-      self.fill_colour = None
-      self.opacity = 1.0
-      self.stroke_width = 1.0
-
-    def set_border_colour(self, colour):
-      self.border_colour = colour
-
-    def set_fill_colour(self, colour):
-      self.fill_colour = colour
-
-    def set_opacity(self, opacity):
-      self.opacity = opacity
-
-    def set_stroke_width(self, stroke_width):
-      self.stroke_width = stroke_width
-
-    def transform(self, x, y):
-      new_shape = []
-      for vertex in self.shape:
-        new_vertex = [vertex[0] + x, vertex[1] + y]
-        new_shape.append(new_vertex)
-      self.shape = new_shape
-
-  class Circle:
-
-    def __init__(self, position, radius):
-      self.position = position
-      self.radius = radius
-      self.border_colour = 'black'
-      self.fill_colour = None
-      self.opacity = 1.0
-
-    def set_border_colour(self, colour):
-      self.border_colour = colour
-
-    def set_fill_colour(self, colour):
-      self.fill_colour = colour
-
-    def set_opacity(self, opacity):
-      self.opacity = opacity
-
-    def transform(self, x, y):
-      self.position = [self.position[0] + x, self.position[1] + y]
-
-    def scale(self, scale_factor):
-      self.radius *= scale_factor
-
-  class Box:
-
-    def __init__(self, position, height, width):
-      self.position = position
-      self.height = height
-      self.width = width
-
-    def transform(self, x, y):
-      self.position = [self.position[0] + x, self.position[1] + y]
-
-    def scale(self, scale_factor):
-      self.height *= scale_factor
-      self.width *= scale_factor
+    self.clear()
 
   def add_polygon(self, shape, border_colour=False, fill_colour=False, opacity=False, stroke_width=1.0):
-    self.polygons.append(self.Polygon(shape))
-    if border_colour != False:
-      self.polygons[-1].set_border_colour(border_colour)
-    if fill_colour != False:
-      self.polygons[-1].set_fill_colour(fill_colour)
-    if opacity != False:
-      self.polygons[-1].set_opacity(opacity)
-    self.polygons[-1].set_stroke_width(stroke_width)
+    border_colour, fill_colour, opacity = shape_style(border_colour, fill_colour, opacity)
+    self.polygons.append(np.asarray(shape, dtype=float).reshape(-1, 2))
+    self.polygon_styles.append(self.style_class('fill:%s; stroke:%s; fill-opacity:%s; stroke-opacity:%s; stroke-width:%s; stroke-linejoin:miter;' % (fill_colour, border_colour, opacity, opacity, stroke_width)))
 
   def add_circle(self, position, radius, border_colour=False, fill_colour=False, opacity=False):
-    self.circles.append(self.Circle(position, radius))
-    if border_colour != False:
-      self.circles[-1].set_border_colour(border_colour)
-    if fill_colour != False:
-      self.circles[-1].set_fill_colour(fill_colour)
-    if opacity != False:
-      self.circles[-1].set_opacity(opacity)
+    border_colour, fill_colour, opacity = shape_style(border_colour, fill_colour, opacity)
+    self.circles.append((float(position[0]), float(position[1]), self.definition("<circle cx='0' cy='0' r='%s' />", radius)))
+    self.circle_styles.append(self.style_class('stroke:%s; fill:%s; fill-opacity:%s; stroke-opacity:%s;' % (border_colour, fill_colour, opacity, opacity)))
 
   def add_box(self, position, height, width):
-    self.boxes.append(self.Box(position, height, width))
-
-  def write_polygon_to_canvas(self, shape_id):
-    shape = self.polygons[shape_id]
-    if shape.fill_colour == None:
-      fill_colour = "none"
-    else:
-      fill_colour = shape.fill_colour
-    if shape.border_colour == None:
-      border_colour = "none"
-    else:
-      border_colour = shape.border_colour
-    opacity = shape.opacity
-    stroke_width = shape.stroke_width
-    canvas = "\n  <g id='shape_%s'>" % shape_id
-    points = [(str(vertex[0]) + "," + str(vertex[1])) for vertex in shape.shape]
-    canvas += "\n    <polygon points='" + (" ".join(points)) + "' style='fill:%s; stroke:%s; fill-opacity:%s; stroke-opacity:%s; stroke-width:%s; stroke-linejoin:miter;' />" % (fill_colour, border_colour, opacity, opacity, stroke_width)
-    canvas += "\n  </g>\n"
-    self.canvas += canvas
-
-  def write_circle_to_canvas(self, shape_id):
-    shape = self.circles[shape_id]
-    if shape.fill_colour == None:
-      fill_colour = "none"
-    else:
-      fill_colour = shape.fill_colour
-    if shape.border_colour == None:
-      border_colour = "none"
-    else:
-      border_colour = shape.border_colour
-    opacity = shape.opacity
-    position = shape.position
-    radius = shape.radius
-    canvas = "\n  <g id='circle_%s'>" % shape_id
-    canvas += "\n    <circle cx='%s' cy='%s' r='%s' style='stroke:%s; fill:%s; fill-opacity:%s; stroke-opacity:%s;' />" % (position[0], position[1], radius, border_colour, fill_colour, opacity, opacity)
-    canvas += "\n  </g>\n"
-    self.canvas += canvas
-
-  def write_box_to_canvas(self, shape_id):
-    shape = self.boxes[shape_id]
-    height = shape.height
-    width = shape.width
-    vertex1 = shape.position
-    vertex2 = [vertex1[0]+width, vertex1[1]]
-    vertex3 = [vertex1[0]+width, vertex1[1]+height]
-    vertex4 = [vertex1[0], vertex1[1]+height]
-    canvas = "\n  <g id='bounding_box_%s'>" % shape_id
-    canvas += "\n    <polygon points='%s,%s %s,%s %s,%s, %s,%s' style='fill:none; stroke:gray; stroke-width:1; stroke-dasharray:3 2'/>" % (vertex1[0], vertex1[1], vertex2[0], vertex2[1], vertex3[0], vertex3[1], vertex4[0], vertex4[1])
-    canvas += "\n  </g>"
-    self.canvas += canvas
-
-  def write_all_polygons(self):
-    for shape_id in range(0, len(self.polygons)):
-      self.write_polygon_to_canvas(shape_id)
-
-  def write_all_circles(self):
-    for shape_id in range(0, len(self.circles)):
-      self.write_circle_to_canvas(shape_id)
-
-  def write_all_boxes(self):
-    for shape_id in range(0, len(self.boxes)):
-      self.write_box_to_canvas(shape_id)
-
-  def write_everything(self):
-    self.write_all_boxes()
-    self.write_all_circles()
-    self.write_all_polygons()
+    self.boxes.append((float(position[0]), float(position[1]), self.definition("<rect x='0' y='0' width='%s' height='%s' class='%s' />", width, height, self.style_class('fill:none; stroke:gray; stroke-width:1; stroke-dasharray:3 2;'))))
+
+  # The name of the CSS class for a style, which is added if it's new
+  def style_class(self, style):
+    if style not in self.styles:
+      self.styles[style] = content_name('s', style)
+    return self.styles[style]
+
+  # The ID of the definition of a shape, which is added if it's new
+  def definition(self, template, *values):
+    code = template % tuple([number(value) if type(value) != str else value for value in values])
+    if code not in self.definitions:
+      self.definitions[code] = content_name('d', code)
+    return self.definitions[code]
+
+  # Write the SVG code for the shapes to a file-like stream
+  def write(self, stream):
+    stream.write(self.code())
+
+  # Return the SVG code for the shapes: styles and definitions, followed by the
+  # boxes, the circles, and the polygons
+  def code(self):
+    parts = []
+    if len(self.styles) > 0:
+      parts.append("\n<style type='text/css'>\n")
+      parts.extend(['.%s { %s }\n' % (name, style) for style, name in sorted(self.styles.items())])
+      parts.append("</style>")
+    if len(self.definitions) > 0:
+      parts.append("\n<defs>\n")
+      parts.extend([code.replace(' ', " id='%s' " % name, 1) + '\n' for code, name in sorted(self.definitions.items())])
+      parts.append("</defs>")
+    for x, y, name in self.boxes:
+      parts.append("\n<use xlink:href='#%s' x='%s' y='%s' />" % (name, number(x), number(y)))
+    for (x, y, name), style in zip(self.circles, self.circle_styles):
+      parts.append("\n<use xlink:href='#%s' x='%s' y='%s' class='%s' />" % (name, number(x), number(y), style))
+    for shape, style in zip(self.polygons, self.polygon_styles):
+      parts.append("\n<polygon points='%s' class='%s' />" % (' '.join(['%s,%s' % (number(x), number(y)) for x, y in shape]), style))
+    parts.append("\n")
+    return ''.join(parts)
 
   def save(self, filename='drawing'):
-    canvas = self.addHeader()
-    canvas += self.addCanvas()
-    canvas += self.addFooter()
     f = open(filename + '.svg', 'w')
-    f.write(canvas)
+    f.write(self.addHeader())
+    self.write(f)
+    f.write(self.addFooter())
     f.close()
     print('File saved as %s.svg' % filename)
 
   def clear(self):
-    self.canvas = ''
     self.polygons = []
+    self.polygon_styles = []
     self.circles = []
+    self.circle_styles = []
     self.boxes = []
+    self.styles = {}
+    self.definitions = {}
 
   def addHeader(self):
-    return "<svg width='" + str(self.width) + "' height='" + str(self.height) + "' xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#' xmlns:svg='http://www.w3.org/2000/svg' xmlns='http://www.w3.org/2000/svg' version='1.1'>\n"
-
-  def addCanvas(self):
-    return self.canvas + "\n"
+    return "<svg width='" + str(self.width) + "' height='" + str(self.height) + "' xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#' xmlns:svg='http://www.w3.org/2000/svg' xmlns='http://www.w3.org/2000/svg' xmlns:xlink='http://www.w3.org/1999/xlink' version='1.1'>\n"
 
   def addFooter(self):
     return "</svg>"
+
+# Fill in the default colours and opacity of a shape (a black border, no fill,
+# and full opacity)
+def shape_style(border_colour, fill_colour, opacity):
+  if border_colour == None:
+    border_colour = 'none'
+  elif border_colour == False:
+    border_colour = 'black'
+  if fill_colour == None or fill_colour == False:
+    fill_colour = 'none'
+  if opacity == False:
+    opacity = 1.0
+  return border_colour, fill_colour, opacity
+
+# A name for some code, derived from its contents
+def content_name(prefix, code):
+  return prefix + hashlib.sha1(code).hexdigest()[:10]
+
+# Format a coordinate or length to 6 significant figures
+def number(value):
+  return '%g' % value
@@ -1,9 +1,10 @@
+from functools import partial
 import basics
+import scheduler
 
-def experiment_results(experiment):
-  results = []
-  for chain in basics.chain_codes[experiment-1]:
-    results.append(chain_results(chain, experiment))
+def experiment_results(experiment, n_jobs=1):
+  generation_function = partial(generation_results, experiment=experiment)
+  results = scheduler.experiment_results(generation_function, experiment, range(1, 11), n_jobs)
   dataset = {'data':results, 'experiment': experiment, 'starting_generation':1,
     'y_range':(0,1), 'y_label':'Transmission error', 'data_type':'transmission_error'}
   return dataset
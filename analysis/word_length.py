@@ -1,9 +1,12 @@
+from functools import partial
 import basics
+import scheduler
 
-def experiment_results(experiment):
-  results = [chain_results(chain, experiment) for chain in basics.chain_codes[experiment-1]]
+def experiment_results(experiment, n_jobs=1):
+  generation_function = partial(generation_results, experiment=experiment)
+  results = scheduler.experiment_results(generation_function, experiment, range(0, 11), n_jobs)
   return {'data':results, 'experiment':experiment, 'starting_generation':0,
-    'y_range':(3,9)}, 'y_label':'Average word length', 'data_type':'word_length'}
+    'y_range':(3,9), 'y_label':'Average word length', 'data_type':'word_length'}
 
 def chain_results(chain, experiment=False):
   if type(experiment) == bool and experiment == False: